@@ -31,6 +31,14 @@ class LightworldAvatarControler:
          self.curPos = LVector3(x,y, terrainHeight + self.avatarHeight)
          self.curCamPos = self.curPos - self.getMoveDir() * self.camDist
 
+    def setPosAndHeading(self, pos, heading):
+        self.curPos = LVector3(pos)
+        self.curHeading = heading
+        self.curCamPos = self.curPos - self.getMoveDir() * self.camDist
+        self.moving = False
+        self.turning = False
+        self.canReceiveCommand = True
+
     def getMoveDir(self):
         return Heading.getDirection3f(self.curHeading)
     
@@ -5,9 +5,6 @@ from direct.interval.IntervalGlobal import *
 from panda3d.core import lookAt
 from panda3d.core import GeomVertexFormat, GeomVertexData
 from panda3d.core import Geom, GeomTriangles, GeomVertexWriter
-from panda3d.core import CollisionTraverser, CollisionNode
-from panda3d.core import CollisionHandlerQueue, CollisionRay
-from panda3d.core import CollideMask
 from panda3d.core import Texture, GeomNode, TransparencyAttrib
 from panda3d.core import PerspectiveLens
 from panda3d.core import CardMaker
@@ -18,15 +15,33 @@ from panda3d.core import NodePath
 from panda3d.core import Fog
 
 from panda3d.core import Material
+from panda3d.core import Quat
+from panda3d.core import ConfigVariableInt, ConfigVariableBool, ConfigVariableString
+from panda3d.core import loadPrcFileData
 
 import sys
 import os
+import argparse
+import json
+import random
+import time
 
 import cProfile
 
 from navigation import *
-from terrainMesh import TerrainMesher
+from terrainMesh import TerrainMesher, TerrainTextureScheme
+from terrainChunks import TerrainChunkGrid, TerrainChunkCuller, TerrainRemeshScheduler, TerrainChunkBatcher
+from terrainLighting import TerrainLightBaker
+from terrainCollision import TerrainCollider
+from textureAtlas import TextureAtlasBuilder
+from terrainMinimap import TerrainMinimap
+from memoryBudget import MemoryBudget, MemoryAccounting
 from avatar import LightworldAvatarControler 
+from waterSimulation import WaterSimulation
+from terrainGeneration import TerrainPipeline
+from worldSnapshot import WorldSnapshotWriter, WorldSnapshotReader, WorldSnapshotStreamer
+from simulationClock import FixedTimestepClock, InputRecorder, InputReplay
+from qualityGovernor import QualityGovernor, QualityParameter
 
 # Function to put text on the screen.
 def addInstructions(pos, msg):
@@ -39,20 +54,39 @@ def addStatistics(pos, msg):
                         shadow=(0, 0, 0, 1), parent=base.a2dBottomLeft,
                         pos=(0.08, pos + 0.04), align=TextNode.ALeft)
 
+def addReport(msg):
+    return OnscreenText(text=msg, style=1, fg=(1, 1, 1, 1), scale=.04,
+                        shadow=(0, 0, 0, 1), parent=base.a2dTopRight,
+                        pos=(-0.08, -0.08), align=TextNode.ARight, mayChange=True)
+
 # Function to put title on the screen.
 def addTitle(text):
     return OnscreenText(text=text, style=1, fg=(1, 1, 1, 1), scale=.06,
                         parent=base.a2dBottomRight, align=TextNode.ARight,
                         pos=(-0.1, 0.09), shadow=(0, 0, 0, 1))
 
+# Command line options
+def parseArguments():
+    parser = argparse.ArgumentParser(description="Lightworld: Explore the map")
+    parser.add_argument("--record", metavar="PATH", help="record the input events of the session")
+    parser.add_argument("--replay", metavar="PATH", help="replay a recorded session")
+    parser.add_argument("--benchmark", metavar="PATH",
+                        help="with --replay, one simulation step per frame and frame times written to PATH")
+    parser.add_argument("--headless", action="store_true", help="render offscreen, without audio")
+    options, _ = parser.parse_known_args()
+    return options
+
 # Game Class
 class LightworldBasic(ShowBase):
-    def __init__(self):
+    def __init__(self, options=None):
         
         # Interactive or overview mode
         self.overview = True
 
         # Set up the window, camera, etc.
+        self.options = parseArguments() if options is None else options
+        if self.options.headless:
+            loadPrcFileData("", "window-type offscreen\naudio-library-name null")
         ShowBase.__init__(self)
 
         # Set the background color to blue
@@ -71,6 +105,11 @@ class LightworldBasic(ShowBase):
         self.inst.append(addInstructions(0.30, "[Right Arrow]: Rotate Right"))
         self.inst.append(addInstructions(0.35, "[Up Arrow]: Move Forward"))
         self.inst.append(addInstructions(0.40, "[Down Arrow]: Move Backward"))
+        self.inst.append(addInstructions(0.45, "[o]: Toggle Occlusion Culling"))
+        self.inst.append(addInstructions(0.50, "[F5/F6/F9]: Save/Save Edits/Load World"))
+        self.inst.append(addInstructions(0.55, "[PgUp/PgDn/End]: Raise/Lower/Flatten Ahead"))
+        self.inst.append(addInstructions(0.60, "[w/Home]: Toggle Water Flow/Add Spring Ahead"))
+        self.inst.append(addInstructions(0.65, "[m]: Toggle Memory and Generation Report"))
 
 
         self.terrainSize = 64
@@ -80,6 +119,20 @@ class LightworldBasic(ShowBase):
         self.stat.append(addStatistics(0.10, self.terrainSizeMsg.format(self.terrainSize)))
         self.terrainMaxHeightMsg = "Terrain Max Height: {0}"
         self.stat.append(addStatistics(0.05, self.terrainMaxHeightMsg.format(self.terrainHeight)))
+        self.visibleChunksMsg = "Visible Chunks: {0}/{1} ({2} verts)"
+        self.stat.append(addStatistics(0.15, self.visibleChunksMsg.format(0, 0, 0)))
+        self.memoryMsg = "Memory: {0:.1f} / {1:.0f} MB"
+        self.memoryRefusedMsg = "Size {0} refused: needs {1:.0f} MB of {2:.0f} MB"
+        self.regenerationRefusedMsg = "Size {0} refused: regeneration too slow over size {1}"
+        self.stat.append(addStatistics(0.20, self.memoryMsg.format(0, 0)))
+
+        # Memory budget of the world, checked before creating larger terrains
+        budgetMB = ConfigVariableInt("lightworld-memory-budget-mb", 1024).getValue()
+        # 24 instead of 36 bytes per vertex, see Mesh
+        compactVertices = ConfigVariableBool("lightworld-compact-vertices", False).getValue()
+        self.memoryBudget = MemoryBudget(budgetMB * 1024 * 1024, compactVertices)
+        self.memoryReport = addReport("")
+        self.memoryReport.hide()
 
         # Create the avatar
         avatarHeight = 1.6
@@ -88,31 +141,127 @@ class LightworldBasic(ShowBase):
         
         self.linfog = Fog("A linear-mode Fog node")
         self.linfog.setColor(0.16, 0.72, 0.87)
-        self.linfog.setLinearRange(0,18)
-        self.linfog.setLinearFallback(45,6,18)
+        self.fogDistance = 18
+        self.linfog.setLinearRange(0,self.fogDistance)
+        self.linfog.setLinearFallback(45,6,self.fogDistance)
         self.camera.attachNewNode(self.linfog)
         render.setFog(self.linfog)
+        self.activeFog = self.linfog
+        # First person view distance, None when unlimited: far plane of the
+        # lens and a sky colored fog fading the terrain out before it
+        self.viewDistance = None
+        self.defaultFar = self.camLens.getFar()
+        self.distanceFog = Fog("Distance fog")
+        self.distanceFog.setColor(*self.skyBackgroundColor)
+        self.camera.attachNewNode(self.distanceFog)
 
         # Initialize terrain and avatar
-        self.texture = loader.loadTexture("terrainTex2.png") 
+        # Materials of terrainTex2.png repacked with gutters and mip levels
+        atlasBuilder = TextureAtlasBuilder()
+        atlasBuilder.addMaterialsFromGrid(loader.loadTexture("terrainTex2.png"), 4, TerrainTextureScheme.Materials)
+        self.texture = atlasBuilder.buildTexture("terrainAtlas")
+        self.materialColors = atlasBuilder.getMeanColors()
         self.terrainNode = NodePath()
         self.waterNode = NodePath()
+        # Minimap, and its low poly proxy drawn instead of the meshes in overview
+        self.minimap = None
+        self.minimapCard = NodePath()
+        self.minimapAvatar = NodePath()
+        self.overviewNode = NodePath()
+        self.overviewProxyDirty = False
         self.terrainMesher = TerrainMesher() 
+        self.terrainMesher.textureUVMap = atlasBuilder.getUVMap()
+        self.terrainMesher.compactVertices = compactVertices
+        # Weathered terrain, see TerrainPipeline.makeEroded
+        if ConfigVariableBool("lightworld-terrain-erosion", False).getValue():
+            self.terrainMesher.terrainPipeline = TerrainPipeline.makeEroded()
+        # Static chunks merged by batches of n x n chunks, 0 to draw them one by one
+        self.chunkBatchSize = ConfigVariableInt("lightworld-chunk-batch-size", 0).getValue()
+        self.memoryBudget.batchedMeshes = self.chunkBatchSize > 0
+        self.chunkBatchers = []
+        self.chunkSize = 16
+        self.chunkGrid = None
+        self.chunkCuller = None
+        self.remeshScheduler = None
+        self.brushRadius = 1
+        self.waterSimulation = None
+        self.waterFlowEnabled = False
+        self.springRate = 2.0
+
+        # Main directional light, also used to bake terrain shadows
+        self.sunHpr = LVector3(-100, -50, 0)
+        sunQuat = Quat()
+        sunQuat.setHpr(self.sunHpr)
+        self.sunDirection = -sunQuat.getForward()
+        self.snapshotPath = "world.lwsnap"
+        self.unsavedChunks = set()
+        # Whether the snapshot holds the current world up to unsavedChunks
+        self.snapshotMatchesWorld = False
+
+        # Fixed timestep simulation, inputs are applied at simulation steps so
+        # that sessions can be recorded and replayed identically
+        self.simulationClock = FixedTimestepClock(60.0)
+        # Avatar move and turn speed, in world units per second
+        self.avatarSpeed = 9.0
+        self.prevAvatarPos = LVector3(self.avatarControler.curPos)
+        self.prevCamPos = LVector3(self.avatarControler.curCamPos)
+        self.inputHandlers = {}
+        self.pendingInput = []
+        self.inputRecorder = None
+        self.inputReplay = None
+        self.frameTimes = []
+        sessionHeader = {"seed": random.randrange(1, 2 ** 31), "terrainSize": self.terrainSize,
+                         "terrainHeight": self.terrainHeight, "stepRate": self.simulationClock.stepRate}
+        if self.options.replay:
+            self.inputReplay = InputReplay(self.options.replay)
+            sessionHeader = self.inputReplay.header
+            self.terrainSize = sessionHeader["terrainSize"]
+            self.terrainHeight = sessionHeader["terrainHeight"]
+            self.simulationClock = FixedTimestepClock(sessionHeader["stepRate"])
+            self.simulationClock.lockstep = self.options.benchmark is not None
+        elif self.options.record:
+            self.inputRecorder = InputRecorder(self.options.record, sessionHeader)
+        # Terrain seeds of the session
+        self.seedRandom = random.Random(sessionHeader["seed"])
+
+        # Quality adjusted to the frame time, off without a target frame rate,
+        # while benchmarking and while replaying, a replay must not depend on
+        # the frame times of the machine
+        self.remeshBudget = 0.004
+        self.qualityGovernor = None
+        targetFps = ConfigVariableInt("lightworld-target-fps", 0).getValue()
+        if(targetFps > 0 and self.options.benchmark is None and self.inputReplay is None):
+            self.qualityGovernor = self.makeQualityGovernor(1.0 / targetFps)
 
         # Generate terrain and position avatar
         self.updateTerrain()
 
         # Accept the control keys for movement and rotation
-        self.accept("escape", sys.exit)
-        self.accept("v", self.toggleOverview)
-        self.accept("+", self.increaseTerrainSize)
-        self.accept("-", self.decreaseTerrainSize)
-        self.accept("space", self.updateTerrain)
-        self.accept("arrow_left", self.turnLeft)
-        self.accept("arrow_right", self.turnRight)
-        self.accept("arrow_up", self.moveForward)
-        self.accept("arrow_down", self.moveBackward)
-        taskMgr.add(self.move, "moveTask")
+        self.accept("escape", self.quit)
+        self.acceptInput("v", self.toggleOverview)
+        self.acceptInput("+", self.increaseTerrainSize)
+        self.acceptInput("-", self.decreaseTerrainSize)
+        self.acceptInput("space", self.updateTerrain)
+        self.acceptInput("o", self.toggleOcclusionCulling)
+        self.accept("f5", self.saveWorld)
+        self.accept("f6", self.saveWorldEdits)
+        self.acceptInput("f9", self.loadWorld)
+        self.acceptInput("page_up", self.raiseTerrainAhead)
+        self.acceptInput("page_down", self.lowerTerrainAhead)
+        self.acceptInput("end", self.flattenTerrainAhead)
+        self.acceptInput("w", self.toggleWaterFlow)
+        self.acceptInput("home", self.addSpringAhead)
+        self.accept("m", self.toggleMemoryReport)
+        self.acceptInput("arrow_left", self.turnLeft)
+        self.acceptInput("arrow_right", self.turnRight)
+        self.acceptInput("arrow_up", self.moveForward)
+        self.acceptInput("arrow_down", self.moveBackward)
+        taskMgr.add(self.simulate, "simulationTask", sort=30)
+        taskMgr.add(self.remeshChunks, "remeshTask", sort=40)
+        taskMgr.add(self.cullChunks, "cullTask", sort=45)
+        if self.qualityGovernor is not None:
+            taskMgr.add(self.governQuality, "qualityTask", sort=50)
+        taskMgr.doMethodLater(1.0, self.updateMemoryReport, "memoryTask")
 
         self.disableMouse()
         self.toggleOverview()
@@ -133,56 +282,200 @@ class LightworldBasic(ShowBase):
         dlight3.setColor((0.6, 0.6, 0.6, 1))
         dlnp3 = render.attachNewNode(dlight3)
         render.setLight(dlnp3)
-        dlnp3.setHpr(-100, -50, 0)
+        dlnp3.setHpr(self.sunHpr)
         
     def updateAvatarPosition(self):
         self.avatarControler.setInitialPos(0,0,self.terrainMesher.heightMap.getZHeightFromXY(0.0,0.0))
     
     def updateCameraPosition(self):
         if self.overview == False:
-            self.camera.setPos(self.avatarControler.curCamPos)
-            self.camera.lookAt(self.avatarControler.curPos)
-            if(not render.hasFog() and self.camera.getPos().getZ() < -0.25):
-                render.setFog(self.linfog)
-                self.setBackgroundColor(*self.seaBackgroundColor)
-            elif(render.hasFog() and self.camera.getPos().getZ() > -0.25):
-                render.clearFog()
-                self.setBackgroundColor(*self.skyBackgroundColor)
+            self.prevAvatarPos = LVector3(self.avatarControler.curPos)
+            self.prevCamPos = LVector3(self.avatarControler.curCamPos)
+            self.updateFirstPersonCamera(1.0)
         else:
             self.camera.setPos(LVector3(-2.2 * self.terrainSize, -1.7 * self.terrainSize, self.terrainSize) )
             self.camera.lookAt(LVector3(-0.1 * self.terrainSize, 0.0, -0.30 * self.terrainSize))
-            if(render.hasFog()):
-                render.clearFog()
-                self.setBackgroundColor(*self.skyBackgroundColor)
+            self.updateFog()
+
+    # Camera position behind the avatar, pulled in front of the terrain when
+    # the view from the avatar is blocked
+    def getCameraPos(self, avatarPos, camPos):
+        offset = camPos - avatarPos
+        distance = offset.length()
+        if distance <= 0.0:
+            return camPos
+        hit = self.terrainCollider.castRay(avatarPos, offset / distance, distance)
+        if hit is None:
+            return camPos
+        return avatarPos + offset * max(hit.t - 0.1, 0.0) / distance
 
     def updateTerrain(self):
-        self.terrainMesher.generateTerrain(self.terrainSize, self.terrainHeight)
-        self.updateTerrainMesh()
-        self.updateWaterMesh()
+        start = time.perf_counter()
+        self.terrainMesher.generateTerrain(self.terrainSize, self.terrainHeight, self.seedRandom.randrange(1, 2 ** 31))
+        self.updateTerrainNodes()
+        self.snapshotMatchesWorld = False
+        if self.qualityGovernor is not None:
+            self.qualityGovernor.addRegeneration(self.terrainSize, time.perf_counter() - start)
         self.updateAvatarPosition()
         self.updateCameraPosition()
+
+    def updateTerrainNodes(self):
+        self.chunkGrid = TerrainChunkGrid(self.terrainMesher.heightMap, self.chunkSize)
+        self.chunkCuller = TerrainChunkCuller(self.chunkGrid)
+        self.chunkGrid.lightBaker = TerrainLightBaker(self.terrainMesher.heightMap, self.sunDirection)
+        self.terrainCollider = TerrainCollider(self.terrainMesher.heightMap)
+        self.terrainMesher.heightMap.popDirtyRects()
+        # Rects edited by the simulation, not remeshed yet
+        self.editedRects = []
+        self.unsavedChunks = set()
+        self.updateTerrainMesh()
+        self.updateWaterMesh()
+        self.remeshScheduler = TerrainRemeshScheduler(
+            self.chunkGrid, self.terrainMesher, self.terrainNode, self.waterNode, self.remeshBudget)
+        self.chunkBatchers = []
+        if self.chunkBatchSize > 0:
+            self.chunkBatchers = [
+                TerrainChunkBatcher(self.chunkGrid, self.terrainNode, TerrainChunkBatcher.TerrainLayer, self.chunkBatchSize),
+                TerrainChunkBatcher(self.chunkGrid, self.waterNode, TerrainChunkBatcher.WaterLayer, self.chunkBatchSize)]
+        self.waterSimulation = WaterSimulation(self.terrainMesher.heightMap)
+        self.updateMinimapNodes()
         self.stat[0].setText(self.terrainSizeMsg.format(self.terrainSize))
         self.stat[1].setText(self.terrainMaxHeightMsg.format(self.terrainHeight))
+        self.updateMemoryReport()
+
+    # Minimap card in the corner, with a marker at the avatar
+    def updateMinimapNodes(self):
+        self.minimap = TerrainMinimap(self.terrainMesher.heightMap, self.materialColors, self.sunDirection)
+        self.minimapCard.removeNode()
+        cardMaker = CardMaker('minimap')
+        cardMaker.setFrame(-0.25, 0.25, -0.25, 0.25)
+        self.minimapCard = base.a2dBottomRight.attachNewNode(cardMaker.generate())
+        self.minimapCard.setPos(-0.35, 0, 0.45)
+        self.minimapCard.setTexture(self.minimap.texture)
+        cardMaker = CardMaker('minimapAvatar')
+        cardMaker.setFrame(-0.012, 0.012, -0.012, 0.012)
+        self.minimapAvatar = self.minimapCard.attachNewNode(cardMaker.generate())
+        self.minimapAvatar.setTextureOff(1)
+        self.minimapAvatar.setColor(1.0, 0.2, 0.2, 1.0)
+        self.overviewProxyDirty = True
+        self.updateOverviewNodes()
+
+    # Overview draws the proxy, the first person view the meshes and minimap
+    def updateOverviewNodes(self):
+        if self.overview:
+            if self.overviewProxyDirty:
+                self.overviewNode.removeNode()
+                self.overviewNode = render.attachNewNode(self.minimap.makeProxyNode(kHeights=self.chunkGrid.kHeights))
+                self.overviewNode.setTexture(self.minimap.texture)
+                self.overviewNode.setLightOff()
+                self.overviewProxyDirty = False
+            self.overviewNode.show()
+            self.terrainNode.hide()
+            self.waterNode.hide()
+            self.minimapCard.hide()
+        else:
+            self.overviewNode.hide()
+            self.terrainNode.show()
+            self.waterNode.show()
+            self.minimapCard.show()
 
     def updateTerrainMesh(self):
         self.terrainNode.removeNode()
-        terrainMesh = self.terrainMesher.meshTerrain()
-        snode = GeomNode('terrainPatch')
-        snode.addGeom(terrainMesh)
-        self.terrainNode = render.attachNewNode(snode)
+        self.terrainNode = render.attachNewNode('terrainPatch')
         self.terrainNode.setTexture(self.texture)
+        self.chunkGrid.buildTerrainNodes(self.terrainMesher, self.terrainNode)
 
     def updateWaterMesh(self):
         self.waterNode.removeNode()
-        waterMesh = self.terrainMesher.meshWater()
-        snode = GeomNode('waterPatch')
-        snode.addGeom(waterMesh)
-        self.waterNode = render.attachNewNode(snode)
+        self.waterNode = render.attachNewNode('waterPatch')
         self.waterNode.setTexture(self.texture)
+        self.chunkGrid.buildWaterNodes(self.terrainMesher, self.waterNode)
         self.waterNode.setTwoSided(True)
         self.waterNode.setTransparency(TransparencyAttrib.M_alpha)
 
+    def saveWorld(self):
+        writer = WorldSnapshotWriter(self.snapshotPath, self.chunkSize)
+        writer.saveFull(self.terrainMesher.heightMap, self.avatarControler)
+        self.unsavedChunks = set()
+        self.snapshotMatchesWorld = True
+
+    # Append the chunks edited since the last save to the snapshot, or save
+    # the whole world when the snapshot holds another one
+    def saveWorldEdits(self):
+        if(not self.snapshotMatchesWorld or not os.path.exists(self.snapshotPath)):
+            self.saveWorld()
+            return
+        writer = WorldSnapshotWriter(self.snapshotPath, self.chunkSize)
+        try:
+            writer.saveDelta(self.terrainMesher.heightMap, sorted(self.unsavedChunks), self.avatarControler)
+        except ValueError:
+            # Layout of another world, e.g. the file was replaced
+            self.saveWorld()
+            return
+        self.unsavedChunks = set()
+
+    def loadWorld(self):
+        if not os.path.exists(self.snapshotPath):
+            return
+        reader = WorldSnapshotReader(self.snapshotPath)
+        if not self.checkMemoryBudget(reader.size):
+            reader.close()
+            return
+        streamer = WorldSnapshotStreamer(reader)
+        streamer.streamAll()
+        self.terrainMesher.setTerrain(streamer.heightMap)
+        self.terrainSize = reader.size
+        self.terrainHeight = reader.height
+        if reader.hasAgent():
+            pos, heading = reader.readAgent()
+            self.avatarControler.setPosAndHeading(pos, heading)
+        else:
+            self.updateAvatarPosition()
+        reader.close()
+        self.updateTerrainNodes()
+        self.snapshotMatchesWorld = True
+        self.updateCameraPosition()
+
+    # Refuse sizes whose estimated memory is over the budget
+    def checkMemoryBudget(self, size):
+        if self.memoryBudget.fits(size, self.chunkSize):
+            return True
+        estimate = self.memoryBudget.estimate(size, self.chunkSize).getTotal()
+        self.stat[3].setText(self.memoryRefusedMsg.format(
+            size, estimate / (1024 * 1024), self.memoryBudget.limitBytes / (1024 * 1024)))
+        return False
+
+    def measureMemory(self):
+        return MemoryAccounting.measureWorld(
+            self.terrainMesher.heightMap, self.chunkGrid, self.waterSimulation, self.terrainCollider, self.chunkBatchers)
+
+    def toggleMemoryReport(self):
+        if self.memoryReport.isHidden():
+            self.memoryReport.show()
+            self.updateMemoryReport()
+        else:
+            self.memoryReport.hide()
+
+    def updateMemoryReport(self, task=None):
+        report = self.measureMemory()
+        self.stat[3].setText(self.memoryMsg.format(
+            report.getTotal() / (1024 * 1024), self.memoryBudget.limitBytes / (1024 * 1024)))
+        if not self.memoryReport.isHidden():
+            pipeline = self.terrainMesher.terrainPipeline
+            lines = report.formatLines()
+            lines.append("")
+            lines.append("Generation: {0:.0f} ms".format(pipeline.getTotalTime() * 1000.0))
+            lines.extend(pipeline.formatTimings())
+            self.memoryReport.setText("\n".join(lines))
+        if task is not None:
+            return task.again
+
     def increaseTerrainSize(self):
+        if not self.checkMemoryBudget(self.terrainSize * 2):
+            return
+        if(self.qualityGovernor is not None and not self.qualityGovernor.allowsTerrainSize(self.terrainSize * 2)):
+            self.stat[3].setText(self.regenerationRefusedMsg.format(self.terrainSize * 2, self.qualityGovernor.maxTerrainSize))
+            return
         self.terrainSize = round(self.terrainSize * 2.0)
         self.terrainHeight = round(self.terrainHeight * 1.5)
         self.updateTerrain()
@@ -210,6 +503,7 @@ class LightworldBasic(ShowBase):
             self.inst[6].hide()
             self.inst[7].hide()
             
+        self.updateOverviewNodes()
         self.updateCameraPosition()
 
     def moveForward(self):
@@ -224,6 +518,31 @@ class LightworldBasic(ShowBase):
             target.setZ(self.terrainMesher.heightMap.getZHeightFromXY(target.getX(),target.getY()))
             self.avatarControler.triggerMove(target)
 
+    def getCellAhead(self):
+        target = self.avatarControler.getTargetForwardCell()
+        return self.terrainMesher.heightMap.getIJLocationFromXY(target.getXy())
+
+    def raiseTerrainAhead(self):
+        if self.overview == False:
+            ij = self.getCellAhead()
+            self.terrainMesher.heightMap.raiseTerrain(ij.getX(), ij.getY(), self.brushRadius)
+
+    def lowerTerrainAhead(self):
+        if self.overview == False:
+            ij = self.getCellAhead()
+            self.terrainMesher.heightMap.lowerTerrain(ij.getX(), ij.getY(), self.brushRadius)
+
+    def flattenTerrainAhead(self):
+        if self.overview == False:
+            ij = self.getCellAhead()
+            self.terrainMesher.heightMap.flattenTerrain(ij.getX(), ij.getY(), self.brushRadius)
+
+    def addSpringAhead(self):
+        if self.overview == False:
+            ij = self.getCellAhead()
+            self.waterSimulation.addSource(ij.getX(), ij.getY(), self.springRate)
+            self.waterFlowEnabled = True
+
     def turnLeft(self):
         if self.overview == False:
             self.avatarControler.triggerTurnLeft()
@@ -232,23 +551,184 @@ class LightworldBasic(ShowBase):
         if self.overview == False:
             self.avatarControler.triggerTurnRight()
 
-    def move(self, task):       
+    # Camera between the last two simulated avatar states
+    def updateFirstPersonCamera(self, alpha):
+        avatarPos = self.prevAvatarPos + (self.avatarControler.curPos - self.prevAvatarPos) * alpha
+        camPos = self.prevCamPos + (self.avatarControler.curCamPos - self.prevCamPos) * alpha
+        self.camera.setPos(self.getCameraPos(avatarPos, camPos))
+        self.camera.lookAt(avatarPos)
+        u, v = self.minimap.getUVFromXY(avatarPos.getX(), avatarPos.getY())
+        self.minimapAvatar.setPos(0.5 * u - 0.25, 0, 0.5 * v - 0.25)
+        self.updateFog()
+
+    # Sea fog under water, the distance fog over a limited view, none
+    # otherwise or in the overview
+    def updateFog(self):
+        fog = None
+        far = self.defaultFar
+        if self.overview == False:
+            if(self.camera.getPos().getZ() < -0.25):
+                fog = self.linfog
+            elif self.viewDistance is not None:
+                fog = self.distanceFog
+            if self.viewDistance is not None:
+                far = self.viewDistance
+        if(far != self.camLens.getFar()):
+            self.camLens.setFar(far)
+        if fog is self.activeFog:
+            return
+        if fog is None:
+            render.clearFog()
+        else:
+            render.setFog(fog)
+        self.setBackgroundColor(*(self.seaBackgroundColor if fog is self.linfog else self.skyBackgroundColor))
+        self.activeFog = fog
+
+    # Gameplay keys are queued and handled at the next simulation step
+    def acceptInput(self, event, handler):
+        self.inputHandlers[event] = handler
+        self.accept(event, self.queueInput, [event])
+
+    def queueInput(self, event):
+        if self.inputReplay is None:
+            self.pendingInput.append(event)
+
+    def simulate(self, task):
+        self.simulationClock.advance(globalClock.getDt(), self.simulationStep)
+        if self.waterFlowEnabled:
+            changedChunks = self.waterSimulation.popChangedChunks(self.chunkGrid)
+            if changedChunks:
+                self.remeshScheduler.addDirtyWaterChunks(changedChunks)
+                for chunk in changedChunks:
+                    self.unsavedChunks.add((chunk.ci, chunk.cj))
+                self.minimap.updateChunks(changedChunks, self.chunkGrid.kHeights)
+                self.overviewProxyDirty = True
+        if self.overview == False:
+            self.updateFirstPersonCamera(self.simulationClock.alpha)
+        if self.inputReplay is not None:
+            self.frameTimes.append(globalClock.getDt())
+            if self.inputReplay.isFinished(self.simulationClock.tick):
+                self.finishReplay()
+        return task.cont
+
+    def simulationStep(self):
+        tick = self.simulationClock.tick
+        if self.inputReplay is not None:
+            events = self.inputReplay.popEvents(tick)
+        else:
+            events = self.pendingInput
+            self.pendingInput = []
+        for event in events:
+            if self.inputRecorder is not None:
+                self.inputRecorder.record(tick, event)
+            self.inputHandlers[event]()
+        self.refreshEditedTerrain()
+
+        self.prevAvatarPos = LVector3(self.avatarControler.curPos)
+        self.prevCamPos = LVector3(self.avatarControler.curCamPos)
+        distance = self.avatarSpeed * self.simulationClock.stepTime
         if(self.avatarControler.moving == True):
-            self.avatarControler.moveByDistance(0.15)
-            self.camera.setPos(self.avatarControler.curCamPos)
-            self.camera.lookAt(self.avatarControler.curPos)
+            self.avatarControler.moveByDistance(distance)
         elif(self.avatarControler.turning == True):
-            self.avatarControler.turnByDistance(0.15)
-            self.camera.setPos(self.avatarControler.curCamPos)
-            self.camera.lookAt(self.avatarControler.curPos)
-        if(self.overview == False):
-            if(not render.hasFog() and self.camera.getPos().getZ() < -0.25):
-                render.setFog(self.linfog)
-                self.setBackgroundColor(*self.seaBackgroundColor)
-            elif(render.hasFog() and self.camera.getPos().getZ() > -0.25):
-                render.clearFog()
-                self.setBackgroundColor(*self.skyBackgroundColor)
+            self.avatarControler.turnByDistance(distance)
+        if self.waterFlowEnabled:
+            self.waterSimulation.advance(self.simulationClock.stepTime)
+
+    # End of a replay: write the benchmark results and leave
+    def finishReplay(self):
+        if self.options.benchmark is None:
+            self.inputReplay = None
+            return
+        frameTimes = sorted(self.frameTimes[1:]) or [0.0]
+        results = {
+            "replay": self.options.replay,
+            "ticks": self.simulationClock.tick,
+            "frames": len(self.frameTimes),
+            "meanFrameTime": sum(frameTimes) / len(frameTimes),
+            "p50FrameTime": frameTimes[len(frameTimes) // 2],
+            "p95FrameTime": frameTimes[min(int(len(frameTimes) * 0.95), len(frameTimes) - 1)],
+            "maxFrameTime": frameTimes[-1],
+            "chunksRemeshed": self.remeshScheduler.numRemeshed,
+        }
+        with open(self.options.benchmark, 'w') as f:
+            json.dump(results, f, indent=2)
+        self.quit()
+
+    def quit(self):
+        if self.inputRecorder is not None:
+            self.inputRecorder.close(self.simulationClock.tick)
+            self.inputRecorder = None
+        if self.qualityGovernor is not None:
+            self.qualityGovernor.close()
+        sys.exit()
+
+    def toggleWaterFlow(self):
+        self.waterFlowEnabled = not self.waterFlowEnabled
+
+    # Terrain edits reach the water and the collider in the step that made
+    # them, the chunks are remeshed by the next frame
+    def refreshEditedTerrain(self):
+        dirtyRects = self.terrainMesher.heightMap.popDirtyRects()
+        if not dirtyRects:
+            return
+        for rect in dirtyRects:
+            self.waterSimulation.refreshTerrain(rect)
+        self.terrainCollider.refresh()
+        self.editedRects.extend(dirtyRects)
+
+    def remeshChunks(self, task):
+        dirtyRects = self.editedRects
+        self.editedRects = []
+        if dirtyRects:
+            for chunk in self.remeshScheduler.addDirtyRects(dirtyRects):
+                self.unsavedChunks.add((chunk.ci, chunk.cj))
+            for rect in dirtyRects:
+                self.minimap.update(rect, self.chunkGrid.kHeights)
+            self.overviewProxyDirty = True
+        if self.overview and self.overviewProxyDirty:
+            self.updateOverviewNodes()
+        self.remeshScheduler.update()
+        return task.cont
+
+    # Parameters in degrading order: remeshing spread over more frames
+    # first, then a shorter view distance. The view distance starts at its
+    # maximum, which limits the view of maps over 256 cells.
+    def makeQualityGovernor(self, targetFrameTime):
+        logPath = ConfigVariableString("lightworld-quality-log", "").getValue() or None
+        governor = QualityGovernor(targetFrameTime, logPath=logPath)
+        governor.addParameter(QualityParameter("remeshBudget", self.remeshBudget, 0.001, 0.008, 0.001, self.setRemeshBudget))
+        governor.addParameter(QualityParameter("viewDistance", 512.0, 64.0, 512.0, 64.0, self.setViewDistance))
+        # e.g. "viewDistance 128 384 terrainSize 32 256"
+        governor.parseBounds(ConfigVariableString("lightworld-quality-bounds", "").getValue())
+        return governor
+
+    def governQuality(self, task):
+        self.qualityGovernor.addFrame(globalClock.getDt())
+        return task.cont
+
+    def setViewDistance(self, distance):
+        self.viewDistance = distance
+        self.distanceFog.setLinearRange(0.6 * distance, distance)
+        self.updateFog()
+
+    def setRemeshBudget(self, seconds):
+        self.remeshBudget = seconds
+        if self.remeshScheduler is not None:
+            self.remeshScheduler.frameBudget = seconds
+
+    def toggleOcclusionCulling(self):
+        self.chunkCuller.useOcclusion = not self.chunkCuller.useOcclusion
+
+    def cullChunks(self, task):
+        # Sea fog hides everything beyond its far distance, the frustum ends
+        # at the view distance
+        cullDistance = self.fogDistance if self.activeFog is self.linfog else None
+        self.chunkCuller.update(self.camera, self.camLens, cullDistance)
+        for batcher in self.chunkBatchers:
+            batcher.update()
+        self.stat[2].setText(self.visibleChunksMsg.format(
+            self.chunkCuller.numVisible, len(self.chunkGrid.chunks), self.chunkCuller.numVertsVisible))
         return task.cont
 
-demo = LightworldBasic()
+demo = LightworldBasic(parseArguments())
 demo.run()
@@ -0,0 +1,168 @@
+import sys
+import numpy as np
+
+from meshing import Mesh
+
+###############################################################################
+# Memory usage broken down by subsystem, in bytes
+class MemoryReport:
+
+    def __init__(self):
+        self.usage = {}
+
+    def add(self, subsystem, numBytes):
+        self.usage[subsystem] = self.usage.get(subsystem, 0) + int(numBytes)
+
+    def getTotal(self):
+        return sum(self.usage.values())
+
+    # One "subsystem: size" line per subsystem, largest first
+    def formatLines(self):
+        lines = []
+        for subsystem, numBytes in sorted(self.usage.items(), key=lambda item: -item[1]):
+            lines.append("{0}: {1:.1f} MB".format(subsystem, numBytes / (1024 * 1024)))
+        return lines
+
+###############################################################################
+# Measured usage of the live world structures (CPU side copies only, the
+# GPU buffers of the geoms mirror the mesh sizes)
+class MemoryAccounting:
+
+    # Heights outside of it are int objects of their own, inside they are
+    # shared by the interpreter
+    SmallIntMin = -5
+    SmallIntMax = 256
+
+    # Lists of the height and water maps, the height ints outside of the
+    # small int cache (counted as one object per cell, an upper bound) and
+    # the water level array. The water map only points to True and False.
+    def getRegionMapBytes(terrainRegionMap, kHeights=None):
+        trm = terrainRegionMap
+        numBytes = trm.waterLevelMap.nbytes
+        for rows in (trm.heightMap, trm.waterMap):
+            numBytes += sys.getsizeof(rows) + sum(sys.getsizeof(row) for row in rows)
+        if kHeights is None:
+            kHeights = trm.getKHeightArray()
+        numLarge = np.count_nonzero((kHeights < MemoryAccounting.SmallIntMin) | (kHeights > MemoryAccounting.SmallIntMax))
+        numBytes += numLarge * sys.getsizeof(MemoryAccounting.SmallIntMax + 1)
+        return numBytes
+
+    def getGeomBytes(geom):
+        vdata = geom.getVertexData()
+        numBytes = sum(vdata.getArray(a).getDataSizeBytes() for a in range(vdata.getNumArrays()))
+        for p in range(geom.getNumPrimitives()):
+            primitive = geom.getPrimitive(p)
+            if primitive.isIndexed():
+                numBytes += primitive.getVertices().getDataSizeBytes()
+        return numBytes
+
+    def getNodeBytes(node):
+        if node.isEmpty():
+            return 0
+        geomNode = node.node()
+        return sum(MemoryAccounting.getGeomBytes(geomNode.getGeom(g)) for g in range(geomNode.getNumGeoms()))
+
+    # Flattened copies of the batched chunks, the chunk nodes are counted
+    # with the meshes
+    def getBatchBytes(chunkBatchers):
+        numBytes = 0
+        for batcher in chunkBatchers:
+            for batch in batcher.batches:
+                if(batch.node is None or batch.node.isEmpty()):
+                    continue
+                for node in batch.node.findAllMatches('**/+GeomNode'):
+                    numBytes += MemoryAccounting.getNodeBytes(node)
+        return numBytes
+
+    # Numpy arrays held by an object, directly or in a dict attribute
+    def getArrayBytes(obj):
+        numBytes = 0
+        for value in vars(obj).values():
+            if isinstance(value, np.ndarray):
+                numBytes += value.nbytes
+            elif isinstance(value, dict):
+                numBytes += sum(v.nbytes for v in value.values() if isinstance(v, np.ndarray))
+        return numBytes
+
+    def getLightCacheBytes(chunkGrid):
+        numBytes = 0
+        for chunk in chunkGrid.chunks:
+            if chunk.bakedLight is not None:
+                numBytes += len(chunk.bakedLight[0]) + chunk.bakedLight[1].nbytes
+        return numBytes
+
+    # Report over the region map and the optional world subsystems
+    def measureWorld(terrainRegionMap, chunkGrid=None, waterSimulation=None, terrainCollider=None, chunkBatchers=()):
+        report = MemoryReport()
+        kHeights = chunkGrid.kHeights if chunkGrid is not None else None
+        report.add("Terrain map", MemoryAccounting.getRegionMapBytes(terrainRegionMap, kHeights))
+        if chunkGrid is not None:
+            report.add("Terrain meshes", sum(MemoryAccounting.getNodeBytes(c.terrainNode) for c in chunkGrid.chunks))
+            report.add("Water meshes", sum(MemoryAccounting.getNodeBytes(c.waterNode) for c in chunkGrid.chunks))
+            report.add("Light cache", MemoryAccounting.getLightCacheBytes(chunkGrid))
+            report.add("Chunk grid", chunkGrid.kHeights.nbytes)
+        if chunkBatchers:
+            report.add("Batched meshes", MemoryAccounting.getBatchBytes(chunkBatchers))
+        if waterSimulation is not None:
+            report.add("Water simulation", MemoryAccounting.getArrayBytes(waterSimulation))
+        if terrainCollider is not None:
+            report.add("Collision", MemoryAccounting.getArrayBytes(terrainCollider))
+        return report
+
+###############################################################################
+# Budget checked before creating a world of a given size
+#
+# Estimates are per cell upper bounds measured on generated terrain: cells
+# mesh to about 40 vertices and 58 indices, water cells to 4 vertices and 6
+# indices.
+class MemoryBudget:
+
+    TerrainVertsPerCell = 42
+    TerrainIndicesPerCell = 62
+    WaterVertsPerCell = 4
+    WaterIndicesPerCell = 6
+    # Height and water map pointers, water level and a height int outside
+    # of the small int cache
+    RegionMapBytesPerCell = 8 + 8 + 4 + 28
+    # Noise image, float field, erosion buffers at half resolution and
+    # quantized heights while generating
+    GenerationBytesPerCell = 32
+    # Water depth, levels and flags
+    WaterSimulationBytesPerCell = 4 * 4 + 2
+    # Heights, rise per heading and cell tops
+    CollisionBytesPerCell = 4 + 4 + 8 * 4 + 4
+
+    def __init__(self, limitBytes, compactVertices=False, batchedMeshes=False):
+        self.limitBytes = limitBytes
+        self.compactVertices = compactVertices
+        # Flattened copies of the chunk meshes, see TerrainChunkBatcher
+        self.batchedMeshes = batchedMeshes
+
+    def estimate(self, size, chunkSize=16, lightRadius=6):
+        numCells = size * size
+        vertexBytes = Mesh(self.compactVertices).format.getArray(0).getStride()
+        chunkCells = min(chunkSize, size) ** 2
+        # Chunks are meshed separately, their indices fit in 16 bits
+        indexBytes = 2 if chunkCells * MemoryBudget.TerrainVertsPerCell <= 0xffff else 4
+        numChunks = ((size + chunkSize - 1) // chunkSize) ** 2
+        lightReach = chunkSize + 2 * (lightRadius + 2)
+
+        report = MemoryReport()
+        report.add("Terrain map", numCells * MemoryBudget.RegionMapBytesPerCell)
+        report.add("Generation", numCells * MemoryBudget.GenerationBytesPerCell)
+        report.add("Terrain meshes", numCells * (MemoryBudget.TerrainVertsPerCell * vertexBytes +
+                                                 MemoryBudget.TerrainIndicesPerCell * indexBytes))
+        report.add("Water meshes", numCells * (MemoryBudget.WaterVertsPerCell * vertexBytes +
+                                               MemoryBudget.WaterIndicesPerCell * indexBytes))
+        if self.batchedMeshes:
+            # Batches merge several chunks, over 16 bit indices
+            report.add("Batched meshes", numCells * ((MemoryBudget.TerrainVertsPerCell + MemoryBudget.WaterVertsPerCell) * vertexBytes +
+                                                     (MemoryBudget.TerrainIndicesPerCell + MemoryBudget.WaterIndicesPerCell) * 4))
+        report.add("Light cache", numChunks * 4 * (lightReach * lightReach + (chunkSize + 2) ** 2))
+        report.add("Chunk grid", numCells * 4)
+        report.add("Water simulation", numCells * MemoryBudget.WaterSimulationBytesPerCell)
+        report.add("Collision", numCells * MemoryBudget.CollisionBytesPerCell)
+        return report
+
+    def fits(self, size, chunkSize=16):
+        return self.estimate(size, chunkSize).getTotal() <= self.limitBytes
@@ -1,8 +1,44 @@
 from panda3d.core import GeomVertexFormat, GeomVertexData
-from panda3d.core import Geom, GeomTriangles, GeomVertexWriter
+from panda3d.core import Geom, GeomTriangles, GeomVertexWriter, GeomEnums
 from panda3d.core import LVector3f, LVector3i, LVector2f, LVector2i, LVector4f
+from panda3d.core import GeomVertexArrayFormat, InternalName
+from panda3d.core import RenderState, TexMatrixAttrib, RescaleNormalAttrib, TextureStage, TransformState
 
+from array import array
+import json
 import math
+import numpy as np
+
+###############################################################################
+# Vertex data access as numpy arrays, through the buffer of the first array
+#
+# Returns a (numRows, numComponents) view of the column, writable when the
+# vertex data was obtained with modifyVertexData()
+def getVertexColumnArray(vdata, name):
+    arrayFormat = vdata.getFormat().getArray(0)
+    column = arrayFormat.getColumn(name)
+    stride = arrayFormat.getStride()
+    numRows = vdata.getNumRows()
+    raw = np.frombuffer(memoryview(vdata.modifyArray(0)).cast('B'), dtype=np.uint8)
+    raw = raw.reshape(numRows, stride)
+    start = column.getStart()
+    numericType = column.getNumericType()
+    if(numericType == GeomEnums.NT_packed_dabc):
+        # b, g, r, a bytes
+        return raw[:, start:start+4]
+    dtype = ColumnDTypes[numericType]
+    size = dtype().itemsize * column.getNumComponents()
+    return raw[:, start:start+size].view(dtype)
+
+ColumnDTypes = {
+    GeomEnums.NT_float32: np.float32,
+    GeomEnums.NT_int8: np.int8,
+    GeomEnums.NT_uint8: np.uint8,
+    GeomEnums.NT_int16: np.int16,
+    GeomEnums.NT_uint16: np.uint16,
+    GeomEnums.NT_int32: np.int32,
+    GeomEnums.NT_uint32: np.uint32,
+}
 
 #########################################################################################
 # Class abstracting uv mapping in textures
@@ -21,12 +57,25 @@ import math
 
 class TextureUVMap:
     
-    def __init__(self, size):
+    # size x size squares, margin as a fraction of the square
+    def __init__(self, size, margin=0.1):
         self.offset = 1 / size
-        self.margin = self.offset * 0.1
+        self.margin = self.offset * margin
         self.scale = self.offset - 2 * self.margin
         self.materialOffset = {}
 
+    # From a {"gridSize", "margin", "materials": {name: [i, j]}} table, as
+    # written by TextureAtlasBuilder
+    def fromTable(table):
+        uvMap = TextureUVMap(table["gridSize"], table["margin"])
+        for name, (i, j) in table["materials"].items():
+            uvMap.addMaterial(name, i, j)
+        return uvMap
+
+    def loadTable(path):
+        with open(path, 'r') as f:
+            return TextureUVMap.fromTable(json.load(f))
+
     def addMaterial(self, name, i, j):
         self.materialOffset[name] = LVector2f(i*self.offset + self.margin, j*self.offset + self.margin)
     
@@ -38,40 +87,264 @@ class TextureUVMap:
 
 ###############################################################################
 # Container for Mesh Data (terrain, water, etc...)
+#
+# Faces are collected in a FaceBuffer and written to the vertex data in one
+# go by makeGeom.
+#
+# The compact format takes 24 bytes per vertex instead of 36:
+#   - float32 position
+#   - int8 normal scaled by 127, normalized again when lit
+#   - packed color bytes, as in the default format
+#   - uint16 texture coordinates scaled by 65535, scaled back by a texture
+#     matrix
+# Geoms of the compact format must be added with the state of getGeomState.
 class Mesh:
+    NormalScale = 127.0
+    TexCoordScale = 65535.0
+    CompactFormat = None
+
+    def __init__(self, compact=False, usageHint=Geom.UHDynamic):
+        self.format = Mesh.getCompactFormat() if compact else GeomVertexFormat.getV3n3cpt2()
+        self.usageHint = usageHint
+        self.faces = FaceBuffer()
+
+    def getCompactFormat():
+        if Mesh.CompactFormat is None:
+            arrayFormat = GeomVertexArrayFormat()
+            arrayFormat.addColumn(InternalName.getVertex(), 3, GeomEnums.NT_float32, GeomEnums.C_point)
+            arrayFormat.addColumn(InternalName.getColor(), 1, GeomEnums.NT_packed_dabc, GeomEnums.C_color)
+            arrayFormat.addColumn(InternalName.getTexcoord(), 2, GeomEnums.NT_uint16, GeomEnums.C_texcoord)
+            arrayFormat.addColumn(InternalName.getNormal(), 3, GeomEnums.NT_int8, GeomEnums.C_normal)
+            # Unused, rows must fill the stride to be seen as a buffer
+            arrayFormat.addColumn(InternalName.make('padding'), 1, GeomEnums.NT_uint8, GeomEnums.C_other, 23, 1)
+            Mesh.CompactFormat = GeomVertexFormat.registerFormat(GeomVertexFormat(arrayFormat))
+        return Mesh.CompactFormat
+
+    # State decoding the vertex columns of the geom, empty unless compact
+    def getGeomState(geom):
+        if(geom.getVertexData().getFormat() != Mesh.getCompactFormat()):
+            return RenderState.makeEmpty()
+        return RenderState.make(
+            TexMatrixAttrib.make(TextureStage.getDefault(), TransformState.makeScale2d(1.0 / Mesh.TexCoordScale)),
+            RescaleNormalAttrib.make(RescaleNormalAttrib.M_normalize))
+
+    @property
+    def numVerts(self):
+        return self.faces.numVerts
+
+    def addFace(self, textureUVMap, face):
+        self.faces.addCellFace(textureUVMap, face)
+
+    def makeGeom(self):
+        faces = self.faces
+        vdata = GeomVertexData('terrain', self.format, self.usageHint)
+        tris = GeomTriangles(self.usageHint)
+        if faces.numVerts > 0:
+            # Presized, the columns are written in place
+            vdata.uncleanSetNumRows(faces.numVerts)
+            getVertexColumnArray(vdata, 'vertex')[:] = np.frombuffer(faces.verts, dtype=np.float32).reshape(-1, 3)
+            normals = np.frombuffer(faces.normals, dtype=np.float32).reshape(-1, 3)
+            texCoords = np.frombuffer(faces.texCoords, dtype=np.float32).reshape(-1, 2)
+            normalColumn = getVertexColumnArray(vdata, 'normal')
+            texCoordColumn = getVertexColumnArray(vdata, 'texcoord')
+            if(normalColumn.dtype == np.float32):
+                normalColumn[:] = normals
+                texCoordColumn[:] = texCoords
+            else:
+                normalColumn[:] = np.rint(normals * Mesh.NormalScale)
+                texCoordColumn[:] = np.rint(np.clip(texCoords, 0.0, 1.0) * Mesh.TexCoordScale)
+            colors = np.frombuffer(faces.colors, dtype=np.float32).reshape(-1, 4)
+            colorColumn = getVertexColumnArray(vdata, 'color')
+            if(colorColumn.dtype == np.float32):
+                colorColumn[:] = colors
+            else:
+                # packed_dabc: b, g, r, a bytes
+                colorColumn[:] = np.rint(np.clip(colors[:, [2, 1, 0, 3]], 0.0, 1.0) * 255.0).astype(np.uint8)
+
+            if faces.numVerts > 0xffff:
+                tris.setIndexType(GeomEnums.NT_uint32)
+                indexType = np.uint32
+            else:
+                indexType = np.uint16
+            indexArray = tris.modifyVertices()
+            indexArray.uncleanSetNumRows(len(faces.indices))
+            indexView = np.frombuffer(memoryview(indexArray).cast('B'), dtype=indexType)
+            indexView[:] = np.frombuffer(faces.indices, dtype=np.int32)
+        geom = Geom(vdata)
+        geom.addPrimitive(tris)
+        return geom
+
+###############################################################################
+# Struct of arrays storage of mesh faces
+#
+# Vertex attributes are kept in flat float arrays and triangles as vertex
+# indices, so that meshing creates no Python object per face or vertex. The
+# add methods build the same faces as the CellFace constructors of the same
+# name, texture coordinates are relative to the material square until
+# setFaceMaterial maps them in the texture.
+class FaceBuffer:
+    __slots__ = ("verts", "normals", "colors", "texCoords", "indices", "faceStarts", "numVerts")
+
     def __init__(self):
-        self.format = GeomVertexFormat.getV3n3cpt2()
-        self.vdata = GeomVertexData('terrain', self.format, Geom.UHDynamic)
-        self.vertex = GeomVertexWriter(self.vdata, 'vertex')
-        self.texcoord = GeomVertexWriter(self.vdata, 'texcoord')
-        self.color = GeomVertexWriter(self.vdata, 'color')
-        self.tris = GeomTriangles(Geom.UHDynamic)  
-        self.normal = GeomVertexWriter(self.vdata, 'normal')
+        self.clear()
+
+    def clear(self):
+        self.verts = array('f')       # x, y, z per vertex
+        self.normals = array('f')     # x, y, z per vertex
+        self.colors = array('f')      # r, g, b, a per vertex
+        self.texCoords = array('f')   # u, v per vertex
+        self.indices = array('i')     # three vertices per triangle
+        self.faceStarts = array('i')  # first vertex of each face
         self.numVerts = 0
 
-    def addFace(self, textureUVMap, face):
-        n = face.normal
-        c = face.color
+    @property
+    def numFaces(self):
+        return len(self.faceStarts)
+
+    def __getFaceRange(self, f):
+        end = self.faceStarts[f+1] if f + 1 < len(self.faceStarts) else self.numVerts
+        return self.faceStarts[f], end
+
+    # Close a face of n vertices just appended to verts and texCoords: fan
+    # triangles, normal to the first three vertices and white color
+    def __endFace(self, n):
+        v = self.verts
+        b = 3 * self.numVerts
+        ax = v[b+3] - v[b]
+        ay = v[b+4] - v[b+1]
+        az = v[b+5] - v[b+2]
+        bx = v[b+6] - v[b+3]
+        by = v[b+7] - v[b+4]
+        bz = v[b+8] - v[b+5]
+        nx = ay * bz - az * by
+        ny = az * bx - ax * bz
+        nz = ax * by - ay * bx
+        length = math.sqrt(nx * nx + ny * ny + nz * nz)
+        if length > 0.0:
+            nx /= length
+            ny /= length
+            nz /= length
+        self.normals.extend((nx, ny, nz) * n)
+        self.colors.extend((1.0, 1.0, 1.0, 1.0) * n)
+        first = self.numVerts
+        for k in range(1, n - 1):
+            self.indices.extend((first, first + k, first + k + 1))
+        self.faceStarts.append(first)
+        self.numVerts += n
+
+    def addSquareFace(self, center, normal, up, sideRadius, upRadius, refTexRadius):
+        cx, cy, cz = center
+        nx, ny, nz = normal
+        ux, uy, uz = up
+        # side = up x normal
+        sx = (uy * nz - uz * ny) * sideRadius
+        sy = (uz * nx - ux * nz) * sideRadius
+        sz = (ux * ny - uy * nx) * sideRadius
+        ux *= upRadius
+        uy *= upRadius
+        uz *= upRadius
+        self.verts.extend((
+            cx - sx - ux, cy - sy - uy, cz - sz - uz,
+            cx + sx - ux, cy + sy - uy, cz + sz - uz,
+            cx + sx + ux, cy + sy + uy, cz + sz + uz,
+            cx - sx + ux, cy - sy + uy, cz - sz + uz))
+        ratioSide = sideRadius / refTexRadius
+        ratioUp = upRadius / refTexRadius
+        self.texCoords.extend((0.0, 0.0, ratioSide, 0.0, ratioSide, ratioUp, 0.0, ratioUp))
+        self.__endFace(4)
+
+    def addTriangle(self, v0, v1, v2, refTexRadius):
+        ratio = math.dist(v1, v0) / math.sqrt(2.0) / refTexRadius
+        self.verts.extend(v0)
+        self.verts.extend(v1)
+        self.verts.extend(v2)
+        self.texCoords.extend((0.0, 0.0, ratio, 0.0, ratio, ratio))
+        self.__endFace(3)
+
+    def addNonPlanarSquare(self, v0, v1, v2, v3, refTexRadius):
+        ratio = math.dist(v1, v0) / math.sqrt(2.0) / refTexRadius
+        self.verts.extend(v0)
+        self.verts.extend(v1)
+        self.verts.extend(v2)
+        self.texCoords.extend((0.0, 0.0, ratio, 0.0, ratio, ratio))
+        self.__endFace(3)
+        self.verts.extend(v0)
+        self.verts.extend(v2)
+        self.verts.extend(v3)
+        self.texCoords.extend((0.0, 0.0, ratio, ratio, 0.0, ratio))
+        self.__endFace(3)
+
+    # Append faces given as numpy arrays, with indices and face starts
+    # relative to the appended vertices
+    def extendArrays(self, verts, normals, colors, texCoords, indices, faceStarts):
+        first = self.numVerts
+        self.verts.frombytes(np.ascontiguousarray(verts, dtype=np.float32).tobytes())
+        self.normals.frombytes(np.ascontiguousarray(normals, dtype=np.float32).tobytes())
+        self.colors.frombytes(np.ascontiguousarray(colors, dtype=np.float32).tobytes())
+        self.texCoords.frombytes(np.ascontiguousarray(texCoords, dtype=np.float32).tobytes())
+        self.indices.frombytes((np.asarray(indices) + first).astype(np.int32).tobytes())
+        self.faceStarts.frombytes((np.asarray(faceStarts) + first).astype(np.int32).tobytes())
+        self.numVerts += len(verts)
+
+    # Copy of a face, its texture coordinates mapped with its material
+    def addCellFace(self, textureUVMap, face):
+        first = self.numVerts
+        n = len(face.verts)
         for v in face.verts:
-            self.vertex.add_data3(v.getX(), v.getY(), v.getZ())
-            self.normal.addData3(n.getX(), n.getY(), n.getZ())
-            self.color.addData4f(c.getX(), c.getY(), c.getZ(), c.getW())
+            self.verts.extend((v.getX(), v.getY(), v.getZ()))
         for tc in face.texCoords:
-            schemeTC = textureUVMap.getUVFromXY(face.texMat, tc.getX(), tc.getY())
-            self.texcoord.addData2f(schemeTC.getX(), schemeTC.getY())               
-        mv = self.numVerts
+            self.texCoords.extend((tc.getX(), tc.getY()))
+        self.normals.extend((face.normal.getX(), face.normal.getY(), face.normal.getZ()) * n)
+        self.colors.extend((face.color.getX(), face.color.getY(), face.color.getZ(), face.color.getW()) * n)
         for t in face.triangles:
-            self.tris.addVertices(mv+t.getX(), mv+t.getY(), mv+t.getZ())
-        self.numVerts += len(face.verts)
+            self.indices.extend((first + t.getX(), first + t.getY(), first + t.getZ()))
+        self.faceStarts.append(first)
+        self.numVerts += n
+        self.setFaceMaterial(self.numFaces - 1, textureUVMap, face.texMat)
 
-    def makeGeom(self):
-        geom = Geom(self.vdata)
-        geom.addPrimitive(self.tris)
-        return geom
+    def getFaceCentroidZ(self, f):
+        start, end = self.__getFaceRange(f)
+        return sum(self.verts[3*start+2:3*end:3]) / (end - start)
+
+    def getFaceNormal(self, f):
+        start = self.faceStarts[f]
+        return LVector3f(self.normals[3*start], self.normals[3*start+1], self.normals[3*start+2])
+
+    def setFaceColor(self, f, r, g, b, a):
+        start, end = self.__getFaceRange(f)
+        self.colors[4*start:4*end] = array('f', (r, g, b, a) * (end - start))
+
+    # Map the texture coordinates of the face into the square of the material
+    def setFaceMaterial(self, f, textureUVMap, name):
+        start, end = self.__getFaceRange(f)
+        offset = textureUVMap.materialOffset[name]
+        ox = offset.getX()
+        oy = offset.getY()
+        scale = textureUVMap.scale
+        tc = self.texCoords
+        for k in range(2*start, 2*end, 2):
+            tc[k] = ox + tc[k] * scale
+            tc[k+1] = oy + tc[k+1] * scale
+
+    # Faces as CellFace objects, with unmapped texture coordinates
+    def toCellFaces(self):
+        fList = []
+        for f in range(self.numFaces):
+            start, end = self.__getFaceRange(f)
+            face = CellFace()
+            face.verts = [LVector3f(*self.verts[3*k:3*k+3]) for k in range(start, end)]
+            face.texCoords = [LVector2f(*self.texCoords[2*k:2*k+2]) for k in range(start, end)]
+            face.normal = LVector3f(*self.normals[3*start:3*start+3])
+            face.color = LVector4f(*self.colors[4*start:4*start+4])
+            face.fanTriangles()
+            fList.append(face)
+        return fList
 
 ###############################################################################
 # Cell face class
 class CellFace:
+    __slots__ = ("verts", "texCoords", "texMat", "normal", "triangles", "color")
+
     def __init__(self):
         self.verts = []
         self.texCoords = []
@@ -0,0 +1,220 @@
+import json
+
+###############################################################################
+# One quality knob, kept within [minValue, maxValue]
+#
+# Lower values are cheaper: degrading subtracts step, upgrading adds it
+# back. apply is called with each new value.
+class QualityParameter:
+
+    def __init__(self, name, value, minValue, maxValue, step, apply):
+        self.name = name
+        self.minValue = minValue
+        self.maxValue = maxValue
+        self.step = step
+        self.apply = apply
+        self.value = self.clamp(value)
+
+    def clamp(self, value):
+        return min(max(value, self.minValue), self.maxValue)
+
+    def getDegraded(self):
+        return self.clamp(self.value - self.step)
+
+    def getUpgraded(self):
+        return self.clamp(self.value + self.step)
+
+    def set(self, value):
+        self.value = self.clamp(value)
+        self.apply(self.value)
+
+###############################################################################
+# Adjusts quality parameters to the measured frame time
+#
+# Frame times are collected over windows of windowFrames frames, the 90th
+# percentile of a window is compared to the target:
+#
+#   over target * (1 + margin)   degrade the first parameter, in priority
+#                                order, that can still be degraded
+#   under target * (1 - margin)  for upgradeWindows windows in a row,
+#                                upgrade the last parameter, in priority
+#                                order, that can still be upgraded
+#
+# An upgrade followed by a degrade of the same parameter doubles the windows
+# to wait before the next upgrade, up to maxWaitWindows, so that the governor
+# settles instead of oscillating around the target. The wait goes back to
+# upgradeWindows after stableWindows windows in a row without a degrade.
+#
+# Terrain regeneration times bound the terrain size separately: generation
+# and meshing grow with the cell count, the largest power of two size whose
+# predicted time fits regenerationBudget is allowed.
+#
+# Every change is a decision dict, kept in decisions and written as a JSON
+# line to logPath when given.
+class QualityGovernor:
+
+    def __init__(self, targetFrameTime, windowFrames=60, margin=0.15, upgradeWindows=3, logPath=None):
+        self.targetFrameTime = targetFrameTime
+        self.windowFrames = windowFrames
+        self.margin = margin
+        self.upgradeWindows = upgradeWindows
+        self.parameters = []
+        self.frameTimes = []
+        self.goodWindows = 0
+        self.waitWindows = upgradeWindows
+        self.maxWaitWindows = 8 * upgradeWindows
+        self.stableWindows = 2 * self.maxWaitWindows
+        # Windows since the last degrade
+        self.windowsSinceDegrade = 0
+        self.lastUpgraded = None
+
+        # Terrain size bound from regeneration times
+        self.regenerationBudget = 2.0
+        self.minTerrainSize = 16
+        self.maxTerrainSizeBound = 1024
+        self.maxTerrainSize = self.maxTerrainSizeBound
+
+        self.decisions = []
+        self.logFile = open(logPath, 'a') if logPath is not None else None
+        # Statistics of the last window
+        self.numFrames = 0
+        self.lastMeanFrameTime = 0.0
+        self.lastP90FrameTime = 0.0
+
+    # Parameters are degraded in the order they are added
+    def addParameter(self, parameter):
+        self.parameters.append(parameter)
+        parameter.apply(parameter.value)
+        return parameter
+
+    def getParameter(self, name):
+        for parameter in self.parameters:
+            if parameter.name == name:
+                return parameter
+        return None
+
+    # Bounds from "name min max" triples, e.g. a config variable value
+    def parseBounds(self, text):
+        words = text.split()
+        if(len(words) % 3 != 0):
+            raise ValueError("Quality bounds are name min max triples: {0}".format(text))
+        for k in range(0, len(words), 3):
+            name = words[k]
+            if(name == "terrainSize"):
+                self.minTerrainSize = int(words[k+1])
+                self.maxTerrainSizeBound = int(words[k+2])
+                self.maxTerrainSize = min(max(self.maxTerrainSize, self.minTerrainSize), self.maxTerrainSizeBound)
+                continue
+            parameter = self.getParameter(name)
+            if parameter is None:
+                raise ValueError("Unknown quality parameter: {0}".format(name))
+            parameter.minValue = float(words[k+1])
+            parameter.maxValue = float(words[k+2])
+            parameter.set(parameter.value)
+
+    # Frame of dt seconds, returns the decision taken at the end of a window
+    def addFrame(self, dt):
+        self.numFrames += 1
+        self.frameTimes.append(dt)
+        if(len(self.frameTimes) < self.windowFrames):
+            return None
+        frameTimes = sorted(self.frameTimes)
+        self.frameTimes = []
+        self.lastMeanFrameTime = sum(frameTimes) / len(frameTimes)
+        self.lastP90FrameTime = frameTimes[min(int(len(frameTimes) * 0.9), len(frameTimes) - 1)]
+
+        if(self.lastP90FrameTime > self.targetFrameTime * (1.0 + self.margin)):
+            self.goodWindows = 0
+            self.windowsSinceDegrade = 0
+            return self.__degrade()
+        self.windowsSinceDegrade += 1
+        if(self.windowsSinceDegrade >= self.stableWindows):
+            self.waitWindows = self.upgradeWindows
+        if(self.lastP90FrameTime < self.targetFrameTime * (1.0 - self.margin)):
+            self.goodWindows += 1
+            if(self.goodWindows >= self.waitWindows):
+                self.goodWindows = 0
+                return self.__upgrade()
+        else:
+            self.goodWindows = 0
+        return None
+
+    def __degrade(self):
+        for parameter in self.parameters:
+            value = parameter.getDegraded()
+            if(value != parameter.value):
+                if(parameter is self.lastUpgraded):
+                    self.waitWindows = min(self.waitWindows * 2, self.maxWaitWindows)
+                self.lastUpgraded = None
+                return self.__change(parameter, value, "frame time over target")
+        return None
+
+    def __upgrade(self):
+        for parameter in reversed(self.parameters):
+            value = parameter.getUpgraded()
+            if(value != parameter.value):
+                self.lastUpgraded = parameter
+                return self.__change(parameter, value, "frame time under target")
+        # Nothing left to upgrade, the machine has headroom
+        self.waitWindows = self.upgradeWindows
+        return None
+
+    def __change(self, parameter, value, reason):
+        decision = {
+            "frame": self.numFrames,
+            "parameter": parameter.name,
+            "from": parameter.value,
+            "to": value,
+            "reason": reason,
+            "meanFrameTime": self.lastMeanFrameTime,
+            "p90FrameTime": self.lastP90FrameTime,
+        }
+        parameter.set(value)
+        return self.__record(decision)
+
+    def __record(self, decision):
+        self.decisions.append(decision)
+        if self.logFile is not None:
+            self.logFile.write(json.dumps(decision) + "\n")
+            self.logFile.flush()
+        return decision
+
+    # A terrain of size cells per side took seconds to generate and mesh
+    def addRegeneration(self, size, seconds):
+        maxSize = self.minTerrainSize
+        # Time grows with the cell count
+        while(maxSize * 2 <= self.maxTerrainSizeBound and seconds * (maxSize * 2 / size) ** 2 <= self.regenerationBudget):
+            maxSize *= 2
+        if(maxSize == self.maxTerrainSize):
+            return None
+        decision = {
+            "frame": self.numFrames,
+            "parameter": "terrainSize",
+            "from": self.maxTerrainSize,
+            "to": maxSize,
+            "reason": "size {0} regenerated in {1:.2f} s".format(size, seconds),
+            "meanFrameTime": self.lastMeanFrameTime,
+            "p90FrameTime": self.lastP90FrameTime,
+        }
+        self.maxTerrainSize = maxSize
+        return self.__record(decision)
+
+    def allowsTerrainSize(self, size):
+        return size <= self.maxTerrainSize
+
+    def getStats(self):
+        return {
+            "targetFrameTime": self.targetFrameTime,
+            "frames": self.numFrames,
+            "meanFrameTime": self.lastMeanFrameTime,
+            "p90FrameTime": self.lastP90FrameTime,
+            "parameters": {parameter.name: parameter.value for parameter in self.parameters},
+            "maxTerrainSize": self.maxTerrainSize,
+            "decisions": len(self.decisions),
+            "upgradeWaitWindows": self.waitWindows,
+        }
+
+    def close(self):
+        if self.logFile is not None:
+            self.logFile.close()
+            self.logFile = None
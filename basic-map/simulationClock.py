@@ -0,0 +1,101 @@
+import json
+
+###############################################################################
+# Fixed timestep simulation clock
+#
+# Frames add their duration and the simulation runs as many whole steps as
+# fit, the remainder gives the interpolation factor between the last two
+# simulated states for display:
+#
+#   frames  |-----|---------|--|-------|
+#   steps   |   |   |   |   |   |   |  :
+#                                   ^--^ alpha = remainder / stepTime
+#
+# In lockstep mode every frame runs exactly one step, so that replays render
+# the same frames whatever the frame rate.
+class FixedTimestepClock:
+
+    def __init__(self, stepRate=60.0, maxStepsPerFrame=8):
+        self.stepRate = stepRate
+        self.stepTime = 1.0 / stepRate
+        # Limit catch-up after a long frame
+        self.maxStepsPerFrame = maxStepsPerFrame
+        self.lockstep = False
+        self.accumulator = 0.0
+        self.alpha = 1.0
+        self.tick = 0
+
+    # Run the steps due after a frame of dt seconds, stepFunction is called
+    # once per step before the tick count moves on. Returns the number of steps.
+    def advance(self, dt, stepFunction):
+        if self.lockstep:
+            numSteps = 1
+        else:
+            self.accumulator += dt
+            numSteps = min(int(self.accumulator / self.stepTime), self.maxStepsPerFrame)
+            self.accumulator -= numSteps * self.stepTime
+            if(numSteps == self.maxStepsPerFrame):
+                self.accumulator = min(self.accumulator, self.stepTime)
+        for step in range(numSteps):
+            stepFunction()
+            self.tick += 1
+        self.alpha = 1.0 if self.lockstep else self.accumulator / self.stepTime
+        return numSteps
+
+###############################################################################
+# Input recordings
+#
+# JSON lines: a header with what is needed to rebuild the initial world,
+# then one {"tick", "event"} line per input event in order, and an "end"
+# event at the tick the session stopped.
+class InputRecording:
+    Version = 1
+    EndEvent = "end"
+
+# Writes events as they happen, so that a crashed session keeps its inputs
+class InputRecorder:
+
+    def __init__(self, path, header):
+        self.file = open(path, 'w')
+        header = dict(header)
+        header["version"] = InputRecording.Version
+        self.file.write(json.dumps(header) + "\n")
+        self.file.flush()
+
+    def record(self, tick, event):
+        self.file.write(json.dumps({"tick": tick, "event": event}) + "\n")
+        self.file.flush()
+
+    def close(self, tick):
+        if self.file is None:
+            return
+        self.record(tick, InputRecording.EndEvent)
+        self.file.close()
+        self.file = None
+
+# Feeds the recorded events back at their ticks
+class InputReplay:
+
+    def __init__(self, path):
+        with open(path, 'r') as f:
+            lines = [line for line in f.read().splitlines() if line.strip()]
+        self.header = json.loads(lines[0])
+        if(self.header.get("version") != InputRecording.Version):
+            raise ValueError("Unsupported input recording: {0}".format(path))
+        self.events = [json.loads(line) for line in lines[1:]]
+        self.next = 0
+        # Recordings cut short end with their last event
+        self.endTick = self.events[-1]["tick"] if self.events else 0
+
+    # Events of the tick, in recorded order
+    def popEvents(self, tick):
+        events = []
+        while(self.next < len(self.events) and self.events[self.next]["tick"] <= tick):
+            event = self.events[self.next]["event"]
+            if event != InputRecording.EndEvent:
+                events.append(event)
+            self.next += 1
+        return events
+
+    def isFinished(self, tick):
+        return tick >= self.endTick and self.next >= len(self.events)
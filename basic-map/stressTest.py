@@ -0,0 +1,201 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import time
+import zlib
+
+from terrainMesh import TerrainMesher
+
+# Peak resident memory is only available on unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+###############################################################################
+# Generation and meshing stress test
+#
+# Every case (size, height, seed) runs TerrainMesher.generateTerrain then
+# meshTerrain and meshWater in a worker process. The whole matrix is run
+# once per worker count, giving the speedup over one worker:
+#
+#   speedup(n) = wall time(1 worker) / wall time(n workers)
+#
+# Seeds are explicit so that every worker count generates the same maps,
+# the height digests of the cases are compared across worker counts.
+#
+#   python stressTest.py --sizes 64 128 256 --seeds 1 2 3 --workers 1 2 4
+
+# One case in the current process, returns the measures as a dict
+def runStressCase(case):
+    size, height, seed = case
+    terrainMesher = TerrainMesher()
+
+    start = time.perf_counter()
+    terrainMesher.generateTerrain(size, height, seed)
+    generated = time.perf_counter()
+    terrainGeom = terrainMesher.meshTerrain()
+    terrainMeshed = time.perf_counter()
+    waterGeom = terrainMesher.meshWater()
+    waterMeshed = time.perf_counter()
+
+    totalTime = waterMeshed - start
+    return {
+        "size": size,
+        "height": height,
+        "seed": seed,
+        "pid": os.getpid(),
+        "generationTime": generated - start,
+        "terrainMeshTime": terrainMeshed - generated,
+        "waterMeshTime": waterMeshed - terrainMeshed,
+        "totalTime": totalTime,
+        "cellsPerSecond": size * size / totalTime if totalTime > 0.0 else 0.0,
+        "terrainVerts": getNumVerts(terrainGeom),
+        "terrainTriangles": getNumTriangles(terrainGeom),
+        "waterVerts": getNumVerts(waterGeom),
+        "waterTriangles": getNumTriangles(waterGeom),
+        "peakRSSMB": getPeakRSSMB(),
+        "heightDigest": zlib.crc32(terrainMesher.heightMap.getKHeightArray().tobytes()),
+    }
+
+def getNumVerts(geom):
+    return geom.getVertexData().getNumRows()
+
+def getNumTriangles(geom):
+    return sum(geom.getPrimitive(p).getNumPrimitives() for p in range(geom.getNumPrimitives()))
+
+# Peak of the worker so far, each case runs in a fresh worker so it is the peak of the case
+def getPeakRSSMB():
+    if resource is None:
+        return None
+    # Kilobytes on linux, bytes on macOS
+    scale = 1.0 if os.uname().sysname == "Darwin" else 1024.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / (1024 * 1024)
+
+###############################################################################
+# Runs the case matrix for each worker count
+class StressTest:
+
+    def __init__(self, sizes, heights, seeds, workerCounts, repeat=1):
+        self.cases = [(size, height, seed) for size in sizes for height in heights for seed in seeds] * repeat
+        # Largest cases first, so that a big one does not run alone at the end
+        self.cases.sort(key=lambda case: -case[0])
+        self.workerCounts = sorted(set(workerCounts))
+        # All runs, with the worker count they ran with
+        self.runs = []
+        # (workers, wall time) per worker count
+        self.wallTimes = []
+
+    def run(self):
+        self.runs = []
+        self.wallTimes = []
+        for numWorkers in self.workerCounts:
+            # One case per worker process, so that the peak memory of a case is its own
+            with multiprocessing.Pool(numWorkers, maxtasksperchild=1) as pool:
+                start = time.perf_counter()
+                results = pool.map(runStressCase, self.cases, chunksize=1)
+                wallTime = time.perf_counter() - start
+            for result in results:
+                result["workers"] = numWorkers
+                self.runs.append(result)
+            self.wallTimes.append((numWorkers, wallTime))
+        return self
+
+    # Same maps whatever the worker count
+    def isReproducible(self):
+        digests = {}
+        for result in self.runs:
+            key = (result["size"], result["height"], result["seed"])
+            digests.setdefault(key, set()).add(result["heightDigest"])
+        return all(len(values) == 1 for values in digests.values())
+
+    # Speedup and efficiency per worker count, relative to the fewest workers
+    def getScaling(self):
+        if not self.wallTimes:
+            return []
+        baseWorkers, baseTime = self.wallTimes[0]
+        numCells = sum(size * size for size, _, _ in self.cases)
+        scaling = []
+        for numWorkers, wallTime in self.wallTimes:
+            speedup = baseTime / wallTime if wallTime > 0.0 else 0.0
+            scaling.append({
+                "workers": numWorkers,
+                "wallTime": wallTime,
+                "speedup": speedup,
+                "efficiency": speedup * baseWorkers / numWorkers,
+                "cellsPerSecond": numCells / wallTime if wallTime > 0.0 else 0.0,
+            })
+        return scaling
+
+    # Per size scaling, from the summed run times of the size
+    def getScalingBySize(self):
+        bySize = {}
+        for result in self.runs:
+            bySize.setdefault(result["size"], []).append(result)
+        scaling = []
+        for size in sorted(bySize):
+            runs = bySize[size]
+            scaling.append({
+                "size": size,
+                "meanTotalTime": sum(r["totalTime"] for r in runs) / len(runs),
+                "meanGenerationTime": sum(r["generationTime"] for r in runs) / len(runs),
+                "meanMeshTime": sum(r["terrainMeshTime"] + r["waterMeshTime"] for r in runs) / len(runs),
+                "maxPeakRSSMB": max((r["peakRSSMB"] or 0.0) for r in runs),
+                "meanTerrainVerts": sum(r["terrainVerts"] for r in runs) / len(runs),
+            })
+        return scaling
+
+    def writeCSV(self, path):
+        if not self.runs:
+            return
+        fields = ["workers"] + [name for name in self.runs[0] if name != "workers"]
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(self.runs)
+
+    def writeJSON(self, path):
+        summary = {
+            "cpuCount": os.cpu_count(),
+            "cases": [list(case) for case in self.cases],
+            "reproducible": self.isReproducible(),
+            "scaling": self.getScaling(),
+            "sizes": self.getScalingBySize(),
+            "runs": self.runs,
+        }
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+# Powers of two up to the core count, and the core count itself
+def getDefaultWorkerCounts():
+    cpuCount = os.cpu_count() or 1
+    counts = []
+    n = 1
+    while n < cpuCount:
+        counts.append(n)
+        n *= 2
+    counts.append(cpuCount)
+    return counts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lightworld: generation and meshing stress test")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 128, 256])
+    parser.add_argument("--heights", type=int, nargs="+", default=[18])
+    parser.add_argument("--seeds", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument("--workers", type=int, nargs="+", default=getDefaultWorkerCounts())
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", default="stress", help="writes OUTPUT.csv and OUTPUT.json")
+    options = parser.parse_args()
+    if 0 in options.seeds:
+        parser.error("seed 0 picks a random seed, runs would not be reproducible")
+
+    stressTest = StressTest(options.sizes, options.heights, options.seeds, options.workers, options.repeat).run()
+    stressTest.writeCSV(options.output + ".csv")
+    stressTest.writeJSON(options.output + ".json")
+    for scaling in stressTest.getScaling():
+        print("{0} workers: {1:.2f} s, speedup {2:.2f}, efficiency {3:.0%}".format(
+            scaling["workers"], scaling["wallTime"], scaling["speedup"], scaling["efficiency"]))
+    if not stressTest.isReproducible():
+        print("Warning: height maps differ between worker counts")
@@ -0,0 +1,620 @@
+from panda3d.core import Geom, GeomNode, NodePath, BoundingBox
+from panda3d.core import LPoint3f, LVector2i
+import argparse
+import math
+import time
+import numpy as np
+
+from meshing import Mesh
+
+###############################################################################
+# Square block of terrain cells meshed and culled together
+#
+#   j1 +-------+-------+
+#      |       |       |
+#      | chunk | chunk |
+#      |  0,1  |  1,1  |
+#      +-------+-------+
+#      |       |       |
+#      | chunk | chunk |
+#      |  0,0  |  1,0  |
+#   j0 +-------+-------+
+#     i0  -->         i1
+#
+class TerrainChunk:
+    # Layers of geoms, index of versions and batched
+    TerrainLayer = 0
+    WaterLayer = 1
+
+    def __init__(self, ci, cj, i0, j0, i1, j1):
+        # Cell range covered by the chunk, i1 and j1 excluded
+        self.ci = ci
+        self.cj = cj
+        self.i0 = i0
+        self.j0 = j0
+        self.i1 = i1
+        self.j1 = j1
+
+        # World space bounds
+        self.minPoint = LPoint3f(0.0, 0.0, 0.0)
+        self.maxPoint = LPoint3f(0.0, 0.0, 0.0)
+        self.bounds = BoundingBox()
+
+        # Scene graph nodes
+        self.terrainNode = NodePath()
+        self.waterNode = NodePath()
+        self.numTerrainVerts = 0
+        self.numWaterVerts = 0
+        self.visible = True
+        # Changes of the geom of each layer, and whether a batch draws it
+        self.versions = [0, 0]
+        self.batched = [False, False]
+        # Baked lighting cache, see TerrainLightBaker
+        self.bakedLight = None
+
+    def containsIJ(self, i, j):
+        return i >= self.i0 and i < self.i1 and j >= self.j0 and j < self.j1
+
+    # Compute tight bounds from the heights of the chunk cells and their ring
+    # of neighbors, as side walls and tapers rise up to the neighbor height
+    def updateBounds(self, terrainRegionMap, kHeights):
+        trm = terrainRegionMap
+        radius = trm.cellDimension / 2.0
+        inner = kHeights[self.i0:self.i1, self.j0:self.j1]
+        ring = kHeights[max(self.i0-1, 0):min(self.i1+1, trm.size), max(self.j0-1, 0):min(self.j1+1, trm.size)]
+        minZ = trm.getZHeightFromK(int(inner.min()))
+        maxZ = trm.getZHeightFromK(int(ring.max()))
+        waterLevel = trm.waterLevelMap[self.i0:self.i1, self.j0:self.j1]
+        wet = waterLevel > inner * trm.heightStep
+        if(bool(wet.any())):
+            minZ = min(minZ, float(waterLevel[wet].min()))
+            maxZ = max(maxZ, float(waterLevel[wet].max()))
+        minXY = trm.getXYLocationFromIJ(LVector2i(self.i0, self.j0))
+        maxXY = trm.getXYLocationFromIJ(LVector2i(self.i1-1, self.j1-1))
+        self.minPoint = LPoint3f(minXY.getX() - radius, minXY.getY() - radius, minZ)
+        self.maxPoint = LPoint3f(maxXY.getX() + radius, maxXY.getY() + radius, maxZ)
+        self.bounds = BoundingBox(self.minPoint, self.maxPoint)
+
+    def getNumVerts(self):
+        return self.numTerrainVerts + self.numWaterVerts
+
+    def getLayerNode(self, layer):
+        return self.terrainNode if layer == TerrainChunk.TerrainLayer else self.waterNode
+
+    def getCenter(self):
+        return (self.minPoint + self.maxPoint) * 0.5
+
+    # Distance from a point to the closest point of the bounding box
+    def getDistanceTo(self, point):
+        dx = max(self.minPoint.getX() - point.getX(), 0.0, point.getX() - self.maxPoint.getX())
+        dy = max(self.minPoint.getY() - point.getY(), 0.0, point.getY() - self.maxPoint.getY())
+        dz = max(self.minPoint.getZ() - point.getZ(), 0.0, point.getZ() - self.maxPoint.getZ())
+        return math.sqrt(dx*dx + dy*dy + dz*dz)
+
+    def setVisible(self, visible):
+        if(visible == self.visible):
+            return
+        self.visible = visible
+        self.updateNodes()
+
+    # Nodes are shown when visible, unless a batch draws them
+    def updateNodes(self):
+        for layer, node in enumerate([self.terrainNode, self.waterNode]):
+            if node.isEmpty():
+                continue
+            if(self.visible and not self.batched[layer]):
+                node.unstash()
+            else:
+                node.stash()
+
+###############################################################################
+# Spatial organisation of the terrain into chunks
+class TerrainChunkGrid:
+
+    def __init__(self, terrainRegionMap, chunkSize):
+        self.heightMap = terrainRegionMap
+        self.chunkSize = chunkSize
+        self.numChunks = (terrainRegionMap.size + chunkSize - 1) // chunkSize
+        self.kHeights = terrainRegionMap.getKHeightArray()
+        # Optional TerrainLightBaker applied to every terrain geom
+        self.lightBaker = None
+        self.chunks = []
+        for ci in range(self.numChunks):
+            for cj in range(self.numChunks):
+                i0 = ci * chunkSize
+                j0 = cj * chunkSize
+                i1 = min(i0 + chunkSize, terrainRegionMap.size)
+                j1 = min(j0 + chunkSize, terrainRegionMap.size)
+                chunk = TerrainChunk(ci, cj, i0, j0, i1, j1)
+                chunk.updateBounds(terrainRegionMap, self.kHeights)
+                self.chunks.append(chunk)
+
+    def getChunk(self, ci, cj):
+        return self.chunks[ci * self.numChunks + cj]
+
+    def getChunkFromIJ(self, i, j):
+        return self.getChunk(i // self.chunkSize, j // self.chunkSize)
+
+    # Chunks overlapping the cells [i0,i1[ x [j0,j1[
+    def getChunksInRect(self, rect):
+        i0, j0, i1, j1 = rect
+        chunkList = []
+        for ci in range(i0 // self.chunkSize, (i1 - 1) // self.chunkSize + 1):
+            for cj in range(j0 // self.chunkSize, (j1 - 1) // self.chunkSize + 1):
+                chunkList.append(self.getChunk(ci, cj))
+        return chunkList
+
+    # Refresh heights and bounds after the terrain data changed
+    def refreshHeights(self, chunkList=None):
+        self.kHeights = self.heightMap.getKHeightArray()
+        for chunk in (self.chunks if chunkList is None else chunkList):
+            chunk.updateBounds(self.heightMap, self.kHeights)
+
+    # Refresh only the heights of an edited cell rectangle and the bounds of
+    # the chunks around it
+    def refreshHeightsInRect(self, rect):
+        i0, j0, i1, j1 = rect
+        for i in range(i0, i1):
+            self.kHeights[i, j0:j1] = self.heightMap.heightMap[i][j0:j1]
+        ringRect = (max(i0 - 1, 0), max(j0 - 1, 0), min(i1 + 1, self.heightMap.size), min(j1 + 1, self.heightMap.size))
+        for chunk in self.getChunksInRect(ringRect):
+            chunk.updateBounds(self.heightMap, self.kHeights)
+
+    # Mesh every chunk and attach one GeomNode per chunk under the parent node
+    def buildTerrainNodes(self, terrainMesher, parent):
+        for chunk in self.chunks:
+            self.buildChunkTerrainNode(chunk, terrainMesher, parent)
+
+    def buildWaterNodes(self, terrainMesher, parent):
+        for chunk in self.chunks:
+            self.buildChunkWaterNode(chunk, terrainMesher, parent)
+
+    def buildChunkTerrainNode(self, chunk, terrainMesher, parent):
+        geom = terrainMesher.meshTerrainChunk(chunk.i0, chunk.j0, chunk.i1, chunk.j1)
+        self.setChunkTerrainGeom(chunk, geom, parent)
+
+    def buildChunkWaterNode(self, chunk, terrainMesher, parent):
+        geom = terrainMesher.meshWaterChunk(chunk.i0, chunk.j0, chunk.i1, chunk.j1)
+        self.setChunkWaterGeom(chunk, geom, parent)
+
+    # The light is baked into the geom first unless withLight is False,
+    # e.g. when already done with bakeChunkLight
+    def setChunkTerrainGeom(self, chunk, geom, parent, withLight=True):
+        if withLight:
+            self.bakeChunkLight(chunk, geom)
+        chunk.terrainNode = self.__replaceGeom(chunk, chunk.terrainNode, geom, parent, 'terrainChunk')
+        chunk.numTerrainVerts = self.__getNumVerts(geom)
+        chunk.versions[TerrainChunk.TerrainLayer] += 1
+
+    def setChunkWaterGeom(self, chunk, geom, parent):
+        chunk.waterNode = self.__replaceGeom(chunk, chunk.waterNode, geom, parent, 'waterChunk')
+        chunk.numWaterVerts = self.__getNumVerts(geom)
+        chunk.versions[TerrainChunk.WaterLayer] += 1
+
+    def bakeChunkLight(self, chunk, geom):
+        if(self.lightBaker is not None and geom is not None):
+            self.lightBaker.bakeGeom(chunk, self.kHeights, geom)
+
+    # Bake the light again into a copy of the terrain geom, static vertex
+    # buffers are replaced rather than rewritten
+    def relightChunk(self, chunk):
+        if(self.lightBaker is None or chunk.terrainNode.isEmpty()):
+            return
+        geomNode = chunk.terrainNode.node()
+        geom = geomNode.getGeom(0).makeCopy()
+        # The copy shares the vertex arrays until the color one is modified
+        self.lightBaker.bakeGeom(chunk, self.kHeights, geom)
+        geomNode.setGeom(0, geom)
+        chunk.versions[TerrainChunk.TerrainLayer] += 1
+
+    def __getNumVerts(self, geom):
+        return 0 if geom is None else geom.getVertexData().getNumRows()
+
+    # Reuse the existing node: dynamic geoms with the same vertex count and
+    # format are copied into its vertex buffer, others replace its geom.
+    # Without a node, create one.
+    def __replaceGeom(self, chunk, node, geom, parent, name):
+        if(geom is not None and not node.isEmpty()):
+            geomNode = node.node()
+            oldData = geomNode.getGeom(0).getVertexData()
+            newData = geom.getVertexData()
+            if(newData.getUsageHint() != Geom.UHStatic and oldData.getNumRows() == newData.getNumRows()
+               and oldData.getFormat() == newData.getFormat()):
+                oldGeom = geomNode.modifyGeom(0)
+                oldData = oldGeom.modifyVertexData()
+                for a in range(newData.getNumArrays()):
+                    oldData.modifyArray(a).modifyHandle().copyDataFrom(newData.getArray(a).getHandle())
+                oldGeom.setPrimitive(0, geom.getPrimitive(0))
+            else:
+                geomNode.setGeom(0, geom)
+                geomNode.setGeomState(0, Mesh.getGeomState(geom))
+            geomNode.setBounds(chunk.bounds)
+            return node
+        node.removeNode()
+        return self.__attachGeom(chunk, geom, parent, name)
+
+    def __attachGeom(self, chunk, geom, parent, name):
+        if geom is None:
+            return NodePath()
+        snode = GeomNode('{0}_{1}_{2}'.format(name, chunk.ci, chunk.cj))
+        snode.addGeom(geom, Mesh.getGeomState(geom))
+        # Tight bounds so the renderer does not recompute them from vertices
+        snode.setBounds(chunk.bounds)
+        snode.setFinal(True)
+        node = parent.attachNewNode(snode)
+        if not chunk.visible:
+            node.stash()
+        return node
+
+###############################################################################
+# Square block of chunks drawn by one flattened node
+class TerrainChunkBatch:
+    def __init__(self, chunkList):
+        self.chunks = chunkList
+        # Layer versions of the chunks when last checked
+        self.versions = None
+        self.stableFrames = 0
+        self.node = None
+        self.numGeoms = 0
+
+    def isVisible(self):
+        return any(chunk.visible for chunk in self.chunks)
+
+###############################################################################
+# Draw call batching of the static chunks of one layer
+#
+# Chunks are grouped in batches of batchSize x batchSize chunks. Once the
+# geoms of a batch did not change for settleFrames updates, a flattened copy
+# of its chunk nodes replaces them: flattenStrong merges the geoms of the
+# same state, splitting them at max-collect-vertices, so a batch holds a
+# few geoms instead of one per chunk. The chunk nodes are kept stashed and
+# shown again as soon as one of the chunks is remeshed or relit, editing
+# stays per chunk at the cost of the batch copy in memory.
+#
+# update() goes after the chunk culling, a batch is shown when one of its
+# chunks is visible.
+class TerrainChunkBatcher:
+    TerrainLayer = TerrainChunk.TerrainLayer
+    WaterLayer = TerrainChunk.WaterLayer
+
+    def __init__(self, chunkGrid, parent, layer, batchSize=4, settleFrames=30):
+        self.chunkGrid = chunkGrid
+        self.parent = parent
+        self.layer = layer
+        self.batchSize = batchSize
+        self.settleFrames = settleFrames
+        self.batches = []
+        n = chunkGrid.numChunks
+        for bi in range(0, n, batchSize):
+            for bj in range(0, n, batchSize):
+                chunkList = [chunkGrid.getChunk(ci, cj) for ci in range(bi, min(bi + batchSize, n))
+                                                        for cj in range(bj, min(bj + batchSize, n))]
+                self.batches.append(TerrainChunkBatch(chunkList))
+
+        # Statistics
+        self.numBuilt = 0
+        self.numReleased = 0
+
+    def update(self):
+        for batch in self.batches:
+            versions = [chunk.versions[self.layer] for chunk in batch.chunks]
+            if(versions != batch.versions):
+                if batch.node is not None:
+                    self.__release(batch)
+                batch.versions = versions
+                batch.stableFrames = 0
+            if batch.node is None:
+                if batch.stableFrames >= self.settleFrames:
+                    self.__build(batch)
+                else:
+                    batch.stableFrames += 1
+            if(batch.node is not None and not batch.node.isEmpty()):
+                if batch.isVisible():
+                    batch.node.unstash()
+                else:
+                    batch.node.stash()
+
+    # Draw calls of the layer with the current chunk visibility
+    def getNumDrawCalls(self):
+        numDrawCalls = 0
+        for batch in self.batches:
+            if batch.node is not None:
+                numDrawCalls += batch.numGeoms if batch.isVisible() else 0
+                continue
+            for chunk in batch.chunks:
+                node = chunk.getLayerNode(self.layer)
+                if(chunk.visible and not node.isEmpty()):
+                    numDrawCalls += node.node().getNumGeoms()
+        return numDrawCalls
+
+    def __build(self, batch):
+        nodeList = [chunk.getLayerNode(self.layer) for chunk in batch.chunks]
+        nodeList = [node for node in nodeList if not node.isEmpty()]
+        batch.numGeoms = 0
+        if not nodeList:
+            # Nothing to draw, e.g. no water
+            batch.node = NodePath()
+            return
+        first = batch.chunks[0]
+        batch.node = NodePath('batch_{0}_{1}'.format(first.ci, first.cj))
+        for node in nodeList:
+            node.copyTo(batch.node)
+        batch.node.flattenStrong()
+        bounds = BoundingBox(batch.chunks[0].minPoint, batch.chunks[0].maxPoint)
+        for chunk in batch.chunks[1:]:
+            bounds.extendBy(chunk.bounds)
+        batch.node.node().setBounds(bounds)
+        batch.node.node().setFinal(True)
+        batch.numGeoms = sum(geomNode.node().getNumGeoms() for geomNode in batch.node.findAllMatches('**/+GeomNode'))
+        batch.node.reparentTo(self.parent)
+        for chunk in batch.chunks:
+            chunk.batched[self.layer] = True
+            chunk.updateNodes()
+        self.numBuilt += 1
+
+    def __release(self, batch):
+        if not batch.node.isEmpty():
+            batch.node.removeNode()
+            self.numReleased += 1
+        batch.node = None
+        batch.numGeoms = 0
+        for chunk in batch.chunks:
+            chunk.batched[self.layer] = False
+            chunk.updateNodes()
+
+###############################################################################
+# Per frame visibility of the chunks: fog distance, view frustum and
+# optionally heightmap horizon occlusion
+#
+# The line of sight windows of terrainVisibility are not used here: their
+# interpolated horizon can hide cells that are in sight, while culling has
+# to keep every chunk that may be seen.
+class TerrainChunkCuller:
+
+    def __init__(self, chunkGrid, useOcclusion=False):
+        self.chunkGrid = chunkGrid
+        self.useOcclusion = useOcclusion
+        # See getOccluderHeights, updated with the heights every frame
+        self.occluderHeights = None
+
+        # Statistics of the last update
+        self.numVisible = 0
+        self.numVertsVisible = 0
+
+    # cullDistance is None when nothing limits the view distance
+    def update(self, cameraNodePath, lens, cullDistance=None):
+        camPos = cameraNodePath.getPos(cameraNodePath.getTop())
+        frustum = lens.makeBounds()
+        frustum.xform(cameraNodePath.getMat(cameraNodePath.getTop()))
+
+        if self.useOcclusion:
+            self.occluderHeights = TerrainChunkCuller.getOccluderHeights(self.chunkGrid.kHeights)
+
+        self.numVisible = 0
+        self.numVertsVisible = 0
+        for chunk in self.chunkGrid.chunks:
+            visible = self.isChunkVisible(chunk, camPos, frustum, cullDistance)
+            chunk.setVisible(visible)
+            if visible:
+                self.numVisible += 1
+                self.numVertsVisible += chunk.getNumVerts()
+
+    def isChunkVisible(self, chunk, camPos, frustum, cullDistance):
+        if(cullDistance is not None and chunk.getDistanceTo(camPos) > cullDistance):
+            return False
+        if(frustum.contains(chunk.bounds) == 0):
+            return False
+        if(self.useOcclusion and self.isChunkOccluded(chunk, camPos)):
+            return False
+        return True
+
+    # Lowest height of each cell and its 8 neighbors, cells off the map do
+    # not occlude
+    def getOccluderHeights(kHeights):
+        size = kHeights.shape[0]
+        padded = np.full((size + 2, size + 2), np.iinfo(np.int32).min // 2, dtype=np.int32)
+        padded[1:-1, 1:-1] = kHeights
+        eroded = padded[1:-1, 1:-1].copy()
+        for di in range(3):
+            for dj in range(3):
+                np.minimum(eroded, padded[di:di+size, dj:dj+size], out=eroded)
+        return eroded
+
+    # Conservative horizon test: the chunk is hidden when the lines of sight
+    # to a grid of points on its bounds top, two cells apart, all pass under
+    # the occluder height of some cell outside the chunk.
+    #
+    # Any point of the chunk is at most a cell from a grid point on each
+    # axis, and under the bounds top: its line of sight is under the sampled
+    # one and at most a cell aside, so it goes through the cell, or a
+    # neighbor, that blocked the sampled line. The occluder height is the
+    # lowest of these, a peak between the grid points cannot be missed.
+    def isChunkOccluded(self, chunk, camPos):
+        trm = self.chunkGrid.heightMap
+        ex = camPos.getX()
+        ey = camPos.getY()
+        ez = camPos.getZ()
+        minP = chunk.minPoint
+        maxP = chunk.maxPoint
+        if(ex >= minP.getX() and ex <= maxP.getX() and ey >= minP.getY() and ey <= maxP.getY()):
+            return False
+        spacing = 2.0 * trm.cellDimension
+        numX = int(math.ceil((maxP.getX() - minP.getX()) / spacing)) + 1
+        numY = int(math.ceil((maxP.getY() - minP.getY()) / spacing)) + 1
+        xs = np.linspace(minP.getX(), maxP.getX(), numX)
+        ys = np.linspace(minP.getY(), maxP.getY(), numY)
+        tx, ty = np.meshgrid(xs, ys)
+        tx = tx.reshape(-1, 1)
+        ty = ty.reshape(-1, 1)
+        tz = maxP.getZ()
+
+        # Samples about a cell apart, a skipped cell only keeps the chunk
+        center = chunk.getCenter()
+        dist = math.sqrt((center.getX() - ex)**2 + (center.getY() - ey)**2) + (maxP.getX() - minP.getX())
+        numSamples = max(int(dist / trm.cellDimension), 2)
+        t = np.linspace(0.0, 1.0, numSamples, endpoint=False)[1:].reshape(1, -1)
+        px = ex + (tx - ex) * t
+        py = ey + (ty - ey) * t
+        pz = ez + (tz - ez) * t
+        pi = np.rint((px + trm.size) / 2.0).astype(np.int32)
+        pj = np.rint((py + trm.size) / 2.0).astype(np.int32)
+
+        # Only cells on the map and outside the chunk can occlude it
+        occluder = (pi >= 0) & (pi < trm.size) & (pj >= 0) & (pj < trm.size)
+        occluder &= ~((pi >= chunk.i0) & (pi < chunk.i1) & (pj >= chunk.j0) & (pj < chunk.j1))
+        pi = np.clip(pi, 0, trm.size-1)
+        pj = np.clip(pj, 0, trm.size-1)
+        cellZ = self.occluderHeights[pi, pj] * trm.heightStep
+        blocked = (occluder & (cellZ > pz)).any(axis=1)
+        return bool(blocked.all())
+
+###############################################################################
+# Remeshing of edited chunks spread over frames within a time budget
+#
+# A chunk job runs in steps: terrain meshing, light baking, terrain geom
+# swap, water meshing and water geom swap. The cost of each kind of step is
+# tracked, a step that would end over the frame budget waits for the next
+# frame. At least one step runs per frame, so that a step costing more than
+# the whole budget (meshing a rough chunk) still goes through, alone.
+class TerrainRemeshScheduler:
+
+    def __init__(self, chunkGrid, terrainMesher, terrainParent, waterParent, frameBudget=0.004):
+        self.chunkGrid = chunkGrid
+        self.terrainMesher = terrainMesher
+        self.terrainParent = terrainParent
+        self.waterParent = waterParent
+        # Seconds of meshing allowed per frame
+        self.frameBudget = frameBudget
+
+        self.queue = []
+        # What needs rebuilding in the queued chunks
+        self.terrainDirty = set()
+        self.waterDirty = set()
+        self.lightDirty = set()
+        self.curChunk = None
+        self.curJob = None
+        # Next step of the current job, and the expected seconds per step
+        self.curStep = None
+        self.stepCosts = {}
+
+        # Statistics
+        self.numRemeshed = 0
+        self.lastFrameTime = 0.0
+
+    def isIdle(self):
+        return self.curJob is None and len(self.queue) == 0
+
+    def getNumPending(self):
+        return len(self.queue) + (0 if self.curJob is None else 1)
+
+    def __enqueue(self, chunk, dirtySet):
+        dirtySet.add(chunk)
+        # A running job keeps its old data, the chunk is simply redone after
+        if chunk not in self.queue:
+            self.queue.append(chunk)
+
+    # Queue the chunks touched by the edited cell rectangles, returns them
+    def addDirtyRects(self, dirtyRects):
+        dirtyChunks = []
+        for rect in dirtyRects:
+            self.chunkGrid.refreshHeightsInRect(rect)
+            for chunk in self.chunkGrid.getChunksInRect(rect):
+                if chunk not in dirtyChunks:
+                    dirtyChunks.append(chunk)
+            # Baked light reaches further than the geometry
+            if self.chunkGrid.lightBaker is not None:
+                reach = self.chunkGrid.lightBaker.radius + 1
+                size = self.chunkGrid.heightMap.size
+                lightRect = (max(rect[0] - reach, 0), max(rect[1] - reach, 0), min(rect[2] + reach, size), min(rect[3] + reach, size))
+                for chunk in self.chunkGrid.getChunksInRect(lightRect):
+                    self.__enqueue(chunk, self.lightDirty)
+        for chunk in dirtyChunks:
+            self.__enqueue(chunk, self.terrainDirty)
+            self.__enqueue(chunk, self.waterDirty)
+        return dirtyChunks
+
+    # Queue the chunks whose water surface changed
+    def addDirtyWaterChunks(self, chunkList):
+        for chunk in chunkList:
+            chunk.updateBounds(self.chunkGrid.heightMap, self.chunkGrid.kHeights)
+            self.__enqueue(chunk, self.waterDirty)
+
+    def update(self):
+        start = time.perf_counter()
+        numSteps = 0
+        while not self.isIdle():
+            if self.curJob is None:
+                self.__startJob(self.queue.pop(0))
+            step = self.curStep
+            stepStart = time.perf_counter()
+            if(numSteps > 0 and stepStart - start + self.stepCosts.get(step, 0.0) > self.frameBudget):
+                break
+            try:
+                self.curStep = next(self.curJob)
+            except StopIteration:
+                self.curJob = None
+                self.curChunk = None
+                self.curStep = None
+                self.numRemeshed += 1
+            cost = time.perf_counter() - stepStart
+            # Follows a slower step at once, a faster one slowly
+            self.stepCosts[step] = max(cost, 0.9 * self.stepCosts.get(step, 0.0))
+            numSteps += 1
+        self.lastFrameTime = time.perf_counter() - start
+
+    def __startJob(self, chunk):
+        withTerrain = chunk in self.terrainDirty
+        withWater = chunk in self.waterDirty
+        withLight = chunk in self.lightDirty
+        self.terrainDirty.discard(chunk)
+        self.waterDirty.discard(chunk)
+        self.lightDirty.discard(chunk)
+        self.curChunk = chunk
+        self.curJob = self.__remeshChunk(chunk, withTerrain, withWater, withLight)
+        self.curStep = next(self.curJob, None)
+
+    # Mesh the chunk in steps and swap each layer in when complete, every
+    # yield names the step that follows it
+    def __remeshChunk(self, chunk, withTerrain, withWater, withLight):
+        if withTerrain:
+            yield "terrainMesh"
+            terrainGeom = self.terrainMesher.meshTerrainChunk(chunk.i0, chunk.j0, chunk.i1, chunk.j1)
+            # Light is baked into the new terrain geom
+            yield "lightBake"
+            self.chunkGrid.bakeChunkLight(chunk, terrainGeom)
+            yield "terrainSwap"
+            self.chunkGrid.setChunkTerrainGeom(chunk, terrainGeom, self.terrainParent, withLight=False)
+        elif withLight:
+            yield "relight"
+            self.chunkGrid.relightChunk(chunk)
+        if withWater:
+            yield "waterMesh"
+            waterGeom = self.terrainMesher.meshWaterChunk(chunk.i0, chunk.j0, chunk.i1, chunk.j1)
+            yield "waterSwap"
+            self.chunkGrid.setChunkWaterGeom(chunk, waterGeom, self.waterParent)
+
+# Draw calls of the chunks of a generated map, one by one and batched
+if __name__ == "__main__":
+    from terrainMesh import TerrainMesher
+
+    parser = argparse.ArgumentParser(description="Lightworld: chunk batching report")
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--height", type=int, default=18)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=4)
+    options = parser.parse_args()
+
+    terrainMesher = TerrainMesher()
+    terrainMesher.generateTerrain(options.size, options.height, options.seed)
+    chunkGrid = TerrainChunkGrid(terrainMesher.heightMap, options.chunk_size)
+    terrainParent = NodePath('terrain')
+    waterParent = NodePath('water')
+    chunkGrid.buildTerrainNodes(terrainMesher, terrainParent)
+    chunkGrid.buildWaterNodes(terrainMesher, waterParent)
+    for layer, parent in [(TerrainChunkBatcher.TerrainLayer, terrainParent), (TerrainChunkBatcher.WaterLayer, waterParent)]:
+        batcher = TerrainChunkBatcher(chunkGrid, parent, layer, options.batch_size, settleFrames=0)
+        before = batcher.getNumDrawCalls()
+        batcher.update()
+        print("{0} draw calls: {1} per chunk, {2} batched".format(
+            "Terrain" if layer == TerrainChunkBatcher.TerrainLayer else "Water", before, batcher.getNumDrawCalls()))
@@ -0,0 +1,558 @@
+from panda3d.core import LPoint3f, LVector3f
+import math
+import numpy as np
+
+###############################################################################
+# Collision queries against the analytic terrain shape
+#
+# The terrain solid is everything under a height function H(x,y) built from
+# the cell shapes of CellShape2. Each cell is cut in 4x4 sub-cells on which H
+# is linear, except the folded corners which fold along their diagonal:
+#
+#       b=3 +-----+-----+-----+-----+
+#           | cor |    side   | cor |     center: flat at the cell height
+#       b=2 +-----+-----+-----+-----+     side:   flat, or tapered up one
+#           |     |           |     |             step towards a higher
+#           | side|  center   | side|             neighbor
+#       b=1 +     +           +     +     corner: flat, tapered along x or
+#           |     |           |     |             y, or folded along the
+#       b=0 +-----+-----+-----+-----+             inner-outer diagonal
+#           | cor |    side   | cor |
+#           +-----+-----+-----+-----+
+#             a=0   a=1   a=2   a=3
+#
+# H is discontinuous across cell borders, where the solid has vertical walls.
+# Rays walk the cells with a DDA and test the linear pieces where they cross
+# the sub-cell lines and diagonals, spheres and capsules test the closest
+# points on the analytic triangles.
+
+class TerrainCollisionHit:
+    def __init__(self, t, point, normal, i, j):
+        self.t = t
+        self.point = point
+        self.normal = normal
+        self.i = i
+        self.j = j
+
+class TerrainCollider:
+
+    # Neighbor offsets (di, dj) by heading
+    RiseHeadings = {
+        "xn": (-1, 0), "xp": (1, 0), "yn": (0, -1), "yp": (0, 1),
+        "xnyn": (-1, -1), "xpyn": (1, -1), "xpyp": (1, 1), "xnyp": (-1, 1)
+    }
+
+    def __init__(self, terrainRegionMap):
+        trm = terrainRegionMap
+        self.heightMap = trm
+        self.radius = trm.cellDimension / 2.0
+        self.subSize = trm.cellDimension / 4.0
+        self.step = trm.heightStep
+        self.numSub = 4 * trm.size
+        # World position of the lower border of cell 0
+        self.origin = -trm.size - self.radius
+        self.refresh()
+
+    # Recompute the cell classification after heights changed
+    def refresh(self):
+        trm = self.heightMap
+        self.kHeights = trm.getKHeightArray()
+        k = self.kHeights
+        self.z0 = k.astype(np.float32) * self.step
+        self.rise = {}
+        for heading, (di, dj) in TerrainCollider.RiseHeadings.items():
+            rise = np.zeros_like(k)
+            si = slice(max(-di, 0), trm.size - max(di, 0))
+            sj = slice(max(-dj, 0), trm.size - max(dj, 0))
+            ni = slice(max(di, 0), trm.size + min(di, 0))
+            nj = slice(max(dj, 0), trm.size + min(dj, 0))
+            rise[si, sj] = k[ni, nj] - k[si, sj]
+            self.rise[heading] = rise
+        # Highest point of each cell, tapers rise one step above the center
+        anyRise = np.zeros(k.shape, dtype=bool)
+        for rise in self.rise.values():
+            anyRise |= rise > 0
+        self.cellTop = self.z0 + anyRise * self.step
+        self.maxZ = float(self.cellTop.max())
+
+    ###########################################################################
+    # Height function
+
+    # Height and gradient (in world units) of the sub-cells (si,sj) at the
+    # world positions (x,y), clamped inside the sub-cells
+    def evaluate(self, si, sj, x, y):
+        ci = si // 4
+        cj = sj // 4
+        a = si - 4 * ci
+        b = sj - 4 * cj
+        # Local coordinates in cell radius units, in [-1,1]
+        lu = (x - (self.origin + ci * 2.0 * self.radius + self.radius)) / self.radius
+        lv = (y - (self.origin + cj * 2.0 * self.radius + self.radius)) / self.radius
+        lu = np.clip(lu, (a - 2) * 0.5, (a - 1) * 0.5)
+        lv = np.clip(lv, (b - 2) * 0.5, (b - 1) * 0.5)
+
+        sx = np.where(a >= 2, 1, -1)
+        sy = np.where(b >= 2, 1, -1)
+        u = sx * lu
+        v = sy * lv
+        ringU = (a == 0) | (a == 3)
+        ringV = (b == 0) | (b == 3)
+
+        xrise = np.where(sx > 0, self.rise["xp"][ci, cj], self.rise["xn"][ci, cj])
+        yrise = np.where(sy > 0, self.rise["yp"][ci, cj], self.rise["yn"][ci, cj])
+        crise = np.where(sx > 0,
+            np.where(sy > 0, self.rise["xpyp"][ci, cj], self.rise["xpyn"][ci, cj]),
+            np.where(sy > 0, self.rise["xnyp"][ci, cj], self.rise["xnyn"][ci, cj]))
+
+        h = np.zeros(np.shape(lu), dtype=np.float64)
+        gu = np.zeros_like(h)
+        gv = np.zeros_like(h)
+        ramp = self.step / 0.5
+
+        # Sides, tapered towards a higher neighbor
+        sideU = ringU & ~ringV & (xrise > 0)
+        sideV = ringV & ~ringU & (yrise > 0)
+        h = np.where(sideU, ramp * (u - 0.5), h)
+        gu = np.where(sideU, ramp, gu)
+        h = np.where(sideV, ramp * (v - 0.5), h)
+        gv = np.where(sideV, ramp, gv)
+
+        # Corners
+        corner = ringU & ringV
+        taperU = corner & (xrise > 0) & (yrise <= 0)
+        taperV = corner & (xrise <= 0) & (yrise > 0)
+        folded = corner & (((xrise == 0) & (yrise == 0) & (crise > 0)) | ((xrise > 0) & (yrise > 0)))
+        h = np.where(taperU, ramp * (u - 0.5), h)
+        gu = np.where(taperU, ramp, gu)
+        h = np.where(taperV, ramp * (v - 0.5), h)
+        gv = np.where(taperV, ramp, gv)
+
+        zx = np.minimum(xrise, 1) * self.step
+        zy = np.minimum(yrise, 1) * self.step
+        zc = np.minimum(np.maximum(np.maximum(crise, xrise), yrise), 1) * self.step
+        s = u - 0.5
+        w = v - 0.5
+        lowerU = s >= w
+        foldH = np.where(lowerU, zx * (s - w) + zc * w, zy * (w - s) + zc * s) / 0.5
+        foldGU = np.where(lowerU, zx, zc - zy) / 0.5
+        foldGV = np.where(lowerU, zc - zx, zy) / 0.5
+        h = np.where(folded, foldH, h)
+        gu = np.where(folded, foldGU, gu)
+        gv = np.where(folded, foldGV, gv)
+
+        # Back to world units
+        h = h + self.z0[ci, cj]
+        gx = gu * sx / self.radius
+        gy = gv * sy / self.radius
+        return h, gx, gy
+
+    def getSubCell(self, x, y):
+        si = np.floor((np.asarray(x) - self.origin) / self.subSize).astype(np.int64)
+        sj = np.floor((np.asarray(y) - self.origin) / self.subSize).astype(np.int64)
+        return si, sj
+
+    def isOnMap(self, si, sj):
+        return (si >= 0) & (si < self.numSub) & (sj >= 0) & (sj < self.numSub)
+
+    # Terrain height at a world position, None outside the map
+    def getHeightAt(self, x, y):
+        si, sj = self.getSubCell(x, y)
+        if not self.isOnMap(si, sj):
+            return None
+        h, _, _ = self.evaluate(np.array([si]), np.array([sj]), np.array([x]), np.array([y]))
+        return float(h[0])
+
+    def __normals(self, gx, gy):
+        n = np.stack([-gx, -gy, np.ones_like(gx)], axis=-1)
+        return n / np.linalg.norm(n, axis=-1, keepdims=True)
+
+    ###########################################################################
+    # Rays
+
+    # Batched ray casts. origins and directions are (N,3) arrays, directions
+    # need not be normalized and t is in units of direction length.
+    # Returns t (inf when missed), normals (N,3) and hit cells (N,2, -1 when
+    # missed).
+    def castRays(self, origins, directions, maxDistance=np.inf):
+        o = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        d = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        n = o.shape[0]
+        tHit = np.full(n, np.inf)
+        normals = np.zeros((n, 3))
+        cells = np.full((n, 2), -1, dtype=np.int64)
+
+        # Clip the rays to the map footprint
+        lo = self.origin
+        hi = self.origin + self.numSub * self.subSize
+        tStart = np.zeros(n)
+        tEnd = np.full(n, float(maxDistance))
+        for axis in range(2):
+            da = d[:, axis]
+            moving = np.abs(da) > 1e-12
+            inv = np.where(moving, 1.0 / np.where(moving, da, 1.0), 0.0)
+            t0 = (lo - o[:, axis]) * inv
+            t1 = (hi - o[:, axis]) * inv
+            tNear = np.where(moving, np.minimum(t0, t1), -np.inf)
+            tFar = np.where(moving, np.maximum(t0, t1), np.inf)
+            outside = ~moving & ((o[:, axis] < lo) | (o[:, axis] >= hi))
+            tStart = np.maximum(tStart, tNear)
+            tEnd = np.where(outside, -np.inf, np.minimum(tEnd, tFar))
+
+        vertical = (np.abs(d[:, 0]) < 1e-12) & (np.abs(d[:, 1]) < 1e-12)
+        active = (tStart < tEnd)
+        self.__castVertical(o, d, tStart, tEnd, active & vertical, tHit, normals, cells)
+        self.__castDDA(o, d, tStart, tEnd, active & ~vertical, tHit, normals, cells)
+        return tHit, normals, cells
+
+    # Single ray cast, returns a TerrainCollisionHit or None
+    def castRay(self, origin, direction, maxDistance=np.inf):
+        t, normals, cells = self.castRays(
+            [[origin.getX(), origin.getY(), origin.getZ()]],
+            [[direction.getX(), direction.getY(), direction.getZ()]], maxDistance)
+        if not np.isfinite(t[0]):
+            return None
+        point = LPoint3f(origin + direction * float(t[0]))
+        return TerrainCollisionHit(float(t[0]), point, LVector3f(*normals[0]), int(cells[0, 0]), int(cells[0, 1]))
+
+    def __castVertical(self, o, d, tStart, tEnd, mask, tHit, normals, cells):
+        idx = np.nonzero(mask)[0]
+        if len(idx) == 0:
+            return
+        si, sj = self.getSubCell(o[idx, 0], o[idx, 1])
+        h, gx, gy = self.evaluate(si, sj, o[idx, 0], o[idx, 1])
+        z = o[idx, 2] + d[idx, 2] * tStart[idx]
+        dz = d[idx, 2]
+        t = np.where(z <= h, tStart[idx], np.where(dz < 0, tStart[idx] + (h - z) / np.where(dz < 0, dz, -1.0), np.inf))
+        t = np.where(t <= tEnd[idx], t, np.inf)
+        hit = np.isfinite(t)
+        tHit[idx[hit]] = t[hit]
+        normals[idx[hit]] = self.__normals(gx[hit], gy[hit])
+        cells[idx[hit], 0] = si[hit] // 4
+        cells[idx[hit], 1] = sj[hit] // 4
+
+    # Walk the cells along the rays. Inside a cell H is continuous and linear
+    # between the lines splitting its sub-cells and the corner diagonals, so
+    # the ray height above H only needs checking where the ray crosses them.
+    def __castDDA(self, o, d, tStart, tEnd, mask, tHit, normals, cells):
+        idx = np.nonzero(mask)[0]
+        if len(idx) == 0:
+            return
+        o = o[idx]
+        d = d[idx]
+        tEnd = tEnd[idx]
+        tEnter = tStart[idx].copy()
+        cellSize = 2.0 * self.radius
+        size = self.heightMap.size
+
+        # Start cell, nudged inside along the ray
+        p = o + d * tEnter[:, None]
+        eps = 1e-9
+        ci = np.floor((p[:, 0] + np.sign(d[:, 0]) * eps - self.origin) / cellSize).astype(np.int64)
+        cj = np.floor((p[:, 1] + np.sign(d[:, 1]) * eps - self.origin) / cellSize).astype(np.int64)
+        ci = np.clip(ci, 0, size - 1)
+        cj = np.clip(cj, 0, size - 1)
+
+        stepX = np.where(d[:, 0] > 0, 1, -1)
+        stepY = np.where(d[:, 1] > 0, 1, -1)
+        movingX = np.abs(d[:, 0]) > 1e-12
+        movingY = np.abs(d[:, 1]) > 1e-12
+        invX = np.where(movingX, 1.0 / np.where(movingX, d[:, 0], 1.0), 0.0)
+        invY = np.where(movingY, 1.0 / np.where(movingY, d[:, 1], 1.0), 0.0)
+        nextX = self.origin + (ci + (stepX > 0)) * cellSize
+        nextY = self.origin + (cj + (stepY > 0)) * cellSize
+        tMaxX = np.where(movingX, (nextX - o[:, 0]) * invX, np.inf)
+        tMaxY = np.where(movingY, (nextY - o[:, 1]) * invY, np.inf)
+        tDeltaX = np.where(movingX, np.abs(cellSize * invX), np.inf)
+        tDeltaY = np.where(movingY, np.abs(cellSize * invY), np.inf)
+        # Axis crossed to enter the current cell, -1 for the first one
+        enterAxis = np.full(len(idx), -1)
+
+        live = np.arange(len(idx))
+        for iteration in range(2 * size + 2):
+            if len(live) == 0:
+                break
+            ls = live
+            tExit = np.minimum(np.minimum(tMaxX[ls], tMaxY[ls]), tEnd[ls])
+            tE = tEnter[ls]
+
+            # Only rays dipping under the top of their cell can hit it
+            zE = o[ls, 2] + d[ls, 2] * tE
+            zX = o[ls, 2] + d[ls, 2] * tExit
+            under = np.minimum(zE, zX) <= self.cellTop[ci[ls], cj[ls]]
+            c = ls[under]
+            hit = np.zeros(len(c), dtype=bool)
+            if len(c) > 0:
+                t, hit, wall = self.__intersectCells(ci[c], cj[c], o[c], d[c], tE[under], tExit[under])
+                hs = c[hit]
+                if len(hs) > 0:
+                    ph = o[hs] + d[hs] * t[hit, None]
+                    si = np.clip(self.getSubCell(ph[:, 0], ph[:, 1])[0], 4 * ci[hs], 4 * ci[hs] + 3)
+                    sj = np.clip(self.getSubCell(ph[:, 0], ph[:, 1])[1], 4 * cj[hs], 4 * cj[hs] + 3)
+                    _, gx, gy = self.evaluate(si, sj, ph[:, 0], ph[:, 1])
+                    n = self.__normals(gx, gy)
+                    # Entering through a wall
+                    wallX = wall[hit] & (enterAxis[hs] == 0)
+                    wallY = wall[hit] & (enterAxis[hs] == 1)
+                    n[wallX] = np.stack([-stepX[hs][wallX], np.zeros(wallX.sum()), np.zeros(wallX.sum())], axis=-1)
+                    n[wallY] = np.stack([np.zeros(wallY.sum()), -stepY[hs][wallY], np.zeros(wallY.sum())], axis=-1)
+                    tHit[idx[hs]] = t[hit]
+                    normals[idx[hs]] = n
+                    cells[idx[hs], 0] = ci[hs]
+                    cells[idx[hs], 1] = cj[hs]
+
+            # Advance the others to the next cell
+            missed = np.ones(len(ls), dtype=bool)
+            missed[np.nonzero(under)[0][hit]] = False
+            ls = ls[missed]
+            alongX = tMaxX[ls] < tMaxY[ls]
+            ax = ls[alongX]
+            ay = ls[~alongX]
+            tEnter[ax] = tMaxX[ax]
+            ci[ax] += stepX[ax]
+            tMaxX[ax] += tDeltaX[ax]
+            enterAxis[ax] = 0
+            tEnter[ay] = tMaxY[ay]
+            cj[ay] += stepY[ay]
+            tMaxY[ay] += tDeltaY[ay]
+            enterAxis[ay] = 1
+
+            # Stop at the end of the ray, off the map, or when flying away
+            # above every cell
+            z = o[ls, 2] + d[ls, 2] * tEnter[ls]
+            keep = (tEnter[ls] < tEnd[ls]) & (ci[ls] >= 0) & (ci[ls] < size) & (cj[ls] >= 0) & (cj[ls] < size)
+            keep &= ~((z > self.maxZ) & (d[ls, 2] >= 0))
+            live = ls[keep]
+
+    # First point of the ray segments [tEnter,tExit] under H in the cells
+    # (ci,cj). Returns t, hit flags and whether the hit is on the entry wall.
+    def __intersectCells(self, ci, cj, o, d, tEnter, tExit):
+        n = len(ci)
+        cx = self.origin + ci * 2.0 * self.radius + self.radius
+        cy = self.origin + cj * 2.0 * self.radius + self.radius
+
+        # Breakpoints: sub-cell lines at -r/2, 0, r/2 and both diagonals
+        ts = [tEnter, tExit]
+        for axis, center in [(0, cx), (1, cy)]:
+            moving = np.abs(d[:, axis]) > 1e-12
+            inv = 1.0 / np.where(moving, d[:, axis], 1.0)
+            for offset in (-0.5 * self.radius, 0.0, 0.5 * self.radius):
+                ts.append(np.where(moving, (center + offset - o[:, axis]) * inv, tEnter))
+        for sign in (1.0, -1.0):
+            # (x-cx) = sign*(y-cy) along the ray
+            num = sign * (o[:, 1] - cy) - (o[:, 0] - cx)
+            den = d[:, 0] - sign * d[:, 1]
+            moving = np.abs(den) > 1e-12
+            ts.append(np.where(moving, num / np.where(moving, den, 1.0), tEnter))
+        ts = np.sort(np.clip(np.stack(ts, axis=1), tEnter[:, None], tExit[:, None]), axis=1)
+
+        # Ray height above H at the breakpoints, evaluated in this cell
+        k = ts.shape[1]
+        p = o[:, None, :] + d[:, None, :] * ts[:, :, None]
+        px = p[:, :, 0].ravel()
+        py = p[:, :, 1].ravel()
+        si, sj = self.getSubCell(px, py)
+        si = np.clip(si, np.repeat(4 * ci, k), np.repeat(4 * ci + 3, k))
+        sj = np.clip(sj, np.repeat(4 * cj, k), np.repeat(4 * cj + 3, k))
+        h, _, _ = self.evaluate(si, sj, px, py)
+        f = p[:, :, 2] - h.reshape(n, k)
+
+        under = f <= 0
+        hit = under.any(axis=1)
+        first = np.argmax(under, axis=1)
+        rows = np.arange(n)
+        prev = np.maximum(first - 1, 0)
+        f1 = f[rows, first]
+        f0 = f[rows, prev]
+        t1 = ts[rows, first]
+        t0 = ts[rows, prev]
+        denom = np.where(first > 0, f0 - f1, 1.0)
+        denom = np.where(np.abs(denom) > 1e-15, denom, 1.0)
+        t = np.where(first > 0, t0 + (t1 - t0) * f0 / denom, t1)
+        wall = hit & (first == 0)
+        return t, hit, wall
+
+    ###########################################################################
+    # Triangles of the analytic shape, for sphere and capsule queries
+
+    # Surface and wall triangles over the world rectangle, as (M,3,3)
+    def getTriangles(self, x0, y0, x1, y1):
+        si0, sj0 = self.getSubCell(x0, y0)
+        si1, sj1 = self.getSubCell(x1, y1)
+        si0 = int(max(si0, 0))
+        sj0 = int(max(sj0, 0))
+        si1 = int(min(si1, self.numSub - 1))
+        sj1 = int(min(sj1, self.numSub - 1))
+        if(si0 > si1 or sj0 > sj1):
+            return np.zeros((0, 3, 3))
+        si, sj = np.meshgrid(np.arange(si0, si1 + 1), np.arange(sj0, sj1 + 1), indexing='ij')
+        si = si.ravel()
+        sj = sj.ravel()
+        xa = self.origin + si * self.subSize
+        ya = self.origin + sj * self.subSize
+        xb = xa + self.subSize
+        yb = ya + self.subSize
+        corners = []
+        for cx, cy in [(xa, ya), (xb, ya), (xb, yb), (xa, yb)]:
+            h, _, _ = self.evaluate(si, sj, cx, cy)
+            corners.append(np.stack([cx, cy, h], axis=-1))
+        # Split along the diagonal that folded corners bend on: the one
+        # through the cell center side corner of the sub-cell
+        a = si % 4
+        b = sj % 4
+        diag02 = ((a >= 2) == (b >= 2))
+        t1 = np.where(diag02[:, None, None],
+            np.stack([corners[0], corners[1], corners[2]], axis=1),
+            np.stack([corners[0], corners[1], corners[3]], axis=1))
+        t2 = np.where(diag02[:, None, None],
+            np.stack([corners[0], corners[2], corners[3]], axis=1),
+            np.stack([corners[1], corners[2], corners[3]], axis=1))
+        triangles = [t1, t2]
+
+        # Walls on the cell borders inside the rectangle
+        for axis in range(2):
+            mask = ((si if axis == 0 else sj) % 4 == 3)
+            mask &= ((si if axis == 0 else sj) < self.numSub - 1)
+            if not mask.any():
+                continue
+            ai = si[mask]
+            aj = sj[mask]
+            ni = ai + (1 if axis == 0 else 0)
+            nj = aj + (0 if axis == 0 else 1)
+            if axis == 0:
+                ex = self.origin + ni * self.subSize
+                px0, py0, px1, py1 = ex, self.origin + aj * self.subSize, ex, self.origin + (aj + 1) * self.subSize
+            else:
+                ey = self.origin + nj * self.subSize
+                px0, py0, px1, py1 = self.origin + ai * self.subSize, ey, self.origin + (ai + 1) * self.subSize, ey
+            hA0, _, _ = self.evaluate(ai, aj, px0, py0)
+            hA1, _, _ = self.evaluate(ai, aj, px1, py1)
+            hB0, _, _ = self.evaluate(ni, nj, px0, py0)
+            hB1, _, _ = self.evaluate(ni, nj, px1, py1)
+            diff = (np.abs(hA0 - hB0) > 1e-6) | (np.abs(hA1 - hB1) > 1e-6)
+            if not diff.any():
+                continue
+            pA0 = np.stack([px0, py0, hA0], axis=-1)[diff]
+            pA1 = np.stack([px1, py1, hA1], axis=-1)[diff]
+            pB0 = np.stack([px0, py0, hB0], axis=-1)[diff]
+            pB1 = np.stack([px1, py1, hB1], axis=-1)[diff]
+            triangles.append(np.stack([pA0, pA1, pB1], axis=1))
+            triangles.append(np.stack([pA0, pB1, pB0], axis=1))
+        return np.concatenate(triangles, axis=0)
+
+    # Closest points on the triangles (M,3,3) to the point p (3,)
+    def closestPointsOnTriangles(self, p, tris):
+        a = tris[:, 0]
+        b = tris[:, 1]
+        c = tris[:, 2]
+        ab = b - a
+        ac = c - a
+        ap = p - a
+        d1 = np.einsum('ij,ij->i', ab, ap)
+        d2 = np.einsum('ij,ij->i', ac, ap)
+        bp = p - b
+        d3 = np.einsum('ij,ij->i', ab, bp)
+        d4 = np.einsum('ij,ij->i', ac, bp)
+        cp = p - c
+        d5 = np.einsum('ij,ij->i', ab, cp)
+        d6 = np.einsum('ij,ij->i', ac, cp)
+        va = d3 * d6 - d5 * d4
+        vb = d5 * d2 - d1 * d6
+        vc = d1 * d4 - d3 * d2
+
+        denom = va + vb + vc
+        safe = np.where(np.abs(denom) > 1e-18, denom, 1.0)
+        v = vb / safe
+        w = vc / safe
+        result = a + ab * v[:, None] + ac * w[:, None]
+
+        def safeDiv(num, den):
+            return num / np.where(np.abs(den) > 1e-18, den, 1.0)
+
+        # Edge and vertex regions, from the last to the first so that the
+        # first matching case wins
+        bcRegion = (va <= 0) & ((d4 - d3) >= 0) & ((d5 - d6) >= 0)
+        tBC = safeDiv(d4 - d3, (d4 - d3) + (d5 - d6))
+        result = np.where(bcRegion[:, None], b + (c - b) * tBC[:, None], result)
+        acRegion = (vb <= 0) & (d2 >= 0) & (d6 <= 0)
+        tAC = safeDiv(d2, d2 - d6)
+        result = np.where(acRegion[:, None], a + ac * tAC[:, None], result)
+        cRegion = (d6 >= 0) & (d5 <= d6)
+        result = np.where(cRegion[:, None], c, result)
+        abRegion = (vc <= 0) & (d1 >= 0) & (d3 <= 0)
+        tAB = safeDiv(d1, d1 - d3)
+        result = np.where(abRegion[:, None], a + ab * tAB[:, None], result)
+        bRegion = (d3 >= 0) & (d4 <= d3)
+        result = np.where(bRegion[:, None], b, result)
+        aRegion = (d1 <= 0) & (d2 <= 0)
+        result = np.where(aRegion[:, None], a, result)
+        return result
+
+    # Signed distance from p to the terrain surface within the given reach,
+    # negative when p is inside the solid. Returns (distance, closest point,
+    # normal pointing out of the solid) or None when nothing is in reach.
+    def __distance(self, p, reach, tris=None):
+        if tris is None:
+            tris = self.getTriangles(p[0] - reach, p[1] - reach, p[0] + reach, p[1] + reach)
+        if len(tris) == 0:
+            return None
+        closest = self.closestPointsOnTriangles(p, tris)
+        dist = np.linalg.norm(closest - p, axis=1)
+        k = int(np.argmin(dist))
+        dk = float(dist[k])
+        h = self.getHeightAt(p[0], p[1])
+        inside = h is not None and p[2] < h
+        if dk > 1e-9:
+            normal = (p - closest[k]) / dk
+        else:
+            tri = tris[k]
+            normal = np.cross(tri[1] - tri[0], tri[2] - tri[0])
+            normal = normal / max(np.linalg.norm(normal), 1e-12)
+        if inside:
+            return -dk, closest[k], -normal
+        return dk, closest[k], normal
+
+    # Sphere overlap: returns (penetration depth, push out normal as
+    # LVector3f, contact point as LPoint3f) or None when not touching
+    def sphereContact(self, center, radius):
+        p = np.array([center.getX(), center.getY(), center.getZ()])
+        result = self.__distance(p, radius)
+        if result is None or result[0] >= radius:
+            return None
+        dist, closest, normal = result
+        return radius - dist, LVector3f(*normal), LPoint3f(*closest)
+
+    # Swept capsule with axis p0-p1 and radius, moved by displacement.
+    # Conservative advancement of spheres spread along the axis. Returns
+    # (fraction of the displacement before contact, normal) or None when the
+    # whole move is free.
+    def sweepCapsule(self, p0, p1, radius, displacement, tolerance=1e-3, maxSteps=32):
+        a = np.array([p0.getX(), p0.getY(), p0.getZ()])
+        b = np.array([p1.getX(), p1.getY(), p1.getZ()])
+        m = np.array([displacement.getX(), displacement.getY(), displacement.getZ()])
+        moveLength = float(np.linalg.norm(m))
+        numSpheres = int(math.ceil(np.linalg.norm(b - a) / radius)) + 1
+        centers = a + (b - a) * np.linspace(0.0, 1.0, numSpheres)[:, None]
+
+        lo = np.minimum(centers.min(axis=0), centers.min(axis=0) + m) - radius
+        hi = np.maximum(centers.max(axis=0), centers.max(axis=0) + m) + radius
+        tris = self.getTriangles(lo[0], lo[1], hi[0], hi[1])
+        if len(tris) == 0:
+            return None
+
+        t = 0.0
+        for s in range(maxSteps):
+            best = None
+            for c in centers:
+                result = self.__distance(c + m * t, radius, tris)
+                if result is not None and (best is None or result[0] < best[0]):
+                    best = result
+            gap = best[0] - radius
+            if gap <= tolerance:
+                return t, LVector3f(*best[2])
+            if moveLength < 1e-12:
+                return None
+            t += gap / moveLength
+            if t >= 1.0:
+                return None
+        # Still grazing the surface, stop here rather than risk tunneling
+        return t, LVector3f(*best[2])
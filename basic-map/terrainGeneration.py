@@ -0,0 +1,367 @@
+from panda3d.core import StackedPerlinNoise2, PNMImage, Texture
+import math
+import time
+import numpy as np
+
+###############################################################################
+# Terrain generation pipeline
+#
+#   noise -> reshape -> island -> erosion, smoothing, terraces... -> quantize
+#
+# Stages transform a float field of world z heights indexed [i,j], as whole
+# array operations. The pipeline then quantizes the field into the kHeights
+# of a TerrainRegionMap. Expensive stages can run coarse to fine through a
+# MultiResolutionStage.
+
+# Dimensions of the field a stage works on
+class TerrainFieldInfo:
+
+    def __init__(self, size, cellDimension, heightStep, height):
+        self.size = size
+        self.cellDimension = cellDimension
+        self.heightStep = heightStep
+        self.height = height
+        # World z of the highest and lowest kHeight
+        self.maxZ = height * heightStep
+
+    # Same terrain sampled with cells factor times larger
+    def downsampled(self, factor):
+        return TerrainFieldInfo(self.size // factor, self.cellDimension * factor, self.heightStep, self.height)
+
+# Block mean of factor x factor cells, the size is a multiple of factor
+def DownsampleField(field, factor):
+    if factor == 1:
+        return field.copy()
+    n = field.shape[0] // factor
+    return field.reshape(n, factor, n, factor).mean(axis=(1, 3), dtype=np.float32)
+
+# Bilinear upsampling by factor, cell centers aligned with DownsampleField
+def UpsampleField(field, factor):
+    if factor == 1:
+        return field.copy()
+    n = field.shape[0]
+    pos = np.clip((np.arange(n * factor, dtype=np.float32) + 0.5) / factor - 0.5, 0.0, n - 1)
+    i0 = np.minimum(pos.astype(np.int32), n - 2) if n > 1 else np.zeros(len(pos), dtype=np.int32)
+    w = (pos - i0)[:, None] if n > 1 else np.zeros((len(pos), 1), dtype=np.float32)
+    i1 = np.minimum(i0 + 1, n - 1)
+    rows = field[i0, :] * (1.0 - w) + field[i1, :] * w
+    return (rows[:, i0] * (1.0 - w.T) + rows[:, i1] * w.T).astype(np.float32)
+
+# Transfer of amount across the i and j borders of a field: amounts are
+# (ip, in, jp, jn) outflows from (i,j) to (i+1,j), (i+1,j) to (i,j), (i,j) to
+# (i,j+1) and (i,j+1) to (i,j)
+def ApplyBorderFlows(field, flowIP, flowIN, flowJP, flowJN):
+    field[:-1, :] -= flowIP
+    field[1:, :] += flowIP
+    field[1:, :] -= flowIN
+    field[:-1, :] += flowIN
+    field[:, :-1] -= flowJP
+    field[:, 1:] += flowJP
+    field[:, 1:] -= flowJN
+    field[:, :-1] += flowJN
+
+# The original generation kept the heights in an 8 bit gray image between
+# its steps. The noise, reshape and island stages store and read back the
+# same gray levels, in float64 between, so that the basic pipeline gives the
+# same heights.
+GrayMaxValue = 255
+
+# [0,1] gray levels of a field, and back
+def FieldToGray(field, info):
+    return (np.asarray(field, dtype=np.float64) / info.maxZ + 1.0) / 2.0
+
+def GrayToField(gray, info):
+    return (gray * 2.0 - 1.0) * info.maxZ
+
+# Gray levels written to and read from a PNMImage, in float32 like it
+def QuantizeGray(gray):
+    gray = np.clip(np.asarray(gray, dtype=np.float32), 0.0, 1.0)
+    levels = np.floor(gray * np.float32(GrayMaxValue) + np.float32(0.5))
+    return levels.astype(np.float32) * np.float32(1.0 / GrayMaxValue)
+
+###############################################################################
+# Stages
+
+# Stacked Perlin noise, heights over the whole range
+class NoiseStage:
+    name = "noise"
+
+    def __init__(self, octaves=8, seed=0):
+        self.octaves = octaves
+        # 0 picks a random seed
+        self.seed = seed
+
+    def apply(self, field, info):
+        size = info.size
+        scale = 0.5 * 64 / size
+        stackedNoise = StackedPerlinNoise2(scale, scale, self.octaves, 2, 0.5, size, self.seed)
+        noiseImage = PNMImage(size, size, 1, GrayMaxValue)
+        noiseImage.perlinNoiseFill(stackedNoise)
+        # Texture ram images are bottom to top rows of x
+        texture = Texture()
+        texture.load(noiseImage)
+        levels = np.frombuffer(memoryview(texture.getRamImage()), dtype=np.uint8).reshape(size, size)
+        gray = levels[::-1, :].T.astype(np.float32) * np.float32(1.0 / GrayMaxValue)
+        return GrayToField(gray.astype(np.float64), info)
+
+# More land than water, spiky mountains and flat plains
+class ReshapeStage:
+    name = "reshape"
+
+    def apply(self, field, info):
+        r = (FieldToGray(field, info) - 0.25) / 0.75
+        np.copyto(r, np.power(r, 3.0), where=r > 0)
+        return GrayToField(QuantizeGray((r + 1.0) / 2.0).astype(np.float64), info)
+
+# Sink the border ring under the sea
+class IslandStage:
+    name = "island"
+
+    def __init__(self, borderRatio=0.25, floor=-0.5):
+        self.borderRatio = borderRatio
+        # Lowest sea floor, relative to the height range
+        self.floor = floor
+
+    def apply(self, field, info):
+        size = field.shape[0]
+        border = self.borderRatio * size
+        k = np.arange(size)
+        edge = np.minimum(k, size - 1 - k)
+        distToEdge = np.minimum(edge[:, None], edge[None, :])
+        falloff = np.sqrt(np.minimum(distToEdge / border, 1.0))
+        # On the [0,1] gray levels of the noise image
+        gray = FieldToGray(field, info)
+        floorGray = (self.floor + 1.0) / 2.0
+        gray = np.where(distToEdge < border, np.maximum(gray * falloff, floorGray), gray)
+        return GrayToField(QuantizeGray(gray).astype(np.float64), info)
+
+# Rain carving valleys: water flows down the surface, picks up sediment in
+# proportion to its flow and the slope, and drops it where it slows down.
+# Water and sediment leave the map at its border.
+class HydraulicErosionStage:
+    name = "hydraulic erosion"
+
+    def __init__(self, iterations=40, rainRate=0.02, flowRate=0.5, capacity=2.0,
+                 erosionRate=0.3, depositionRate=0.3, evaporation=0.05, minSlope=0.02):
+        self.iterations = iterations
+        self.rainRate = rainRate
+        self.flowRate = flowRate
+        self.capacity = capacity
+        self.erosionRate = erosionRate
+        self.depositionRate = depositionRate
+        self.evaporation = evaporation
+        self.minSlope = minSlope
+
+    def apply(self, field, info):
+        z = field.astype(np.float32)
+        water = np.zeros_like(z)
+        sediment = np.zeros_like(z)
+        scale = np.ones_like(z)
+        totalFlow = np.zeros_like(z)
+        # Rain and erosion amounts are per world area, scaled to the cell size
+        rain = self.rainRate * info.cellDimension / 2.0
+        for iteration in range(self.iterations):
+            water += rain
+            surface = z + water
+            di = surface[:-1, :] - surface[1:, :]
+            dj = surface[:, :-1] - surface[:, 1:]
+            flowIP = np.maximum(di, 0.0) * self.flowRate
+            flowIN = np.maximum(-di, 0.0) * self.flowRate
+            flowJP = np.maximum(dj, 0.0) * self.flowRate
+            flowJN = np.maximum(-dj, 0.0) * self.flowRate
+
+            # Outflows limited by the water in the cell
+            totalFlow.fill(0.0)
+            totalFlow[:-1, :] += flowIP
+            totalFlow[1:, :] += flowIN
+            totalFlow[:, :-1] += flowJP
+            totalFlow[:, 1:] += flowJN
+            scale.fill(1.0)
+            np.divide(water, totalFlow, out=scale, where=totalFlow > water)
+            flowIP *= scale[:-1, :]
+            flowIN *= scale[1:, :]
+            flowJP *= scale[:, :-1]
+            flowJN *= scale[:, 1:]
+            totalFlow *= scale
+
+            # Sediment follows the water that leaves the cell
+            carried = np.divide(sediment, water, out=np.zeros_like(z), where=water > 1e-6)
+            ApplyBorderFlows(sediment, flowIP * carried[:-1, :], flowIN * carried[1:, :],
+                             flowJP * carried[:, :-1], flowJN * carried[:, 1:])
+            ApplyBorderFlows(water, flowIP, flowIN, flowJP, flowJN)
+            np.maximum(water, 0.0, out=water)
+            np.maximum(sediment, 0.0, out=sediment)
+
+            # Erode under capacity, deposit over it
+            gi, gj = np.gradient(z, info.cellDimension)
+            slope = np.maximum(np.sqrt(gi * gi + gj * gj), self.minSlope)
+            difference = self.capacity * totalFlow * slope - sediment
+            change = np.where(difference > 0, self.erosionRate * difference, self.depositionRate * difference)
+            # Never dig more than the slope to the neighbors
+            np.minimum(change, slope * info.cellDimension * 0.5, out=change)
+            z -= change
+            sediment += change
+
+            water *= 1.0 - self.evaporation
+            for border in (water, sediment):
+                border[0, :] = 0.0
+                border[-1, :] = 0.0
+                border[:, 0] = 0.0
+                border[:, -1] = 0.0
+        # Sediment still in suspension settles
+        return z + sediment
+
+# Slopes steeper than the talus angle slide down to their lower neighbors
+class ThermalErosionStage:
+    name = "thermal erosion"
+
+    def __init__(self, iterations=10, talusSlope=0.8, rate=0.5):
+        self.iterations = iterations
+        self.talusSlope = talusSlope
+        self.rate = rate
+
+    def apply(self, field, info):
+        z = field.astype(np.float32)
+        talus = self.talusSlope * info.cellDimension
+        # Four neighbors share the moved material
+        rate = self.rate / 4.0
+        for iteration in range(self.iterations):
+            di = z[:-1, :] - z[1:, :]
+            dj = z[:, :-1] - z[:, 1:]
+            ApplyBorderFlows(z,
+                np.maximum(di - talus, 0.0) * rate, np.maximum(-di - talus, 0.0) * rate,
+                np.maximum(dj - talus, 0.0) * rate, np.maximum(-dj - talus, 0.0) * rate)
+        return z
+
+# Blend towards the 3x3 mean
+class SmoothStage:
+    name = "smoothing"
+
+    def __init__(self, iterations=1, strength=0.5):
+        self.iterations = iterations
+        self.strength = strength
+
+    def apply(self, field, info):
+        z = field.astype(np.float32)
+        for iteration in range(self.iterations):
+            padded = np.pad(z, 1, mode='edge')
+            rows = padded[:-2, :] + padded[1:-1, :] + padded[2:, :]
+            mean = (rows[:, :-2] + rows[:, 1:-1] + rows[:, 2:]) / 9.0
+            z += self.strength * (mean - z)
+        return z
+
+# Flatten the land into steps, sharpness 0 keeps the slopes, 1 makes flat
+# terraces with vertical risers
+class TerraceStage:
+    name = "terraces"
+
+    def __init__(self, stepHeights=4, sharpness=0.6, minZ=0.0):
+        # Terrace height in height steps
+        self.stepHeights = stepHeights
+        self.sharpness = sharpness
+        self.minZ = minZ
+
+    def apply(self, field, info):
+        step = self.stepHeights * info.heightStep
+        t = (field - self.minZ) / step
+        level = np.floor(t)
+        exponent = 1.0 / max(1.0 - self.sharpness, 1e-3)
+        terraced = self.minZ + (level + (t - level) ** exponent) * step
+        return np.where(field > self.minZ, terraced, field).astype(np.float32)
+
+# Run a stage coarse to fine: at each level the current field is averaged
+# down, the stage runs on it and the change it made is upsampled back.
+# Finer levels run fewer iterations of stages that have some.
+#
+#   coarsest  [ ]  -> stage -> delta --+
+#   finer    [   ] -> stage -> delta --+--> field + sum of upsampled deltas
+#   finest  [     ]-> stage -> delta --+
+class MultiResolutionStage:
+
+    def __init__(self, stage, coarsestSize=128, finestFactor=2):
+        self.stage = stage
+        self.coarsestSize = coarsestSize
+        self.finestFactor = finestFactor
+        self.name = "{0} (1/{1})".format(stage.name, finestFactor)
+
+    def getFactors(self, size):
+        factors = []
+        factor = max(size // self.coarsestSize, self.finestFactor, 1)
+        while factor >= max(self.finestFactor, 1):
+            factors.append(factor)
+            factor //= 2
+        return factors
+
+    def apply(self, field, info):
+        factors = self.getFactors(field.shape[0])
+        iterations = getattr(self.stage, "iterations", None)
+        result = field.astype(np.float32)
+        for level, factor in enumerate(factors):
+            if iterations is not None:
+                self.stage.iterations = max(iterations >> level, 1)
+            coarse = DownsampleField(result, factor)
+            changed = self.stage.apply(coarse.copy(), info.downsampled(factor))
+            result += UpsampleField(changed - coarse, factor)
+        if iterations is not None:
+            self.stage.iterations = iterations
+        return result
+
+###############################################################################
+# Ordered stages, with the time spent in each for the last run
+class TerrainPipeline:
+
+    def __init__(self, stages=None):
+        self.stages = [] if stages is None else list(stages)
+        self.timings = []
+
+    def add(self, stage):
+        self.stages.append(stage)
+        return self
+
+    # Seed of the random stages, 0 picks a random seed
+    def setSeed(self, seed):
+        for stage in self.stages:
+            if hasattr(stage, "seed"):
+                stage.seed = seed
+
+    def getTotalTime(self):
+        return sum(seconds for _, seconds in self.timings)
+
+    # One "stage: time" line per stage
+    def formatTimings(self):
+        return ["{0}: {1:.0f} ms".format(name, seconds * 1000.0) for name, seconds in self.timings]
+
+    def run(self, info, field=None):
+        self.timings = []
+        for stage in self.stages:
+            start = time.perf_counter()
+            field = stage.apply(field, info)
+            self.timings.append((stage.name, time.perf_counter() - start))
+        return field
+
+    # Generate the kHeights and water of the region
+    def fill(self, terrainRegionMap):
+        trm = terrainRegionMap
+        info = TerrainFieldInfo(trm.size, trm.cellDimension, trm.heightStep, trm.height)
+        field = self.run(info)
+
+        start = time.perf_counter()
+        # Halves round to even, as the original round()
+        kHeights = np.rint(np.asarray(field, dtype=np.float64) / trm.heightStep)
+        kHeights = np.clip(kHeights, -trm.height, trm.height).astype(np.int32)
+        trm.heightMap = kHeights.tolist()
+        trm.waterMap = (kHeights < 0).tolist()
+        trm.maxKHeight = max(int(kHeights.max()), -trm.height)
+        self.timings.append(("quantize", time.perf_counter() - start))
+
+    # The original generation: noise, reshape and island
+    def makeBasic(seed=0):
+        return TerrainPipeline([NoiseStage(seed=seed), ReshapeStage(), IslandStage()])
+
+    # Basic terrain weathered by rain and slides, erosion runs coarse to fine
+    def makeEroded(seed=0):
+        pipeline = TerrainPipeline.makeBasic(seed)
+        pipeline.add(MultiResolutionStage(HydraulicErosionStage()))
+        pipeline.add(MultiResolutionStage(ThermalErosionStage()))
+        pipeline.add(SmoothStage())
+        return pipeline
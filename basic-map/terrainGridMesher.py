@@ -0,0 +1,417 @@
+import argparse
+import math
+import numpy as np
+
+from terrainMap import TerrainRegionMap
+from meshing import Mesh, FaceBuffer
+from navigation import Heading
+
+###############################################################################
+# Whole grid terrain meshing
+#
+# Builds the same faces as CellShape2.addFaces for a block of cells at once:
+#  1. rises to the 8 neighbours of every cell from shifted height arrays
+#  2. side and corner components classified into integer codes
+#  3. faces counted per cell slot, the prefix sums give every face its place
+#     in cell order, as the cell mesher would append it
+#  4. vertices of each class emitted with broadcasting into the output arrays
+#  5. normals, materials and triangles computed over all faces
+#
+# Arithmetic follows CellShape2 operation by operation in double precision,
+# the float32 output is identical to the cell mesher.
+#
+#   cell slots: 0 center, 1-4 sides, 5-8 corners
+class TerrainGridMesher:
+
+    SideHeadings = ["xn", "yn", "yp", "xp"]
+    CornerHeadings = ["xnyn", "xpyn", "xpyp", "xnyp"]
+    NumSlots = 9
+
+    # Component classes
+    Flat = 0
+    Tapered = 1
+    TaperedX = 1
+    TaperedY = 2
+    Folded = 3
+
+    Up = (0.0, 0.0, 1.0)
+    North = (0.0, 1.0, 0.0)
+
+    def __init__(self, terrainRegionMap, textureScheme):
+        self.heightMap = terrainRegionMap
+        self.textureScheme = textureScheme
+        self.radius = terrainRegionMap.cellDimension / 2.0
+        self.centerRadius = self.radius / 2.0
+        self.stepHeight = terrainRegionMap.heightStep
+        self.maxHeight = terrainRegionMap.height * terrainRegionMap.heightStep
+
+    # Heights of the cells [i0-1,i1+1[ x [j0-1,j1+1[ and whether they are in
+    # the map, outside cells get the height of their inner neighbour
+    def getHeightBlock(self, i0, j0, i1, j1):
+        trm = self.heightMap
+        bi0 = max(i0 - 1, 0)
+        bj0 = max(j0 - 1, 0)
+        bi1 = min(i1 + 1, trm.size)
+        bj1 = min(j1 + 1, trm.size)
+        block = np.array([row[bj0:bj1] for row in trm.heightMap[bi0:bi1]], dtype=np.int64).reshape(bi1 - bi0, bj1 - bj0)
+        padding = ((bi0 - (i0 - 1), i1 + 1 - bi1), (bj0 - (j0 - 1), j1 + 1 - bj1))
+        valid = np.pad(np.ones(block.shape, dtype=bool), padding, mode='constant', constant_values=False)
+        return np.pad(block, padding, mode='edge'), valid
+
+    # Rise to the neighbour in each heading, 0 outside the map, (n, m) arrays
+    def getRises(self, kBlock, valid):
+        n = kBlock.shape[0] - 2
+        m = kBlock.shape[1] - 2
+        kHeights = kBlock[1:n+1, 1:m+1]
+        rises = {}
+        for heading in Heading.AllSides:
+            direction = Heading.getDirection2i(heading)
+            di = direction.getX()
+            dj = direction.getY()
+            neighbor = kBlock[1+di:1+di+n, 1+dj:1+dj+m]
+            rises[heading] = np.where(valid[1+di:1+di+n, 1+dj:1+dj+m], neighbor - kHeights, 0)
+        return rises
+
+    # Mesh the terrain of the cells [i0,i1[ x [j0,j1[ into the face buffer
+    def addTerrainFaces(self, faces, i0, j0, i1, j1):
+        trm = self.heightMap
+        kBlock, valid = self.getHeightBlock(i0, j0, i1, j1)
+        rises = self.getRises(kBlock, valid)
+        numCells = (i1 - i0) * (j1 - j0)
+        if numCells == 0:
+            return
+
+        # Cells in i major order, as meshed by TerrainMesher
+        ii, jj = np.meshgrid(np.arange(i0, i1), np.arange(j0, j1), indexing='ij')
+        cx = (2 * ii.ravel() - trm.size).astype(np.float32).astype(np.float64)
+        cy = (2 * jj.ravel() - trm.size).astype(np.float32).astype(np.float64)
+        cz = (kBlock[1:-1, 1:-1].ravel() * trm.heightStep).astype(np.float32).astype(np.float64)
+        rises = {heading: rise.ravel() for heading, rise in rises.items()}
+
+        # Classification
+        sideRises = [rises[heading] for heading in TerrainGridMesher.SideHeadings]
+        sideClass = [np.where(rise > 0, TerrainGridMesher.Tapered, TerrainGridMesher.Flat) for rise in sideRises]
+        cornerClass = []
+        cornerFill = []
+        for heading in TerrainGridMesher.CornerHeadings:
+            crise = rises[heading]
+            xrise = rises[Heading.getAdjascentXHeading(heading)]
+            yrise = rises[Heading.getAdjascentYHeading(heading)]
+            code = np.full(numCells, TerrainGridMesher.Flat)
+            code[(xrise == 0) & (yrise == 0) & (crise > 0)] = TerrainGridMesher.Folded
+            code[(xrise > 0) & (yrise > 0)] = TerrainGridMesher.Folded
+            code[(xrise <= 0) & (yrise > 0)] = TerrainGridMesher.TaperedY
+            code[(xrise > 0) & (yrise <= 0)] = TerrainGridMesher.TaperedX
+            cornerClass.append(code)
+            # Side triangle when the cell in the non taper direction is lower
+            nonTaperRise = np.where(code == TerrainGridMesher.TaperedX, yrise, xrise)
+            cornerFill.append(((code == TerrainGridMesher.TaperedX) | (code == TerrainGridMesher.TaperedY)) &
+                              ((nonTaperRise < 0) | ((nonTaperRise == 0) & (crise < 0))))
+
+        # Faces and vertices per slot, then the first of each slot
+        slotFaces = np.empty((numCells, TerrainGridMesher.NumSlots), dtype=np.int64)
+        slotVerts = np.empty((numCells, TerrainGridMesher.NumSlots), dtype=np.int64)
+        slotFaces[:, 0] = 1
+        slotVerts[:, 0] = 4
+        for s in range(4):
+            slotFaces[:, 1+s] = np.where(sideClass[s] == TerrainGridMesher.Tapered, sideRises[s], 1)
+            slotVerts[:, 1+s] = 4 * slotFaces[:, 1+s]
+        for c in range(4):
+            folded = cornerClass[c] == TerrainGridMesher.Folded
+            slotFaces[:, 5+c] = np.where(folded, 2, 1 + cornerFill[c])
+            slotVerts[:, 5+c] = np.where(folded, 6, 4 + 3 * cornerFill[c])
+        totalFaces = int(slotFaces.sum())
+        totalVerts = int(slotVerts.sum())
+        slotFirstFace = (np.cumsum(slotFaces.ravel()) - slotFaces.ravel()).reshape(numCells, TerrainGridMesher.NumSlots)
+        slotFirstVert = (np.cumsum(slotVerts.ravel()) - slotVerts.ravel()).reshape(numCells, TerrainGridMesher.NumSlots)
+
+        out = FaceArrays(totalFaces, totalVerts)
+        radius = self.radius
+        centerRadius = self.centerRadius
+        stepHeight = self.stepHeight
+        invSqrt2 = 1.0 / math.sqrt(2.0)
+        midRadius = (radius+centerRadius) / 2.0
+        ringHalfWitdh = (radius-centerRadius) / 2.0
+        ringHalfWitdhDiag = (radius-centerRadius) / 2.0 * math.sqrt(2.0)
+        up = TerrainGridMesher.Up
+        north = TerrainGridMesher.North
+
+        everyCell = np.ones(numCells, dtype=bool)
+        out.addSquareFaces(everyCell, slotFirstFace[:, 0], slotFirstVert[:, 0], (cx, cy, cz), up, north, centerRadius, centerRadius)
+
+        for s, heading in enumerate(TerrainGridMesher.SideHeadings):
+            direction = Heading.getDirection2i(heading)
+            hx = float(direction.getX())
+            hy = float(direction.getY())
+            mx = cx + hx * midRadius
+            my = cy + hy * midRadius
+            firstFace = slotFirstFace[:, 1+s]
+            firstVert = slotFirstVert[:, 1+s]
+            flat = sideClass[s] == TerrainGridMesher.Flat
+            out.addSquareFaces(flat, firstFace, firstVert, (mx, my, cz), up, (hx, hy, 0.0), centerRadius, ringHalfWitdh)
+            tapered = ~flat
+            out.addSquareFaces(tapered, firstFace, firstVert, (mx, my, cz + stepHeight / 2.0),
+                               (-hx * invSqrt2, -hy * invSqrt2, invSqrt2), (hx * invSqrt2, hy * invSqrt2, invSqrt2),
+                               centerRadius, ringHalfWitdhDiag)
+            # Vertical for further rise
+            maxRise = int(sideRises[s].max())
+            for lvl in range(1, maxRise):
+                wall = sideRises[s] > lvl
+                out.addSquareFaces(wall, firstFace + lvl, firstVert + 4 * lvl,
+                                   (cx + hx * radius, cy + hy * radius, cz + stepHeight * (2.0 * lvl + 1.0) / 2.0),
+                                   (-hx, -hy, 0.0), up, radius, ringHalfWitdh)
+
+        for c, heading in enumerate(TerrainGridMesher.CornerHeadings):
+            direction = Heading.getDirection2i(heading)
+            xSign = float(direction.getX())
+            ySign = float(direction.getY())
+            mx = cx + xSign * midRadius
+            my = cy + ySign * midRadius
+            firstFace = slotFirstFace[:, 5+c]
+            firstVert = slotFirstVert[:, 5+c]
+            code = cornerClass[c]
+            out.addSquareFaces(code == TerrainGridMesher.Flat, firstFace, firstVert, (mx, my, cz), up, north,
+                               ringHalfWitdh, ringHalfWitdh)
+
+            for taper in (TerrainGridMesher.TaperedX, TerrainGridMesher.TaperedY):
+                tx, ty = (xSign, 0.0) if taper == TerrainGridMesher.TaperedX else (0.0, ySign)
+                tapered = code == taper
+                out.addSquareFaces(tapered, firstFace, firstVert, (mx, my, cz + stepHeight / 2.0),
+                                   (-tx * invSqrt2, -ty * invSqrt2, invSqrt2), (tx * invSqrt2, ty * invSqrt2, invSqrt2),
+                                   ringHalfWitdh, ringHalfWitdhDiag)
+                fill = tapered & cornerFill[c]
+                vcorner = (cx + radius * xSign, cy + radius * ySign, cz)
+                vin = (vcorner[0] - tx * (radius - centerRadius), vcorner[1] - ty * (radius - centerRadius), cz)
+                vup = (vcorner[0], vcorner[1], cz + stepHeight)
+                ratio = math.dist((radius, 0.0, 0.0), (centerRadius, 0.0, 0.0)) / math.sqrt(2.0) / 1.0
+                # Winding from the sign of the non taper to taper direction angle
+                if((xSign - tx) * ty - (ySign - ty) * tx > 0):
+                    out.addTriangles(fill, firstFace + 1, firstVert + 4, (vin, vcorner, vup), ratio)
+                else:
+                    out.addTriangles(fill, firstFace + 1, firstVert + 4, (vcorner, vin, vup), ratio)
+
+            folded = code == TerrainGridMesher.Folded
+            crise = rises[heading]
+            xrise = rises[Heading.getAdjascentXHeading(heading)]
+            yrise = rises[Heading.getAdjascentYHeading(heading)]
+            maxrise = np.maximum(np.maximum(crise, xrise), yrise)
+            vin = (cx + centerRadius * xSign, cy + centerRadius * ySign, cz)
+            vcout = (cx + radius * xSign, cy + radius * ySign, cz + np.minimum(maxrise, 1) * stepHeight)
+            vxout = (cx + radius * xSign, cy + centerRadius * ySign, cz + np.minimum(xrise, 1) * stepHeight)
+            vyout = (cx + centerRadius * xSign, cy + radius * ySign, cz + np.minimum(yrise, 1) * stepHeight)
+            if(xSign * ySign > 0):
+                quad = (vin, vxout, vcout, vyout)
+                sideRise = xrise
+                ratios = [math.dist((radius * xSign, centerRadius * ySign, dz), (centerRadius * xSign, centerRadius * ySign, 0.0))
+                          for dz in (0.0, stepHeight)]
+            else:
+                quad = (vin, vyout, vcout, vxout)
+                sideRise = yrise
+                ratios = [math.dist((centerRadius * xSign, radius * ySign, dz), (centerRadius * xSign, centerRadius * ySign, 0.0))
+                          for dz in (0.0, stepHeight)]
+            ratio = np.where(np.minimum(sideRise, 1) > 0, ratios[1], ratios[0]) / math.sqrt(2.0) / 1.0
+            out.addNonPlanarSquares(folded, firstFace, firstVert, quad, ratio)
+
+        out.endFaces()
+        out.setMaterials(self.textureScheme, self.maxHeight)
+        faces.extendArrays(out.verts, out.normals, out.colors, out.texCoords, out.getIndices(), out.faceStarts)
+
+    # Water surface of the wet cells of [i0,i1[ x [j0,j1[
+    def addWaterFaces(self, faces, i0, j0, i1, j1):
+        trm = self.heightMap
+        wet = np.array([row[j0:j1] for row in trm.waterMap[i0:i1]], dtype=bool).reshape(i1 - i0, j1 - j0)
+        ii, jj = np.nonzero(wet)
+        numFaces = len(ii)
+        if numFaces == 0:
+            return
+        ii += i0
+        jj += j0
+        cx = (2 * ii - trm.size).astype(np.float32).astype(np.float64)
+        cy = (2 * jj - trm.size).astype(np.float32).astype(np.float64)
+        cz = trm.waterLevelMap[ii, jj].astype(np.float64)
+        out = FaceArrays(numFaces, 4 * numFaces)
+        first = np.arange(numFaces)
+        out.addSquareFaces(np.ones(numFaces, dtype=bool), first, 4 * first, (cx, cy, cz),
+                           TerrainGridMesher.Up, TerrainGridMesher.North, 1.0, 1.0)
+        out.endFaces()
+        out.colors[:, 3] = 0.85
+        out.setMaterial(self.textureScheme.uvMap, "clearwater")
+        faces.extendArrays(out.verts, out.normals, out.colors, out.texCoords, out.getIndices(), out.faceStarts)
+
+###############################################################################
+# Preallocated face arrays filled by class, in the FaceBuffer layout
+class FaceArrays:
+
+    def __init__(self, numFaces, numVerts):
+        self.verts64 = np.empty((numVerts, 3), dtype=np.float64)
+        self.texCoords = np.empty((numVerts, 2), dtype=np.float32)
+        self.faceStarts = np.empty(numFaces, dtype=np.int64)
+        self.faceSizes = np.empty(numFaces, dtype=np.int64)
+        self.verts = None
+        self.normals = None
+        self.colors = None
+
+    def __setVerts(self, firstVert, vertList):
+        for k, (x, y, z) in enumerate(vertList):
+            self.verts64[firstVert + k, 0] = x
+            self.verts64[firstVert + k, 1] = y
+            self.verts64[firstVert + k, 2] = z
+
+    def __setFaces(self, firstFace, firstVert, size):
+        self.faceStarts[firstFace] = firstVert
+        self.faceSizes[firstFace] = size
+
+    # Values per selected face: arrays are indexed, scalars kept
+    def __select(values, mask):
+        return tuple(v[mask] if isinstance(v, np.ndarray) else v for v in values)
+
+    # FaceBuffer.addSquareFace for the cells of the mask
+    def addSquareFaces(self, mask, firstFace, firstVert, center, normal, up, sideRadius, upRadius):
+        if not mask.any():
+            return
+        cx, cy, cz = FaceArrays.__select(center, mask)
+        nx, ny, nz = FaceArrays.__select(normal, mask)
+        ux, uy, uz = FaceArrays.__select(up, mask)
+        firstFace = firstFace[mask]
+        firstVert = firstVert[mask]
+        # side = up x normal
+        sx = (uy * nz - uz * ny) * sideRadius
+        sy = (uz * nx - ux * nz) * sideRadius
+        sz = (ux * ny - uy * nx) * sideRadius
+        ux = ux * upRadius
+        uy = uy * upRadius
+        uz = uz * upRadius
+        self.__setVerts(firstVert, [
+            (cx - sx - ux, cy - sy - uy, cz - sz - uz),
+            (cx + sx - ux, cy + sy - uy, cz + sz - uz),
+            (cx + sx + ux, cy + sy + uy, cz + sz + uz),
+            (cx - sx + ux, cy - sy + uy, cz - sz + uz)])
+        ratioSide = sideRadius / 1.0
+        ratioUp = upRadius / 1.0
+        for k, (u, v) in enumerate(((0.0, 0.0), (ratioSide, 0.0), (ratioSide, ratioUp), (0.0, ratioUp))):
+            self.texCoords[firstVert + k] = (u, v)
+        self.__setFaces(firstFace, firstVert, 4)
+
+    # FaceBuffer.addTriangle for the cells of the mask
+    def addTriangles(self, mask, firstFace, firstVert, triangle, ratio):
+        if not mask.any():
+            return
+        firstFace = firstFace[mask]
+        firstVert = firstVert[mask]
+        self.__setVerts(firstVert, [FaceArrays.__select(v, mask) for v in triangle])
+        for k, (u, v) in enumerate(((0.0, 0.0), (ratio, 0.0), (ratio, ratio))):
+            self.texCoords[firstVert + k] = (u, v)
+        self.__setFaces(firstFace, firstVert, 3)
+
+    # FaceBuffer.addNonPlanarSquare for the cells of the mask, ratio per cell
+    def addNonPlanarSquares(self, mask, firstFace, firstVert, quad, ratio):
+        if not mask.any():
+            return
+        firstFace = firstFace[mask]
+        firstVert = firstVert[mask]
+        v0, v1, v2, v3 = [FaceArrays.__select(v, mask) for v in quad]
+        ratio = ratio[mask].astype(np.float32)
+        zero = np.zeros_like(ratio)
+        self.__setVerts(firstVert, [v0, v1, v2, v0, v2, v3])
+        for k, (u, v) in enumerate(((zero, zero), (ratio, zero), (ratio, ratio), (zero, zero), (ratio, ratio), (zero, ratio))):
+            self.texCoords[firstVert + k, 0] = u
+            self.texCoords[firstVert + k, 1] = v
+        self.__setFaces(firstFace, firstVert, 3)
+        self.__setFaces(firstFace + 1, firstVert + 3, 3)
+
+    # Float32 vertices, then the normal of the first three vertices and
+    # white color for every face
+    def endFaces(self):
+        self.verts = self.verts64.astype(np.float32)
+        v = self.verts.astype(np.float64)
+        s = self.faceStarts
+        ax = v[s+1, 0] - v[s, 0]
+        ay = v[s+1, 1] - v[s, 1]
+        az = v[s+1, 2] - v[s, 2]
+        bx = v[s+2, 0] - v[s+1, 0]
+        by = v[s+2, 1] - v[s+1, 1]
+        bz = v[s+2, 2] - v[s+1, 2]
+        nx = ay * bz - az * by
+        ny = az * bx - ax * bz
+        nz = ax * by - ay * bx
+        length = np.sqrt(nx * nx + ny * ny + nz * nz)
+        safe = np.where(length > 0.0, length, 1.0)
+        normals = np.stack([nx / safe, ny / safe, nz / safe], axis=1)
+        self.normals = np.repeat(normals, self.faceSizes, axis=0).astype(np.float32)
+        self.colors = np.ones((len(self.verts), 4), dtype=np.float32)
+
+    # FaceBuffer.setFaceMaterial over the faces
+    def __mapTexCoords(self, ox, oy, scale):
+        tc = self.texCoords.astype(np.float64)
+        self.texCoords[:, 0] = np.repeat(ox, self.faceSizes) + tc[:, 0] * scale
+        self.texCoords[:, 1] = np.repeat(oy, self.faceSizes) + tc[:, 1] * scale
+
+    def setMaterial(self, textureUVMap, name):
+        offset = textureUVMap.materialOffset[name]
+        numFaces = len(self.faceStarts)
+        self.__mapTexCoords(np.full(numFaces, offset.getX()), np.full(numFaces, offset.getY()), textureUVMap.scale)
+
+    # Material of each face from the height of its centroid
+    def setMaterials(self, textureScheme, maxHeight):
+        z = self.verts[:, 2].astype(np.float64)
+        s = self.faceStarts
+        total = z[s] + z[s+1] + z[s+2]
+        quads = self.faceSizes == 4
+        total[quads] += z[s[quads]+3]
+        materials = textureScheme.getMaterialIndexArray(total / self.faceSizes, maxHeight)
+        uvMap = textureScheme.uvMap
+        offsets = [uvMap.materialOffset[name] for name in textureScheme.HeightMaterials]
+        ox = np.array([offset.getX() for offset in offsets], dtype=np.float64)
+        oy = np.array([offset.getY() for offset in offsets], dtype=np.float64)
+        self.__mapTexCoords(ox[materials], oy[materials], uvMap.scale)
+
+    # Fan triangles of every face
+    def getIndices(self):
+        numTriangles = self.faceSizes - 2
+        first = np.repeat(self.faceStarts, numTriangles)
+        k = np.arange(numTriangles.sum()) - np.repeat(np.cumsum(numTriangles) - numTriangles, numTriangles) + 1
+        return np.stack([first, first + k, first + k + 1], axis=1).ravel()
+
+# Mesh the region chunk by chunk with both meshers, returns the chunks whose
+# face buffers differ
+def compareWithCellMesher(terrainRegionMap, chunkSize=16, textureScheme=None):
+    # The terrain mesher uses this module
+    from terrainMesh import TerrainTextureScheme, TerrainCellMesher
+    trm = terrainRegionMap
+    if textureScheme is None:
+        textureScheme = TerrainTextureScheme()
+    cellMesher = TerrainCellMesher(trm, textureScheme)
+    gridMesher = TerrainGridMesher(trm, textureScheme)
+    mismatched = []
+    for i0 in range(0, trm.size, chunkSize):
+        for j0 in range(0, trm.size, chunkSize):
+            i1 = min(i0 + chunkSize, trm.size)
+            j1 = min(j0 + chunkSize, trm.size)
+            cellMesh = Mesh()
+            for i in range(i0, i1):
+                for j in range(j0, j1):
+                    cellMesher.meshCellTerrain(cellMesh, i, j)
+            for i in range(i0, i1):
+                for j in range(j0, j1):
+                    cellMesher.meshCellWater(cellMesh, i, j)
+            gridFaces = FaceBuffer()
+            gridMesher.addTerrainFaces(gridFaces, i0, j0, i1, j1)
+            gridMesher.addWaterFaces(gridFaces, i0, j0, i1, j1)
+            cellFaces = cellMesh.faces
+            if(cellFaces.numVerts != gridFaces.numVerts or
+               any(getattr(cellFaces, name) != getattr(gridFaces, name)
+                   for name in ("verts", "normals", "colors", "texCoords", "indices", "faceStarts"))):
+                mismatched.append((i0, j0))
+    return mismatched
+
+if __name__ == "__main__":
+    from terrainGeneration import TerrainPipeline
+    parser = argparse.ArgumentParser(description="Lightworld: grid mesher against the cell mesher")
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--height", type=int, default=18)
+    parser.add_argument("--seeds", type=int, nargs="+", default=[1, 2, 3])
+    options = parser.parse_args()
+    for seed in options.seeds:
+        trm = TerrainRegionMap(options.size, options.height)
+        TerrainPipeline.makeEroded(seed).fill(trm)
+        print("seed {0}: {1} differing chunks".format(seed, len(compareWithCellMesher(trm))))
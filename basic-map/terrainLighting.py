@@ -0,0 +1,137 @@
+from panda3d.core import LVector3f
+import math
+import numpy as np
+
+from meshing import getVertexColumnArray
+
+###############################################################################
+# Precomputed lighting baked into the terrain vertex colors
+#
+# Per cell, from the height map:
+#  - ambient occlusion: mean over the 8 headings of the sine of the horizon
+#    elevation seen from the cell center within a radius
+#  - sun visibility: how far the horizon towards the sun stays under it
+#
+#           sun
+#            \        horizon
+#             \    __---+
+#              \ _-     |
+#        +------X-------+
+#      cell   ---> heading, samples at 1..radius cells
+#
+# Vertices get the bilinear interpolation of the cell values at their xy.
+class TerrainLightBaker:
+
+    # (di, dj) steps of the horizon sampling
+    Headings = [(-1, 0), (-1, -1), (0, -1), (1, -1), (1, 0), (1, 1), (0, 1), (-1, 1)]
+
+    def __init__(self, terrainRegionMap, sunDirection=LVector3f(0.0, 0.0, 1.0), radius=6):
+        self.heightMap = terrainRegionMap
+        self.radius = radius
+        self.aoStrength = 0.9
+        self.shadowStrength = 0.6
+        # Horizon to sun elevation difference (as slope) of the soft shadow edge
+        self.penumbra = 0.15
+        self.setSunDirection(sunDirection)
+
+        # Statistics
+        self.numBaked = 0
+        self.numCacheHits = 0
+
+    # Direction pointing towards the sun. A sun straight overhead has no
+    # heading to sweep and casts no shadow, sunStep is then None.
+    def setSunDirection(self, sunDirection):
+        d = LVector3f(sunDirection)
+        d.normalize()
+        horizontal = math.sqrt(d.getX() * d.getX() + d.getY() * d.getY())
+        if(horizontal < 1e-6):
+            self.sunStep = None
+            self.sunSlope = math.inf
+            return
+        self.sunStep = (d.getX() / horizontal, d.getY() / horizontal)
+        self.sunSlope = d.getZ() / horizontal
+
+    # Light factor per cell over [i0-1,i1+1[ x [j0-1,j1+1[, vectorized over
+    # the block. Heights outside the map repeat the border.
+    def bakeCells(self, kHeights, i0, j0, i1, j1):
+        trm = self.heightMap
+        margin = self.radius + 1
+        li0 = i0 - margin
+        lj0 = j0 - margin
+        li1 = i1 + margin
+        lj1 = j1 + margin
+        block = kHeights[max(li0, 0):min(li1, trm.size), max(lj0, 0):min(lj1, trm.size)]
+        padding = ((max(-li0, 0), max(li1 - trm.size, 0)), (max(-lj0, 0), max(lj1 - trm.size, 0)))
+        padded = np.pad(block.astype(np.float32) * trm.heightStep, padding, mode='edge')
+        # Cells with their one cell ring, in padded coordinates
+        bi0 = self.radius
+        bj0 = self.radius
+        bi1 = padded.shape[0] - self.radius
+        bj1 = padded.shape[1] - self.radius
+        z = padded[bi0:bi1, bj0:bj1]
+
+        occlusion = np.zeros_like(z)
+        for di, dj in TerrainLightBaker.Headings:
+            horizon = np.zeros_like(z)
+            stepLength = trm.cellDimension * math.sqrt(di * di + dj * dj)
+            for r in range(1, self.radius + 1):
+                sample = padded[bi0+r*di:bi1+r*di, bj0+r*dj:bj1+r*dj]
+                np.maximum(horizon, (sample - z) / (r * stepLength), out=horizon)
+            occlusion += horizon / np.sqrt(1.0 + horizon * horizon)
+        ao = 1.0 - self.aoStrength * occlusion / len(TerrainLightBaker.Headings)
+
+        if self.sunStep is None:
+            return ao
+
+        # Horizon towards the sun, nearest cell sampling along the sun heading
+        sunHorizon = np.full_like(z, -np.inf)
+        ii, jj = np.meshgrid(np.arange(bi0, bi1), np.arange(bj0, bj1), indexing='ij')
+        su, sv = self.sunStep
+        stepLength = trm.cellDimension * math.sqrt(su * su + sv * sv)
+        for r in range(1, self.radius + 1):
+            si = np.clip(np.rint(ii + r * su).astype(np.int32), 0, padded.shape[0] - 1)
+            sj = np.clip(np.rint(jj + r * sv).astype(np.int32), 0, padded.shape[1] - 1)
+            np.maximum(sunHorizon, (padded[si, sj] - z) / (r * stepLength), out=sunHorizon)
+        sunVisibility = np.clip(0.5 + (self.sunSlope - sunHorizon) / self.penumbra, 0.0, 1.0)
+
+        return ao * (1.0 - self.shadowStrength * (1.0 - sunVisibility))
+
+    # Light factor of the chunk cells and their ring, reused while the heights
+    # that can influence them are unchanged
+    def getChunkLight(self, chunk, kHeights):
+        size = self.heightMap.size
+        reach = self.radius + 2
+        key = kHeights[max(chunk.i0-reach, 0):min(chunk.i1+reach, size), max(chunk.j0-reach, 0):min(chunk.j1+reach, size)].tobytes()
+        if(chunk.bakedLight is not None and chunk.bakedLight[0] == key):
+            self.numCacheHits += 1
+            return chunk.bakedLight[1]
+        light = self.bakeCells(kHeights, chunk.i0, chunk.j0, chunk.i1, chunk.j1)
+        chunk.bakedLight = (key, light)
+        self.numBaked += 1
+        return light
+
+    # Write the light of the chunk into the color column of the geom
+    def bakeGeom(self, chunk, kHeights, geom):
+        trm = self.heightMap
+        light = self.getChunkLight(chunk, kHeights)
+        vdata = geom.modifyVertexData()
+        verts = getVertexColumnArray(vdata, 'vertex')
+        colors = getVertexColumnArray(vdata, 'color')
+
+        # Continuous cell coordinates relative to the ring origin
+        u = (verts[:, 0] + trm.size) / trm.cellDimension - (chunk.i0 - 1)
+        v = (verts[:, 1] + trm.size) / trm.cellDimension - (chunk.j0 - 1)
+        u = np.clip(u, 0.0, light.shape[0] - 1.001)
+        v = np.clip(v, 0.0, light.shape[1] - 1.001)
+        ui = u.astype(np.int32)
+        vi = v.astype(np.int32)
+        fu = u - ui
+        fv = v - vi
+        shade = (light[ui, vi] * (1.0 - fu) * (1.0 - fv) + light[ui+1, vi] * fu * (1.0 - fv) +
+                 light[ui, vi+1] * (1.0 - fu) * fv + light[ui+1, vi+1] * fu * fv)
+
+        if(colors.dtype == np.float32):
+            colors[:, 0:3] = shade[:, None]
+        else:
+            # Alpha is the last byte of packed_dabc, keep it
+            colors[:, 0:3] = np.clip(shade * 255.0 + 0.5, 0, 255).astype(np.uint8)[:, None]
@@ -1,56 +1,15 @@
-from panda3d.core import StackedPerlinNoise2, PNMImage
 from panda3d.core import LVector3f, LVector3i, LVector2f, LVector2i
 import math
 from array import *
+import numpy as np
+
+from terrainGeneration import TerrainPipeline
 
 ###############################################################################
-# Procedural generation of the terrain
+# Procedural generation of the terrain: noise, reshaping and island falloff
  
 def FillTerrainMapBasic(terrainRegionMap):
-
-    trm = terrainRegionMap
-    
-    #Perlin Noise Base
-    scale = 0.5 * 64 / trm.size
-    stackedNoise = StackedPerlinNoise2(scale, scale, 8, 2, 0.5, trm.size, 0)
-    terrainImage = PNMImage(trm.size, trm.size, 1)
-    terrainImage.perlinNoiseFill(stackedNoise)
-
-    #Make it look a bit more natural
-    for i in range(trm.size):
-        for j in range(trm.size):
-            g = terrainImage.getGray(i,j)
-            # make between -0.5 and 1, more land than water
-            g = (g-0.25)/0.75
-            # make mountain more spiky and plains more flat
-            if g>0:
-                g = g ** 3
-            # return to 0.25 to 1 range
-            g = (g+1)/2
-            terrainImage.setGray(i,j,g)
-    
-    #Make it an island
-    border = 2 * trm.size / 8
-    for i in range(trm.size):
-        for j in range(trm.size):
-            distToEdge = min(i, trm.size-1-i, j, trm.size-1-j)
-            if(distToEdge < border):
-                g = terrainImage.getGray(i,j)
-                g = g * math.sqrt(distToEdge / border)
-                g = max(g, 0.25)
-                terrainImage.setGray(i,j,g)
-
-    # Convert to kHeight
-    # Height in integer increments between -self.height and  self.height
-    trm.maxKHeight = -trm.height
-    for i in range(trm.size):
-        for j in range(trm.size):
-            kHeight= round((terrainImage.getGray(i,j)-0.5)*trm.height*2)
-            trm.heightMap[i][j] = kHeight
-            if(kHeight < 0):
-                trm.waterMap[i][j] = True
-            if(kHeight > trm.maxKHeight):
-                trm.maxKHeight = kHeight
+    TerrainPipeline.makeBasic().fill(terrainRegionMap)
 
 ###############################################################################
 # Class holding all information about a terrain region
@@ -68,15 +27,27 @@ class TerrainRegionMap:
         self.heightMap = [[0 for i in range(self.size)] for j in range(self.size)]
         self.waterMap = [[False for i in range(self.size)] for j in range(self.size)]
         self.waterOffset = self.heightStep / 2.0
+        # Water surface z per cell, only meaningful where above the terrain
+        self.resetWaterLevels()
 
         # Statistics for the terrain data
         self.maxKHeight = 0.0
+
+        # Cell rectangles [i0,i1[ x [j0,j1[ changed by edits and not yet consumed
+        self.dirtyRects = []
     
     def isValid(self, i,j):
         return i >= 0 and i < self.size and j >= 0 and j < self.size
     
     def hasWater(self, i, j):
         return self.waterMap[i][j] == True
+
+    # Flat sea at -waterOffset everywhere
+    def resetWaterLevels(self):
+        self.waterLevelMap = np.full((self.size, self.size), -self.waterOffset, dtype=np.float32)
+
+    def getWaterZHeightFromIJ(self, i, j):
+        return float(self.waterLevelMap[i, j])
     
     def getKHeightFromZ(self, z):
         return round(z/self.heightStep)
@@ -87,6 +58,10 @@ class TerrainRegionMap:
     def getKHeightFromIJ(self, i, j):
         return self.heightMap[i][j]
 
+    # Copy of the height map as a [i,j] indexed integer array
+    def getKHeightArray(self):
+        return np.array(self.heightMap, dtype=np.int32).reshape(self.size, self.size)
+
     def getZHeightFromIJ(self, i, j):
         return self.getZHeightFromK(self.getKHeightFromIJ(i,j)) 
 
@@ -94,6 +69,46 @@ class TerrainRegionMap:
         ijLocation = self.getIJLocationFromXY(LVector2f(x,y))
         return self.getZHeightFromIJ(ijLocation.getX(), ijLocation.getY())
 
+    # Brush edits, radius in cells and amount in height steps
+    def raiseTerrain(self, i, j, radius, amount=1):
+        self.__applyBrush(i, j, radius, lambda k: k + amount)
+
+    def lowerTerrain(self, i, j, radius, amount=1):
+        self.__applyBrush(i, j, radius, lambda k: k - amount)
+
+    # Flatten to the given height, or to the height of the brush center
+    def flattenTerrain(self, i, j, radius, kHeight=None):
+        if not self.isValid(i, j):
+            return
+        target = self.heightMap[i][j] if kHeight is None else kHeight
+        self.__applyBrush(i, j, radius, lambda k: target)
+
+    def __applyBrush(self, ci, cj, radius, op):
+        i0 = max(ci - radius, 0)
+        i1 = min(ci + radius + 1, self.size)
+        j0 = max(cj - radius, 0)
+        j1 = min(cj + radius + 1, self.size)
+        if(i0 >= i1 or j0 >= j1):
+            return
+        for i in range(i0, i1):
+            for j in range(j0, j1):
+                if((i-ci)*(i-ci) + (j-cj)*(j-cj) > radius*radius):
+                    continue
+                kHeight = max(-self.height, min(self.height, op(self.heightMap[i][j])))
+                self.heightMap[i][j] = kHeight
+                self.waterMap[i][j] = kHeight < 0
+                if(kHeight > self.maxKHeight):
+                    self.maxKHeight = kHeight
+        # Neighbor cells mesh their sides against the edited cells
+        self.dirtyRects.append((
+            max(i0 - 1, 0), max(j0 - 1, 0),
+            min(i1 + 1, self.size), min(j1 + 1, self.size)))
+
+    def popDirtyRects(self):
+        dirtyRects = self.dirtyRects
+        self.dirtyRects = []
+        return dirtyRects
+
     def getIJLocationFromXY(self, XYLocation):
         return LVector2i(
             round((XYLocation.getX()+self.size)/2),
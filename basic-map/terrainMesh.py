@@ -1,182 +1,180 @@
 import random
 import math
+import numpy as np
 
 from terrainMap import *
 from navigation import *
 from meshing import *
+from terrainGeneration import TerrainPipeline
+from terrainGridMesher import TerrainGridMesher
 
 ###############################################################################
 # Class managing texture computation
 
 class TerrainTextureScheme:
 
-    def __init__(self):
-        self.uvMap = TextureUVMap(4)
-        self.uvMap.addMaterial("rock", 0, 0)
-        self.uvMap.addMaterial("snow", 1, 0)
-        self.uvMap.addMaterial("dirt", 2, 0)
-        self.uvMap.addMaterial("hillgrass", 0, 1)
-        self.uvMap.addMaterial("plaingrass", 1, 1)
-        self.uvMap.addMaterial("darksand", 2, 1)
-        self.uvMap.addMaterial("lightsand", 3, 1)
-        self.uvMap.addMaterial("darkwater", 0, 2)
-        self.uvMap.addMaterial("clearwater", 1, 2)
+    # Material squares of terrainTex2.png
+    Materials = {
+        "rock": (0, 0),
+        "snow": (1, 0),
+        "dirt": (2, 0),
+        "hillgrass": (0, 1),
+        "plaingrass": (1, 1),
+        "darksand": (2, 1),
+        "lightsand": (3, 1),
+        "darkwater": (0, 2),
+        "clearwater": (1, 2),
+    }
+
+    # uvMap of a texture atlas holding the materials, the squares of
+    # terrainTex2.png by default
+    def __init__(self, uvMap=None):
+        if uvMap is None:
+            uvMap = TextureUVMap(4)
+            for name, (i, j) in TerrainTextureScheme.Materials.items():
+                uvMap.addMaterial(name, i, j)
+        self.uvMap = uvMap
+
+    # Material below each height threshold (fraction of the max height),
+    # the last one above all thresholds
+    HeightThresholds = [-0.101, -0.001, 0.021, 0.401, 0.701]
+    HeightMaterials = ["darksand", "lightsand", "plaingrass", "hillgrass", "rock", "snow"]
 
     def getMaterial(self, zHeight, maxHeight, normal):
         zPercent = zHeight / maxHeight
-        if(zPercent<-0.101):
-            return "darksand"
-        if(zPercent<-0.001):
-            return "lightsand"
-        elif(zPercent<0.021):
-            return "plaingrass"
-        elif(zPercent<0.401):
-            return "hillgrass"
-        elif(zPercent<0.701):
-            return "rock"
-        else:
-            return "snow"
+        for threshold, name in zip(TerrainTextureScheme.HeightThresholds, TerrainTextureScheme.HeightMaterials):
+            if(zPercent<threshold):
+                return name
+        return TerrainTextureScheme.HeightMaterials[-1]
+
+    # Index in HeightMaterials of an array of heights
+    def getMaterialIndexArray(self, zHeights, maxHeight):
+        return np.searchsorted(TerrainTextureScheme.HeightThresholds, zHeights / maxHeight, side='right')
 
 ###############################################################################
 # Cell shape class refactored
+#
+# Faces are appended to a FaceBuffer with plain float math, getFaces and
+# getWaterFaces return them as CellFace objects.
 class CellShape2:
 
+    Up = (0.0, 0.0, 1.0)
+    North = (0.0, 1.0, 0.0)
+
     def __init__(self):
         pass
 
     def getWaterFaces(self, center):
-        fList = []
-        waterCenter = center
-        fList.append(CellFace.MakeSquareFace(
-            waterCenter, 
-            LVector3f(0.0, 0.0, 1.0), 
-            LVector3f(0.0, 1.0, 0.0), 
-            1.0, 1.0, 1.0))
-        return fList
-    
+        faces = FaceBuffer()
+        self.addWaterFaces(faces, center.getX(), center.getY(), center.getZ())
+        return faces.toCellFaces()
+
     def getFaces(self, cellMeshInfo):
+        faces = FaceBuffer()
+        self.addFaces(faces, cellMeshInfo)
+        return faces.toCellFaces()
+
+    def addWaterFaces(self, faces, x, y, z):
+        faces.addSquareFace((x, y, z), CellShape2.Up, CellShape2.North, 1.0, 1.0, 1.0)
+
+    def addFaces(self, faces, cellMeshInfo):
         cmi = cellMeshInfo
-        fList = []
-        fList.append(CellFace.MakeSquareFace(
-            cmi.center, 
-            LVector3f(0.0, 0.0, 1.0), 
-            LVector3f(0.0, 1.0, 0.0), 
-            cmi.centerComp.radius, cmi.centerComp.radius, 
-            1.0))
-
-        midRadius = (cmi.radius+cmi.centerComp.radius) / 2.0
-        ringHalfWitdh = (cmi.radius-cmi.centerComp.radius) / 2.0
-        ringHalfWitdhDiag = (cmi.radius-cmi.centerComp.radius) / 2.0 * math.sqrt(2.0)
+        cx = cmi.center.getX()
+        cy = cmi.center.getY()
+        cz = cmi.center.getZ()
+        radius = cmi.radius
+        centerRadius = cmi.centerComp.radius
+        stepHeight = cmi.stepHeight
+        invSqrt2 = 1.0 / math.sqrt(2.0)
+
+        faces.addSquareFace((cx, cy, cz), CellShape2.Up, CellShape2.North, centerRadius, centerRadius, 1.0)
+
+        midRadius = (radius+centerRadius) / 2.0
+        ringHalfWitdh = (radius-centerRadius) / 2.0
+        ringHalfWitdhDiag = (radius-centerRadius) / 2.0 * math.sqrt(2.0)
         for sc in cmi.sideCompList:
-            headingDir = Heading.getDirection3f(sc.heading)
-            center = cmi.center + headingDir * midRadius
+            hx = sc.dirX
+            hy = sc.dirY
+            mx = cx + hx * midRadius
+            my = cy + hy * midRadius
             if(sc.slope == "flat"):
-                fList.append(CellFace.MakeSquareFace(
-                    center, 
-                    LVector3f(0.0, 0.0, 1.0), 
-                    headingDir,
-                    cmi.centerComp.radius,
+                faces.addSquareFace(
+                    (mx, my, cz),
+                    CellShape2.Up,
+                    (hx, hy, 0.0),
+                    centerRadius,
                     ringHalfWitdh,
-                    1.0))                
+                    1.0)
             elif(sc.slope == "tapered"):
-                tcenter = center + LVector3f(0.0, 0.0, 1.0) * cmi.stepHeight / 2.0
-                tnormal = (LVector3f(0.0, 0.0, 1.0) - headingDir)
-                tnormal.normalize()
-                tup = (headingDir + LVector3f(0.0, 0.0, 1.0))
-                tup.normalize()
-                fList.append(CellFace.MakeSquareFace(
-                    tcenter, 
-                    tnormal, 
-                    tup,
-                    cmi.centerComp.radius,
+                faces.addSquareFace(
+                    (mx, my, cz + stepHeight / 2.0),
+                    (-hx * invSqrt2, -hy * invSqrt2, invSqrt2),
+                    (hx * invSqrt2, hy * invSqrt2, invSqrt2),
+                    centerRadius,
                     ringHalfWitdhDiag,
-                    1.0)) 
-                
+                    1.0)
+
                 # Vertical for further rise
                 for lvl in range(1,sc.rise):
-                    vcenter = cmi.center + headingDir * cmi.radius + LVector3f(0.0, 0.0, 1.0) * cmi.stepHeight * (2.0 * lvl + 1.0) / 2.0
-                    vnormal = -headingDir
-                    vup = LVector3f(0.0, 0.0, 1.0)
-                    fList.append(CellFace.MakeSquareFace(
-                        vcenter, 
-                        vnormal, 
-                        vup,
-                        cmi.radius,
+                    faces.addSquareFace(
+                        (cx + hx * radius, cy + hy * radius, cz + stepHeight * (2.0 * lvl + 1.0) / 2.0),
+                        (-hx, -hy, 0.0),
+                        CellShape2.Up,
+                        radius,
                         ringHalfWitdh,
-                        1.0))
-                
+                        1.0)
+
         for cc in cmi.cornerCompList:
-            headingDir = Heading.getDirection3f(cc.heading)
-            center = cmi.center + headingDir * midRadius
+            xSign = cc.dirX
+            ySign = cc.dirY
+            mx = cx + xSign * midRadius
+            my = cy + ySign * midRadius
             if(cc.slope == "flat"):
-                fList.append(CellFace.MakeSquareFace(
-                    center, 
-                    LVector3f(0.0, 0.0, 1.0), 
-                    LVector3f(0.0, 1.0, 0.0),
+                faces.addSquareFace(
+                    (mx, my, cz),
+                    CellShape2.Up,
+                    CellShape2.North,
                     ringHalfWitdh,
                     ringHalfWitdh,
-                    1.0))
-            
-            elif(cc.slope == "taperedxn" or cc.slope == "taperedyn" or cc.slope == "taperedxp" or cc.slope == "taperedyp"):
-                taperHeading = cc.slope[-2:]
-                taperHeadingDir = Heading.getDirection3f(taperHeading)
-                taperAxis = Heading.getAxis(taperHeading)
-                center = center + LVector3f(0.0, 0.0, 1.0) * cmi.stepHeight / 2.0
-                normal = (LVector3f(0.0, 0.0, 1.0) - taperHeadingDir)
-                normal.normalize()
-                up = (taperHeadingDir + LVector3f(0.0, 0.0, 1.0))
-                up.normalize()
-                fList.append(CellFace.MakeSquareFace(
-                    center, 
-                    normal, 
-                    up,
+                    1.0)
+
+            elif(cc.slope == cc.taperedX or cc.slope == cc.taperedY):
+                # Taper along one axis, the other one is the non taper axis
+                if(cc.slope == cc.taperedX):
+                    tx, ty = xSign, 0.0
+                    nonTaperRise = cc.yrise
+                else:
+                    tx, ty = 0.0, ySign
+                    nonTaperRise = cc.xrise
+                faces.addSquareFace(
+                    (mx, my, cz + stepHeight / 2.0),
+                    (-tx * invSqrt2, -ty * invSqrt2, invSqrt2),
+                    (tx * invSqrt2, ty * invSqrt2, invSqrt2),
                     ringHalfWitdh,
                     ringHalfWitdhDiag,
-                    1.0))         
+                    1.0)
 
                 # Need to fill side triangle in case cell in non-taper dir is lower
-                adjHeadings = Heading.getAdjascentHeadings(cc.heading)
-                for h in adjHeadings:
-                    if not(h == taperHeading):
-                        nonTaperHeading = h
-                nonTaperHeadingDir = Heading.getDirection3f(nonTaperHeading)
-                nonTaperAxis = Heading.getAxis(nonTaperHeading)
-                nonTaperRise = cc.xrise if nonTaperAxis == "x" else cc.yrise
-                xSign = Heading.getDirection3f(cc.heading).getX()
-                ySign = Heading.getDirection3f(cc.heading).getY()
                 if(nonTaperRise<0 or (nonTaperRise == 0 and cc.crise < 0)):
-                    vcorner = LVector3f(cmi.center.getX() + cmi.radius * xSign, cmi.center.getY() + cmi.radius * ySign, cmi.center.getZ())
-                    vin = vcorner - taperHeadingDir * (cmi.radius - cmi.centerComp.radius)
-                    vup = LVector3f(cmi.center.getX() + cmi.radius * xSign, cmi.center.getY() + cmi.radius * ySign, cmi.center.getZ() + cmi.stepHeight)
-                    
-                    angle = nonTaperHeadingDir.signedAngleDeg(taperHeadingDir, LVector3f(0.0, 0.0, 1.0))
-                    if(angle > 0):
-                        verts1 = [vin, vcorner, vup]
-                        face1 = CellFace.MakeTriangle(verts1, 1.0)
-                        fList.append(face1)
+                    vcorner = (cx + radius * xSign, cy + radius * ySign, cz)
+                    vin = (vcorner[0] - tx * (radius - centerRadius), vcorner[1] - ty * (radius - centerRadius), cz)
+                    vup = (vcorner[0], vcorner[1], cz + stepHeight)
+                    # Winding from the sign of the non taper to taper direction angle
+                    if((xSign - tx) * ty - (ySign - ty) * tx > 0):
+                        faces.addTriangle(vin, vcorner, vup, 1.0)
                     else:
-                        verts2 = [vcorner, vin, vup]
-                        face2 = CellFace.MakeTriangle(verts2, 1.0)
-                        fList.append(face2)
-                
+                        faces.addTriangle(vcorner, vin, vup, 1.0)
+
             elif(cc.slope == "foldednormal"):
-                xSign = Heading.getDirection3f(cc.heading).getX()
-                ySign = Heading.getDirection3f(cc.heading).getY()
-                vin = LVector3f(cmi.center.getX() + cmi.centerComp.radius * xSign, cmi.center.getY() + cmi.centerComp.radius * ySign, cmi.center.getZ())
-                maxrise = max(cc.crise, cc.xrise, cc.yrise) 
-                vcout = LVector3f(cmi.center.getX() + cmi.radius * xSign, cmi.center.getY() + cmi.radius * ySign, cmi.center.getZ() + min(maxrise, 1) * cmi.stepHeight)
-                vxout = LVector3f(cmi.center.getX() + cmi.radius * xSign, cmi.center.getY() + cmi.centerComp.radius * ySign, cmi.center.getZ() + min(cc.xrise, 1) * cmi.stepHeight)
-                vyout = LVector3f(cmi.center.getX() + cmi.centerComp.radius * xSign, cmi.center.getY() + cmi.radius * ySign, cmi.center.getZ() + min(cc.yrise, 1) * cmi.stepHeight)
-                verts = []
+                vin = (cx + centerRadius * xSign, cy + centerRadius * ySign, cz)
+                maxrise = max(cc.crise, cc.xrise, cc.yrise)
+                vcout = (cx + radius * xSign, cy + radius * ySign, cz + min(maxrise, 1) * stepHeight)
+                vxout = (cx + radius * xSign, cy + centerRadius * ySign, cz + min(cc.xrise, 1) * stepHeight)
+                vyout = (cx + centerRadius * xSign, cy + radius * ySign, cz + min(cc.yrise, 1) * stepHeight)
                 if(xSign * ySign > 0):
-                    verts = [vin, vxout, vcout, vyout]
+                    faces.addNonPlanarSquare(vin, vxout, vcout, vyout, 1.0)
                 else:
-                    verts = [vin, vyout, vcout, vxout]
-                faces = CellFace.MakeNonPlanarSquare(verts, 1.0)
-                fList.append(faces[0])
-                fList.append(faces[1])
-            
-        return fList
+                    faces.addNonPlanarSquare(vin, vyout, vcout, vxout, 1.0)
 
 ###############################################################################
 # Cell parameters
@@ -197,30 +195,62 @@ class CellShape2:
 #       +-----+-----------+-----+
 #   xnyn            yn           xpyn
 #
+# Components are allocated once per cell mesher and updated for every cell,
+# their heading dependent values are resolved at construction.
 class CenterComponent:
+    __slots__ = ("radius",)
+
     def __init__(self):
         self.radius = 0.0
 
 class SideComponent:
+    __slots__ = ("heading", "dirX", "dirY", "rise", "slope", "neighbor")
+
     def __init__(self, heading):
         self.heading = heading # in "xn", "yn", "xp", "yp"
+        direction = Heading.getDirection2i(heading)
+        self.dirX = float(direction.getX())
+        self.dirY = float(direction.getY())
         self.rise = 0 # rise of direct neighbor
         self.slope = "" # in "flat", "block", "tapered"
+        self.neighbor = None # NeighbCellInfo in the heading
 
 class CornerComponent:
+    __slots__ = ("heading", "dirX", "dirY", "crise", "xrise", "yrise", "slope",
+                 "taperedX", "taperedY", "neighbor", "xNeighbor", "yNeighbor")
+
     def __init__(self, heading):
         self.heading = heading # in "xnyn", "xpyn", "xpyp", "xnyp"
+        direction = Heading.getDirection2i(heading)
+        self.dirX = float(direction.getX())
+        self.dirY = float(direction.getY())
         self.crise = 0 # rise of corner neighbor
         self.xrise = 0 # rise of direct neighbor in closest x direction
         self.yrise = 0 # rise of direct neighbor in closest y direction
         self.slope = "" # in "flat", "block", "taperedxn", "taperedyn", "taperedxp", "taperedyp", "foldednormal"
+        self.taperedX = "tapered" + Heading.getAdjascentXHeading(heading)
+        self.taperedY = "tapered" + Heading.getAdjascentYHeading(heading)
+        self.neighbor = None
+        self.xNeighbor = None
+        self.yNeighbor = None
 
 class NeighbCellInfo:
-    def __init__(self):
+    __slots__ = ("di", "dj", "valid", "rise")
+
+    def __init__(self, heading=None):
+        self.di = 0
+        self.dj = 0
+        if heading is not None:
+            direction = Heading.getDirection2i(heading)
+            self.di = direction.getX()
+            self.dj = direction.getY()
         self.valid = False
         self.rise = 0
 
 class CellMeshInfo:
+    __slots__ = ("radius", "stepHeight", "center", "kHeight", "neighborInfo",
+                 "centerComp", "sideCompList", "cornerCompList")
+
     def __init__(self):
         # Invariants
         self.radius = 0.0
@@ -232,14 +262,14 @@ class CellMeshInfo:
 
         # External Neighbor Info
         self.neighborInfo = {
-            "xn" : NeighbCellInfo(),
-            "yn" : NeighbCellInfo(),
-            "xp" : NeighbCellInfo(),
-            "yp" : NeighbCellInfo(),
-            "xnyn" : NeighbCellInfo(),
-            "xpyn" : NeighbCellInfo(),
-            "xpyp" : NeighbCellInfo(),
-            "xnyp" : NeighbCellInfo()
+            "xn" : NeighbCellInfo("xn"),
+            "yn" : NeighbCellInfo("yn"),
+            "xp" : NeighbCellInfo("xp"),
+            "yp" : NeighbCellInfo("yp"),
+            "xnyn" : NeighbCellInfo("xnyn"),
+            "xpyn" : NeighbCellInfo("xpyn"),
+            "xpyp" : NeighbCellInfo("xpyp"),
+            "xnyp" : NeighbCellInfo("xnyp")
         }
     
         # Internal Mesh Components
@@ -255,7 +285,13 @@ class CellMeshInfo:
             CornerComponent("xpyn"),
             CornerComponent("xpyp"),
             CornerComponent("xnyp")
-        ]   
+        ]
+        for sc in self.sideCompList:
+            sc.neighbor = self.neighborInfo[sc.heading]
+        for cc in self.cornerCompList:
+            cc.neighbor = self.neighborInfo[cc.heading]
+            cc.xNeighbor = self.neighborInfo[Heading.getAdjascentXHeading(cc.heading)]
+            cc.yNeighbor = self.neighborInfo[Heading.getAdjascentYHeading(cc.heading)]
 
 ###############################################################################
 # Worker class meshing one cell of the terrain
@@ -265,52 +301,55 @@ class TerrainCellMesher:
         # cell-invariant settings
         self.heightMap = terrainHeightMap
         self.textureScheme = textureScheme
+        self.waterOffset = terrainHeightMap.waterOffset
+        self.maxHeight = terrainHeightMap.height * terrainHeightMap.heightStep
+
+        # Scratch storage reused for every cell
+        self.cellShape = CellShape2()
         self.cmi = CellMeshInfo()
         self.cmi.radius = terrainHeightMap.cellDimension / 2.0
         self.cmi.stepHeight = terrainHeightMap.heightStep
-        self.waterOffset = terrainHeightMap.waterOffset
+        self.cmi.centerComp.radius = self.cmi.radius / 2.0
+        self.neighborList = list(self.cmi.neighborInfo.values())
 
     def __updateCenterAndHeight(self, i, j):
         # cell position settings
         self.i = i
         self.j = j
         center2i = self.heightMap.getXYLocationFromIJ(LVector2i(i,j))
-        self.cmi.center = LVector3f(center2i.getX(), center2i.getY(), self.heightMap.getZHeightFromIJ(i, j))
         self.cmi.kHeight = self.heightMap.getKHeightFromIJ(i, j)
+        self.cmi.center.set(center2i.getX(), center2i.getY(), self.heightMap.getZHeightFromK(self.cmi.kHeight))
     
     def __updateTerrainCellMeshInfo(self):
         
         # neighbor cells
-        for dir,nbInfo in self.cmi.neighborInfo.items():
-            nbOffset = Heading.getDirection2i(dir)
-            di = nbOffset.getX()
-            dj = nbOffset.getY()
-            if(self.heightMap.isValid(self.i + di, self.j + dj)):
+        heights = self.heightMap.heightMap
+        size = self.heightMap.size
+        kHeight = self.cmi.kHeight
+        for nbInfo in self.neighborList:
+            ni = self.i + nbInfo.di
+            nj = self.j + nbInfo.dj
+            if(ni >= 0 and ni < size and nj >= 0 and nj < size):
                 nbInfo.valid = True
-                nbInfo.rise = self.heightMap.getKHeightFromIJ(self.i+di, self.j+dj) -self.cmi.kHeight
+                nbInfo.rise = heights[ni][nj] - kHeight
             else:
                 nbInfo.valid = False
                 nbInfo.rise = 0 
 
-        # center component
-        self.cmi.centerComp.radius = self.cmi.radius / 2.0
-
         # side components
         for sc in self.cmi.sideCompList:
-            sc.rise = self.cmi.neighborInfo[sc.heading].rise
+            sc.rise = sc.neighbor.rise
             sc.slope = "flat" if sc.rise <= 0 else "tapered"
         
         # corner components
         for cc in self.cmi.cornerCompList:
-            cc.crise = self.cmi.neighborInfo[cc.heading].rise
-            adjXHeading = Heading.getAdjascentXHeading(cc.heading)
-            cc.xrise = self.cmi.neighborInfo[adjXHeading].rise
-            adjYHeading = Heading.getAdjascentYHeading(cc.heading)
-            cc.yrise = self.cmi.neighborInfo[adjYHeading].rise
+            cc.crise = cc.neighbor.rise
+            cc.xrise = cc.xNeighbor.rise
+            cc.yrise = cc.yNeighbor.rise
             if(cc.xrise > 0 and cc.yrise <= 0):
-                cc.slope = "tapered" + adjXHeading
+                cc.slope = cc.taperedX
             elif(cc.xrise <= 0 and cc.yrise > 0):
-                cc.slope = "tapered" + adjYHeading
+                cc.slope = cc.taperedY
             elif(cc.xrise == 0 and cc.yrise == 0 and cc.crise > 0):
                 cc.slope = "foldednormal"
             elif(cc.xrise > 0 and cc.yrise > 0):
@@ -318,60 +357,83 @@ class TerrainCellMesher:
             else: #if cc.rise <= 0:
                 cc.slope = "flat"
 
-    def __meshCell(self, mesh):
-        # Initialize shape
-        cellShape = CellShape2()
-        fList = cellShape.getFaces(self.cmi) 
-        maxHeight = self.heightMap.height * self.heightMap.heightStep
-        for f in fList:
-            f.texMat = self.textureScheme.getMaterial(f.getVertsCentroid().getZ(), maxHeight, f.normal)
-            mesh.addFace(self.textureScheme.uvMap, f)
+    def __meshCell(self, faces):
+        firstFace = faces.numFaces
+        self.cellShape.addFaces(faces, self.cmi)
+        uvMap = self.textureScheme.uvMap
+        for f in range(firstFace, faces.numFaces):
+            texMat = self.textureScheme.getMaterial(faces.getFaceCentroidZ(f), self.maxHeight, faces.getFaceNormal(f))
+            faces.setFaceMaterial(f, uvMap, texMat)
 
-    def __meshWater(self, mesh):
+    def __meshWater(self, faces):
         # If water cell, add water surface face
-        center3f = LVector3f(self.cmi.center.getX(), self.cmi.center.getY(), -self.waterOffset)
-        cellShape = CellShape2()
         if(self.heightMap.hasWater(self.i,self.j)):
-            fList = cellShape.getWaterFaces(center3f)
-            for f in fList:
-                f.texMat = "clearwater"
-                f.color.setW(0.85)
-                mesh.addFace(self.textureScheme.uvMap, f)
+            firstFace = faces.numFaces
+            self.cellShape.addWaterFaces(faces, self.cmi.center.getX(), self.cmi.center.getY(),
+                self.heightMap.getWaterZHeightFromIJ(self.i, self.j))
+            for f in range(firstFace, faces.numFaces):
+                faces.setFaceColor(f, 1.0, 1.0, 1.0, 0.85)
+                faces.setFaceMaterial(f, self.textureScheme.uvMap, "clearwater")
     
     def meshCellTerrain(self, mesh, i, j):
         self.__updateCenterAndHeight(i, j)
         self.__updateTerrainCellMeshInfo()
-        self.__meshCell(mesh)
+        self.__meshCell(mesh.faces)
 
     def meshCellWater(self, mesh, i, j):   
         self.__updateCenterAndHeight(i, j)
-        self.__meshWater(mesh)
+        self.__meshWater(mesh.faces)
 
 ###############################################################################
 # Worker class generating the terrain mesh
 class TerrainMesher:
 
     def __init__(self):
-        pass
+        self.terrainPipeline = TerrainPipeline.makeBasic()
+        # Texture atlas uv map, None for terrainTex2.png
+        self.textureUVMap = None
+        # Compact vertex format of Mesh, terrain geoms are static (remeshing
+        # replaces them), water geoms change with the simulation
+        self.compactVertices = False
+
+    def generateTerrain(self, size, height, seed=None):
+        terrainRegionMap = TerrainRegionMap(size, height)
+        if seed is not None:
+            self.terrainPipeline.setSeed(seed)
+        self.terrainPipeline.fill(terrainRegionMap)
+        self.setTerrain(terrainRegionMap)
 
-    def generateTerrain(self, size, height):
-        self.heightMap = TerrainRegionMap(size, height)
-        FillTerrainMapBasic(self.heightMap)
-        self.textureScheme = TerrainTextureScheme()
+    # Use an existing terrain, e.g. loaded from a snapshot
+    def setTerrain(self, terrainRegionMap):
+        self.heightMap = terrainRegionMap
+        self.textureScheme = TerrainTextureScheme(self.textureUVMap)
         self.cellMesher = TerrainCellMesher(self.heightMap, self.textureScheme)
+        # Same faces as the cell mesher, a block of cells at a time
+        self.gridMesher = TerrainGridMesher(self.heightMap, self.textureScheme)
     
     def meshTerrain(self):
-        terrainMesh = Mesh()
-        for i in range(self.heightMap.size):
-            for j in range(self.heightMap.size):
-                self.cellMesher.meshCellTerrain(terrainMesh, i, j)
+        terrainMesh = Mesh(self.compactVertices, Geom.UHStatic)
+        self.gridMesher.addTerrainFaces(terrainMesh.faces, 0, 0, self.heightMap.size, self.heightMap.size)
         return terrainMesh.makeGeom()
 
     def meshWater(self):
-        waterMesh = Mesh()
-        for i in range(self.heightMap.size):
-            for j in range(self.heightMap.size):
-                self.cellMesher.meshCellWater(waterMesh,i,j)
+        waterMesh = Mesh(self.compactVertices)
+        self.gridMesher.addWaterFaces(waterMesh.faces, 0, 0, self.heightMap.size, self.heightMap.size)
+        return waterMesh.makeGeom()
+
+    # Mesh the cells [i0,i1[ x [j0,j1[ only, returns None if nothing to draw
+    def meshTerrainChunk(self, i0, j0, i1, j1):
+        terrainMesh = Mesh(self.compactVertices, Geom.UHStatic)
+        self.gridMesher.addTerrainFaces(terrainMesh.faces, i0, j0, i1, j1)
+        if(terrainMesh.numVerts == 0):
+            return None
+        return terrainMesh.makeGeom()
+
+    def meshWaterChunk(self, i0, j0, i1, j1):
+        waterMesh = Mesh(self.compactVertices)
+        self.gridMesher.addWaterFaces(waterMesh.faces, i0, j0, i1, j1)
+        if(waterMesh.numVerts == 0):
+            return None
         return waterMesh.makeGeom()
 
 
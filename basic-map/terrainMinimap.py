@@ -0,0 +1,135 @@
+from panda3d.core import Texture, SamplerState
+from panda3d.core import GeomVertexFormat, GeomVertexData, Geom, GeomTriangles, GeomNode, GeomEnums
+import numpy as np
+
+from meshing import getVertexColumnArray
+from terrainMesh import TerrainTextureScheme
+
+###############################################################################
+# Shaded colour map of the terrain, one texel per cell
+#
+# Built from the height and water maps only, vectorized over cell blocks:
+#  - material colour from the height thresholds of TerrainTextureScheme
+#  - hill shading from the height gradient and the sun direction
+#  - water blended over, darker with depth
+#
+# The texture is shown on a card as a minimap, and on a low poly proxy of
+# the terrain in overview mode instead of the full meshes.
+class TerrainMinimap:
+
+    def __init__(self, terrainRegionMap, materialColors, sunDirection):
+        self.heightMap = terrainRegionMap
+        self.textureScheme = TerrainTextureScheme()
+        self.materialColors = np.array([materialColors[name] for name in TerrainTextureScheme.HeightMaterials], dtype=np.float32)
+        self.shallowWaterColor = np.array(materialColors["clearwater"], dtype=np.float32)
+        self.deepWaterColor = np.array(materialColors["darkwater"], dtype=np.float32)
+        self.waterAlpha = 0.85
+        # Depth of the darkest water, in world units
+        self.deepWaterDepth = 4.0
+        self.ambient = 0.35
+        self.sunDirection = np.array([sunDirection.getX(), sunDirection.getY(), sunDirection.getZ()], dtype=np.float32)
+        self.sunDirection /= np.linalg.norm(self.sunDirection)
+
+        size = terrainRegionMap.size
+        self.texture = Texture("minimap")
+        self.texture.setup2dTexture(size, size, Texture.T_unsigned_byte, Texture.F_rgba8)
+        self.texture.setWrapU(SamplerState.WM_clamp)
+        self.texture.setWrapV(SamplerState.WM_clamp)
+        self.texture.makeRamImage()
+        self.update()
+
+    # Colours of the cells [i0,i1[ x [j0,j1[ as a float RGB [i,j] array
+    def getCellColors(self, kHeights, i0, j0, i1, j1):
+        trm = self.heightMap
+        maxHeight = trm.height * trm.heightStep
+        # One cell ring for the gradient, heights outside repeat the border
+        ring = kHeights[max(i0-1, 0):min(i1+1, trm.size), max(j0-1, 0):min(j1+1, trm.size)]
+        padding = ((1 if i0 == 0 else 0, 1 if i1 == trm.size else 0), (1 if j0 == 0 else 0, 1 if j1 == trm.size else 0))
+        z = np.pad(ring.astype(np.float32) * trm.heightStep, padding, mode='edge')
+        zCells = z[1:-1, 1:-1]
+
+        colors = self.materialColors[self.textureScheme.getMaterialIndexArray(zCells, maxHeight)]
+
+        dzdx = (z[2:, 1:-1] - z[:-2, 1:-1]) / (2.0 * trm.cellDimension)
+        dzdy = (z[1:-1, 2:] - z[1:-1, :-2]) / (2.0 * trm.cellDimension)
+        sx, sy, sz = self.sunDirection
+        light = (sz - dzdx * sx - dzdy * sy) / np.sqrt(1.0 + dzdx * dzdx + dzdy * dzdy)
+        colors *= (self.ambient + (1.0 - self.ambient) * np.clip(light, 0.0, 1.0))[:, :, None]
+
+        wet = np.array([row[j0:j1] for row in trm.waterMap[i0:i1]], dtype=bool)
+        if wet.any():
+            depth = np.clip((trm.waterLevelMap[i0:i1, j0:j1] - zCells) / self.deepWaterDepth, 0.0, 1.0)[:, :, None]
+            water = self.shallowWaterColor * (1.0 - depth) + self.deepWaterColor * depth
+            colors[wet] = colors[wet] * (1.0 - self.waterAlpha) + water[wet] * self.waterAlpha
+        return colors
+
+    # Recompute the cells of the rect (i0, j0, i1, j1), all cells by default.
+    # Heights come from kHeights when given, e.g. the array of the chunk grid.
+    def update(self, rect=None, kHeights=None):
+        trm = self.heightMap
+        i0, j0, i1, j1 = (0, 0, trm.size, trm.size) if rect is None else rect
+        # The gradient of the ring cells changes too
+        i0 = max(i0 - 1, 0)
+        j0 = max(j0 - 1, 0)
+        i1 = min(i1 + 1, trm.size)
+        j1 = min(j1 + 1, trm.size)
+        if kHeights is None:
+            kHeights = trm.getKHeightArray()
+        colors = self.getCellColors(kHeights, i0, j0, i1, j1)
+        # Ram image rows are j (v) from the bottom, BGRA bytes
+        image = np.frombuffer(memoryview(self.texture.modifyRamImage()), dtype=np.uint8).reshape(trm.size, trm.size, 4)
+        image[j0:j1, i0:i1, 0:3] = np.clip(colors.transpose(1, 0, 2)[:, :, ::-1] * 255.0 + 0.5, 0, 255).astype(np.uint8)
+        image[j0:j1, i0:i1, 3] = 255
+
+    def updateChunks(self, chunkList, kHeights=None):
+        for chunk in chunkList:
+            self.update((chunk.i0, chunk.j0, chunk.i1, chunk.j1), kHeights)
+
+    # Texture coordinates of a world xy position
+    def getUVFromXY(self, x, y):
+        trm = self.heightMap
+        return ((x + trm.size) / (trm.cellDimension * trm.size) + 0.5 / trm.size,
+                (y + trm.size) / (trm.cellDimension * trm.size) + 0.5 / trm.size)
+
+    # Height field mesh through every step-th cell, at most resolution
+    # vertices per side, water surfaces included. Meant to be drawn with
+    # the minimap texture, without lighting.
+    def makeProxyNode(self, resolution=64, kHeights=None):
+        trm = self.heightMap
+        if kHeights is None:
+            kHeights = trm.getKHeightArray()
+        step = max(trm.size // resolution, 1)
+        samples = np.unique(np.append(np.arange(0, trm.size, step), trm.size - 1))
+        n = len(samples)
+        ii, jj = np.meshgrid(samples, samples, indexing='ij')
+        z = kHeights[ii, jj].astype(np.float32) * trm.heightStep
+        wet = np.array(trm.waterMap, dtype=bool)[ii, jj]
+        z = np.where(wet, np.maximum(z, trm.waterLevelMap[ii, jj]), z)
+
+        vdata = GeomVertexData('minimapProxy', GeomVertexFormat.getV3t2(), Geom.UHStatic)
+        vdata.uncleanSetNumRows(n * n)
+        verts = getVertexColumnArray(vdata, 'vertex')
+        verts[:, 0] = (ii * trm.cellDimension - trm.size).ravel()
+        verts[:, 1] = (jj * trm.cellDimension - trm.size).ravel()
+        verts[:, 2] = z.ravel()
+        texCoords = getVertexColumnArray(vdata, 'texcoord')
+        texCoords[:, 0] = ((ii + 0.5) / trm.size).ravel()
+        texCoords[:, 1] = ((jj + 0.5) / trm.size).ravel()
+
+        # Two counter clockwise triangles per quad, seen from above
+        quad = (np.arange(n - 1)[:, None] * n + np.arange(n - 1)[None, :]).ravel()
+        indices = np.stack([quad, quad + n, quad + n + 1, quad, quad + n + 1, quad + 1], axis=1).ravel()
+        tris = GeomTriangles(Geom.UHStatic)
+        indexType = np.uint16
+        if n * n > 0xffff:
+            tris.setIndexType(GeomEnums.NT_uint32)
+            indexType = np.uint32
+        indexArray = tris.modifyVertices()
+        indexArray.uncleanSetNumRows(len(indices))
+        np.frombuffer(memoryview(indexArray).cast('B'), dtype=indexType)[:] = indices
+
+        geom = Geom(vdata)
+        geom.addPrimitive(tris)
+        geomNode = GeomNode('minimapProxy')
+        geomNode.addGeom(geom)
+        return geomNode
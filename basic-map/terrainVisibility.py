@@ -0,0 +1,280 @@
+import argparse
+import math
+import time
+import numpy as np
+
+from navigation import Heading
+
+###############################################################################
+# Line of sight from viewers over the cell tops of a TerrainRegionMap
+#
+# Ring sweep around the viewer cell, every ring vectorized over its cells
+# and over all the viewers of a batch. The horizon (highest slope seen from
+# the eye so far) of a cell at ring d is interpolated between the two cells
+# of ring d-1 that the line to the viewer crosses:
+#
+#      ring d-1   ring d
+#         +---+
+#         | a |  .
+#         +---+     .   +---+
+#         | b |  w  .  -| c |      horizon(c) = max(lerp(a, b, w), slope(c))
+#         +---+         +---+
+#
+# c is visible when the slope to its top (plus targetHeight) is not under
+# the interpolated horizon. Results are (2 radius + 1)^2 windows centered
+# on the viewer cell, cells further than radius or off the map are not
+# visible. Like XDraw, the interpolation approximates the exact line of
+# sight near occluder silhouettes, see compareWithRayMarching: about 4% of
+# the cells differ, either way. It suits fog of war and perception, not
+# culling, which must never hide what is in sight.
+class TerrainVisibility:
+
+    # Height of the cells off the map, never visible and never occluding
+    NoHeight = -1.0e30
+
+    def __init__(self, terrainRegionMap, radius=32, targetHeight=0.0):
+        self.heightMap = terrainRegionMap
+        self.radius = radius
+        # Height above the cell top of what is looked at, e.g. an agent
+        self.targetHeight = targetHeight
+
+        r = radius
+        width = 2 * r + 1
+        self.width = width
+        # Per ring: window flat indices of the ring cells, of the two cells
+        # of the previous ring and the weight of the second one
+        self.rings = []
+        for d in range(1, r + 1):
+            di = np.concatenate([np.arange(-d, d + 1), np.full(2 * d - 1, d), np.arange(d, -d - 1, -1), np.full(2 * d - 1, -d)])
+            dj = np.concatenate([np.full(2 * d + 1, -d), np.arange(-d + 1, d), np.full(2 * d + 1, d), np.arange(d - 1, -d, -1)])
+            t = (d - 1) / d
+            pi = di * t
+            pj = dj * t
+            # The crossing is on a row or a column of the previous ring
+            alongJ = np.abs(di) == d
+            ai = np.where(alongJ, np.rint(pi), np.floor(pi)).astype(np.int64)
+            aj = np.where(alongJ, np.floor(pj), np.rint(pj)).astype(np.int64)
+            w = np.where(alongJ, pj - aj, pi - ai)
+            bi = np.minimum(np.where(alongJ, ai, ai + 1), d - 1)
+            bj = np.minimum(np.where(alongJ, aj + 1, aj), d - 1)
+            self.rings.append(((di + r) * width + (dj + r), di, dj,
+                               (ai + r) * width + (aj + r), (bi + r) * width + (bj + r), w.astype(np.float32),
+                               np.hypot(di, dj).astype(np.float32) * terrainRegionMap.cellDimension))
+        wi, wj = np.meshgrid(np.arange(-r, r + 1), np.arange(-r, r + 1), indexing='ij')
+        self.inRadius = wi * wi + wj * wj <= r * r
+        self.windowDI = wi
+        self.windowDJ = wj
+
+    # Visibility windows of the viewers, an (n, 3) array of (i, j, eye z)
+    # rows. Returns an (n, 2 radius + 1, 2 radius + 1) bool array, window
+    # cell (a, b) is the map cell (i + a - radius, j + b - radius).
+    def computeWindows(self, kHeights, viewers):
+        trm = self.heightMap
+        r = self.radius
+        viewers = np.asarray(viewers, dtype=np.float64).reshape(-1, 3)
+        n = len(viewers)
+        vi = viewers[:, 0].astype(np.int64)
+        vj = viewers[:, 1].astype(np.int64)
+        eyeZ = viewers[:, 2].astype(np.float32)[:, None]
+        # Cell tops of the windows only, the cost does not grow with the map
+        oi = int(vi.min()) - r
+        oj = int(vj.min()) - r
+        tops = np.full((int(vi.max()) + r + 1 - oi, int(vj.max()) + r + 1 - oj), TerrainVisibility.NoHeight, dtype=np.float32)
+        i0 = max(oi, 0)
+        j0 = max(oj, 0)
+        i1 = min(oi + tops.shape[0], trm.size)
+        j1 = min(oj + tops.shape[1], trm.size)
+        tops[i0 - oi:i1 - oi, j0 - oj:j1 - oj] = kHeights[i0:i1, j0:j1] * np.float32(trm.heightStep)
+
+        horizon = np.full((n, self.width * self.width), TerrainVisibility.NoHeight, dtype=np.float32)
+        visible = np.zeros((n, self.width * self.width), dtype=bool)
+        visible[:, r * self.width + r] = True
+        for cells, di, dj, a, b, w, dist in self.rings:
+            z = tops[vi[:, None] - oi + di[None, :], vj[:, None] - oj + dj[None, :]]
+            seen = horizon[:, a] * (1.0 - w) + horizon[:, b] * w
+            visible[:, cells] = (z + self.targetHeight - eyeZ) / dist >= seen
+            horizon[:, cells] = np.maximum(seen, (z - eyeZ) / dist)
+        visible = visible.reshape(n, self.width, self.width)
+        visible &= self.inRadius
+        # Off the map
+        visible &= (vi[:, None, None] + self.windowDI >= 0) & (vi[:, None, None] + self.windowDI < trm.size)
+        visible &= (vj[:, None, None] + self.windowDJ >= 0) & (vj[:, None, None] + self.windowDJ < trm.size)
+        return visible
+
+    # Window cells within fieldOfView degrees around the heading
+    def getFieldOfViewMask(self, heading, fieldOfView):
+        direction = Heading.getDirection3f(heading)
+        dx = direction.getX()
+        dy = direction.getY()
+        length = np.hypot(self.windowDI, self.windowDJ) * math.hypot(dx, dy)
+        cosine = (self.windowDI * dx + self.windowDJ * dy) / np.maximum(length, 1e-6)
+        mask = cosine >= math.cos(math.radians(fieldOfView) / 2.0)
+        mask[self.radius, self.radius] = True
+        return mask
+
+    # Map and window slices of the window of cell (i, j)
+    def getWindowSlices(self, i, j):
+        r = self.radius
+        size = self.heightMap.size
+        i0 = max(i - r, 0)
+        j0 = max(j - r, 0)
+        i1 = min(i + r + 1, size)
+        j1 = min(j + r + 1, size)
+        return ((slice(i0, i1), slice(j0, j1)),
+                (slice(i0 - (i - r), i1 - (i - r)), slice(j0 - (j - r), j1 - (j - r))))
+
+###############################################################################
+# Visibility of one moving viewer, e.g. the avatar or the camera
+#
+# The window is swept again only when the viewer changes cell or eye
+# height, or when an edit touched it, a turn only applies another field of
+# view mask. A move of one cell is not updated incrementally: every line of
+# sight changes with the eye, so the whole window is swept again. A sweep
+# of one viewer is a few ms for a radius of 32 (1.5 to 3 ms on the machines
+# measured, see the module check), whatever the map size. Cells seen so far
+# are kept in explored, for fog of war.
+class ViewerVisibility:
+
+    def __init__(self, terrainVisibility, fieldOfView=None):
+        self.terrainVisibility = terrainVisibility
+        # Degrees around the heading, None to see all around
+        self.fieldOfView = fieldOfView
+        size = terrainVisibility.heightMap.size
+        self.explored = np.zeros((size, size), dtype=bool)
+
+        self.cell = None
+        self.eyeZ = None
+        self.heading = None
+        self.window = None
+        self.visible = None
+        self.dirty = True
+
+        # Statistics
+        self.numSweeps = 0
+
+    # Heights of the rect (i0, j0, i1, j1) changed
+    def invalidateRect(self, rect):
+        if self.cell is None:
+            return
+        i, j = self.cell
+        r = self.terrainVisibility.radius
+        if(rect[0] <= i + r and rect[2] > i - r and rect[1] <= j + r and rect[3] > j - r):
+            self.dirty = True
+
+    # Returns True when the visible cells may have changed
+    def update(self, kHeights, i, j, eyeZ, heading=None):
+        changed = False
+        if(self.dirty or self.cell != (i, j) or self.eyeZ != eyeZ):
+            self.window = self.terrainVisibility.computeWindows(kHeights, [(i, j, eyeZ)])[0]
+            self.cell = (i, j)
+            self.eyeZ = eyeZ
+            self.dirty = False
+            self.numSweeps += 1
+            changed = True
+        if(changed or heading != self.heading):
+            self.heading = heading
+            self.visible = self.window
+            if(self.fieldOfView is not None and heading is not None):
+                self.visible = self.window & self.terrainVisibility.getFieldOfViewMask(heading, self.fieldOfView)
+            mapSlices, windowSlices = self.terrainVisibility.getWindowSlices(i, j)
+            self.explored[mapSlices] |= self.visible[windowSlices]
+            changed = True
+        return changed
+
+    def isCellVisible(self, i, j):
+        r = self.terrainVisibility.radius
+        a = i - self.cell[0] + r
+        b = j - self.cell[1] + r
+        if(a < 0 or b < 0 or a >= self.visible.shape[0] or b >= self.visible.shape[1]):
+            return False
+        return bool(self.visible[a, b])
+
+    # Any visible cell in [i0,i1[ x [j0,j1[
+    def isRectVisible(self, i0, j0, i1, j1):
+        r = self.terrainVisibility.radius
+        ci, cj = self.cell
+        a0 = max(i0 - ci + r, 0)
+        b0 = max(j0 - cj + r, 0)
+        a1 = min(i1 - ci + r, self.visible.shape[0])
+        b1 = min(j1 - cj + r, self.visible.shape[1])
+        if(a0 >= a1 or b0 >= b1):
+            return False
+        return bool(self.visible[a0:a1, b0:b1].any())
+
+    # Whether the rect lies entirely within the radius of the sweep
+    def isRectSwept(self, i0, j0, i1, j1):
+        r = self.terrainVisibility.radius
+        ci, cj = self.cell
+        di = max(abs(i0 - ci), abs(i1 - 1 - ci))
+        dj = max(abs(j0 - cj), abs(j1 - 1 - cj))
+        return di * di + dj * dj <= r * r
+
+    # (i, j) arrays of the visible cells
+    def getVisibleCells(self):
+        r = self.terrainVisibility.radius
+        a, b = np.nonzero(self.visible)
+        return a + self.cell[0] - r, b + self.cell[1] - r
+
+# Reference visibility of one viewer by marching along every line of sight,
+# returns the fraction of window cells where the sweep agrees with it
+def compareWithRayMarching(terrainVisibility, kHeights, viewer, samplesPerCell=4):
+    trm = terrainVisibility.heightMap
+    r = terrainVisibility.radius
+    vi, vj, eyeZ = int(viewer[0]), int(viewer[1]), float(viewer[2])
+    window = terrainVisibility.computeWindows(kHeights, [viewer])[0]
+    reference = np.zeros_like(window)
+    reference[r, r] = True
+    for a in range(2 * r + 1):
+        for b in range(2 * r + 1):
+            di = a - r
+            dj = b - r
+            ti = vi + di
+            tj = vj + dj
+            if((di == 0 and dj == 0) or not terrainVisibility.inRadius[a, b] or not trm.isValid(ti, tj)):
+                continue
+            dist = math.hypot(di, dj)
+            targetSlope = (kHeights[ti, tj] * trm.heightStep + terrainVisibility.targetHeight - eyeZ) / dist
+            numSamples = max(int(dist * samplesPerCell), 1)
+            t = np.arange(1, numSamples) / numSamples
+            si = np.rint(vi + di * t).astype(np.int32)
+            sj = np.rint(vj + dj * t).astype(np.int32)
+            # Samples in the viewer or the target cell do not occlude
+            between = ((si != vi) | (sj != vj)) & ((si != ti) | (sj != tj))
+            slopes = (kHeights[si, sj] * trm.heightStep - eyeZ) / (dist * t)
+            reference[a, b] = not bool((slopes[between] > targetSlope).any())
+    return float((window == reference).mean())
+
+# Agreement with ray marching, and sweep time of a batch of viewers
+if __name__ == "__main__":
+    from terrainMesh import TerrainMesher
+
+    parser = argparse.ArgumentParser(description="Lightworld: terrain visibility check")
+    parser.add_argument("--size", type=int, default=128)
+    parser.add_argument("--height", type=int, default=18)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--radius", type=int, default=32)
+    parser.add_argument("--viewers", type=int, default=64)
+    parser.add_argument("--eye", type=float, default=1.5, help="eye height above the cell top")
+    options = parser.parse_args()
+
+    terrainMesher = TerrainMesher()
+    terrainMesher.generateTerrain(options.size, options.height, options.seed)
+    trm = terrainMesher.heightMap
+    kHeights = trm.getKHeightArray()
+    visibility = TerrainVisibility(trm, options.radius)
+    rng = np.random.default_rng(options.seed)
+    cells = rng.integers(0, options.size, size=(options.viewers, 2))
+    viewers = np.column_stack([cells, kHeights[cells[:, 0], cells[:, 1]] * trm.heightStep + options.eye])
+
+    start = time.perf_counter()
+    windows = visibility.computeWindows(kHeights, viewers)
+    batchTime = time.perf_counter() - start
+    start = time.perf_counter()
+    for viewer in viewers:
+        visibility.computeWindows(kHeights, [viewer])
+    singleTime = time.perf_counter() - start
+    print("{0} viewers, radius {1}: {2:.1f} ms batched, {3:.1f} ms one by one ({4:.2f} ms a sweep), {5:.0%} of the cells visible".format(
+        options.viewers, options.radius, batchTime * 1000.0, singleTime * 1000.0,
+        singleTime * 1000.0 / options.viewers, windows.mean()))
+    agreement = [compareWithRayMarching(visibility, kHeights, viewer) for viewer in viewers[:8]]
+    print("Agreement with ray marching: {0:.2%} mean, {1:.2%} worst".format(sum(agreement) / len(agreement), min(agreement)))
@@ -0,0 +1,169 @@
+from panda3d.core import Texture, SamplerState
+import json
+import math
+import numpy as np
+
+from meshing import TextureUVMap
+
+###############################################################################
+# Box filter resampling of a (rows, columns, channels) image to n x n,
+# each output texel is the area weighted mean of the texels it covers
+def resampleArea(image, n):
+    def getWeights(m):
+        edges = np.arange(n + 1) * (m / n)
+        k = np.arange(m)
+        lo = np.maximum(edges[:-1, None], k[None, :])
+        hi = np.minimum(edges[1:, None], k[None, :] + 1)
+        return np.clip(hi - lo, 0.0, None) * (n / m)
+    return np.einsum('ik,klc,jl->ijc', getWeights(image.shape[0]), image, getWeights(image.shape[1]))
+
+# Texture as a float RGBA array, rows from the bottom (v) then columns (u)
+def getTextureRGBA(texture):
+    data = np.frombuffer(memoryview(texture.getRamImageAs("RGBA")), dtype=np.uint8)
+    return data.reshape(texture.getYSize(), texture.getXSize(), 4).astype(np.float32) / 255.0
+
+# RGBA float array to the BGRA bytes of a Texture ram image
+def getRamImageBytes(rgba):
+    return np.clip(rgba[:, :, [2, 1, 0, 3]] * 255.0 + 0.5, 0, 255).astype(np.uint8).tobytes()
+
+###############################################################################
+# Packs square material textures in a power of two texture atlas
+#
+# Materials go in the cells of an n x n grid (n power of two), each tile is
+# surrounded by a gutter holding the opposite side of the tile, so that
+# filtering near the tile edge reads the continuation of the tiled texture
+# instead of the neighbour material:
+#
+#     +---------------+
+#     | gutter        |
+#     |   +-------+   |
+#     |   | tile  |   |   cellSize = tile + 2 * gutter
+#     |   +-------+   |
+#     |               |
+#     +---------------+
+#
+# Mip levels are built per tile from the source texture, cell and gutter
+# halve at each level. Levels with a gutter of at least one texel never
+# read another tile, sampling is clamped to the last of them.
+class TextureAtlasBuilder:
+
+    def __init__(self, cellSize=128, gutter=8):
+        if(cellSize & (cellSize - 1) or gutter & (gutter - 1) or 2 * gutter >= cellSize):
+            raise ValueError("Atlas cell {0} and gutter {1} must be powers of two, gutter under half the cell".format(cellSize, gutter))
+        self.cellSize = cellSize
+        self.gutter = gutter
+        self.materials = []
+
+    def addMaterialImage(self, name, rgba):
+        self.materials.append((name, np.asarray(rgba, dtype=np.float32)))
+
+    def addMaterial(self, name, texture):
+        self.addMaterialImage(name, getTextureRGBA(texture))
+
+    # Materials cut from a hand made atlas: squares of a gridSize x gridSize
+    # texture with a margin, materials maps names to (i, j) squares
+    def addMaterialsFromGrid(self, texture, gridSize, materials, margin=0.1):
+        rgba = getTextureRGBA(texture)
+        cellX = rgba.shape[1] / gridSize
+        cellY = rgba.shape[0] / gridSize
+        for name, (i, j) in materials.items():
+            u0 = int(math.ceil((i + margin) * cellX))
+            u1 = int(math.floor((i + 1 - margin) * cellX))
+            v0 = int(math.ceil((j + margin) * cellY))
+            v1 = int(math.floor((j + 1 - margin) * cellY))
+            self.addMaterialImage(name, rgba[v0:v1, u0:u1])
+
+    # Average RGB of each material, e.g. for flat shaded maps
+    def getMeanColors(self):
+        return {name: tuple(float(c) for c in rgba[:, :, 0:3].mean(axis=(0, 1))) for name, rgba in self.materials}
+
+    # Cells per side of the atlas
+    def getGridSize(self):
+        gridSize = 1
+        while gridSize * gridSize < len(self.materials):
+            gridSize *= 2
+        return gridSize
+
+    # Last mip level with a gutter of at least a texel
+    def getMaxCleanLevel(self):
+        return int(math.log2(self.gutter))
+
+    # Material squares of the atlas, in materials order along i then j
+    def getTable(self):
+        gridSize = self.getGridSize()
+        return {
+            "gridSize": gridSize,
+            "margin": self.gutter / self.cellSize,
+            "materials": {name: [k % gridSize, k // gridSize] for k, (name, _) in enumerate(self.materials)},
+        }
+
+    def saveTable(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.getTable(), f, indent=2)
+
+    def getUVMap(self):
+        return TextureUVMap.fromTable(self.getTable())
+
+    # RGBA float images of the atlas, from level 0 down to 1 x 1
+    def buildLevels(self):
+        gridSize = self.getGridSize()
+        levels = []
+        cell = self.cellSize
+        gutter = self.gutter
+        while cell >= 1:
+            tile = cell - 2 * gutter
+            atlas = np.zeros((gridSize * cell, gridSize * cell, 4), dtype=np.float32)
+            for k, (name, rgba) in enumerate(self.materials):
+                padded = np.pad(resampleArea(rgba, tile), ((gutter, gutter), (gutter, gutter), (0, 0)), mode='wrap')
+                u = (k % gridSize) * cell
+                v = (k // gridSize) * cell
+                atlas[v:v+cell, u:u+cell] = padded
+            levels.append(atlas)
+            cell //= 2
+            gutter //= 2
+        # Under one texel per cell, materials can only be averaged together
+        while levels[-1].shape[0] > 1:
+            levels.append(resampleArea(levels[-1], levels[-1].shape[0] // 2))
+        return levels
+
+    def buildTexture(self, name="atlas"):
+        levels = self.buildLevels()
+        size = levels[0].shape[0]
+        texture = Texture(name)
+        texture.setup2dTexture(size, size, Texture.T_unsigned_byte, Texture.F_rgba8)
+        texture.setRamImage(getRamImageBytes(levels[0]))
+        for level in range(1, len(levels)):
+            memoryview(texture.makeRamMipmapImage(level))[:] = getRamImageBytes(levels[level])
+        sampler = SamplerState()
+        sampler.setMinfilter(SamplerState.FT_linear_mipmap_linear)
+        sampler.setMagfilter(SamplerState.FT_linear)
+        sampler.setWrapU(SamplerState.WM_clamp)
+        sampler.setWrapV(SamplerState.WM_clamp)
+        sampler.setMaxLod(self.getMaxCleanLevel())
+        texture.setDefaultSampler(sampler)
+        return texture
+
+    # Texture array alternative: one page per material, no gutter or uv
+    # offset needed, the page is selected by a third texture coordinate
+    def getLayers(self):
+        return {name: k for k, (name, _) in enumerate(self.materials)}
+
+    def buildTextureArray(self, name="materials"):
+        size = self.cellSize
+        texture = Texture(name)
+        texture.setup2dTextureArray(size, size, len(self.materials), Texture.T_unsigned_byte, Texture.F_rgba8)
+        # Pages are filtered separately, mip levels cannot bleed
+        level = 0
+        while size >= 1:
+            pages = b"".join(getRamImageBytes(resampleArea(rgba, size)) for _, rgba in self.materials)
+            if level == 0:
+                texture.setRamImage(pages)
+            else:
+                memoryview(texture.makeRamMipmapImage(level))[:] = pages
+            level += 1
+            size //= 2
+        texture.setMinfilter(SamplerState.FT_linear_mipmap_linear)
+        texture.setMagfilter(SamplerState.FT_linear)
+        texture.setWrapU(SamplerState.WM_repeat)
+        texture.setWrapV(SamplerState.WM_repeat)
+        return texture
@@ -0,0 +1,274 @@
+import argparse
+import numpy as np
+
+###############################################################################
+# Cellular water flow over the terrain height map
+#
+# Each cell holds a water depth on top of its terrain height. At every tick
+# water flows towards the four direct neighbors with a lower surface, in
+# proportion to the surface difference and limited by the available depth.
+# Flows are computed once per cell border, which conserves water exactly:
+#
+#              +-------+
+#              |  yp   |
+#      +-------+-------+-------+
+#      |  xn   | i,j   |  xp   |     surface = terrain z + depth
+#      +-------+-------+-------+
+#              |  yn   |
+#              +-------+
+#
+# The border ring is the open sea: its surface is held at sea level so rivers
+# drain out of the map. Sources add water at a constant rate.
+class WaterSimulation:
+
+    def __init__(self, terrainRegionMap, tickRate=10.0):
+        trm = terrainRegionMap
+        self.heightMap = trm
+        self.tickRate = tickRate
+        self.tickTime = 1.0 / tickRate
+        self.timeAccumulator = 0.0
+        # Limit catch-up after a long frame
+        self.maxTicksPerAdvance = 4
+
+        # Fraction of the surface difference moved to a neighbor per tick
+        self.flowRate = 0.2
+        # Depth under which a cell is considered dry
+        self.minDepth = 0.01
+        # Surface change that triggers a remesh of the water chunk
+        self.remeshThreshold = trm.heightStep / 8.0
+        self.seaLevel = -trm.waterOffset
+
+        self.terrainZ = trm.getKHeightArray().astype(np.float32) * trm.heightStep
+        self.seaDepth = np.maximum(self.seaLevel - self.terrainZ, 0.0)
+        self.depth = np.maximum(trm.waterLevelMap - self.terrainZ, 0.0)
+        self.wet = self.depth > self.minDepth
+        trm.waterLevelMap[:, :] = np.where(self.wet, self.terrainZ + self.depth, self.terrainZ)
+        trm.waterMap = self.wet.tolist()
+        self.meshedLevel = trm.waterLevelMap.copy()
+        self.meshedWet = self.wet.copy()
+
+        self.sources = {}
+        self.numTicks = 0
+
+        # Only the bounding rectangle of the moving water is simulated. Its
+        # borders with still water act as walls for a tick, until the moving
+        # water reaches them.
+        self.windowed = True
+        self.activityThreshold = 1e-5
+        self.activeRect = (0, 0, trm.size, trm.size)
+        # Cells stepped but not yet written back to the region map, and
+        # written back but not yet checked for remeshing
+        self.publishRect = None
+        self.meshRect = None
+
+    def addSource(self, i, j, rate):
+        if self.heightMap.isValid(i, j):
+            self.sources[(i, j)] = self.sources.get((i, j), 0.0) + rate
+
+    def removeSource(self, i, j):
+        self.sources.pop((i, j), None)
+
+    # Terrain heights changed in the cell rectangle [i0,i1[ x [j0,j1[
+    def refreshTerrain(self, rect):
+        i0, j0, i1, j1 = rect
+        trm = self.heightMap
+        for i in range(i0, i1):
+            self.terrainZ[i, j0:j1] = trm.heightMap[i][j0:j1]
+        self.terrainZ[i0:i1, j0:j1] *= trm.heightStep
+        self.seaDepth[i0:i1, j0:j1] = np.maximum(self.seaLevel - self.terrainZ[i0:i1, j0:j1], 0.0)
+        # Keep the water surface, the terrain may have displaced it
+        level = trm.waterLevelMap[i0:i1, j0:j1]
+        self.depth[i0:i1, j0:j1] = np.maximum(level - self.terrainZ[i0:i1, j0:j1], 0.0)
+        self.wet[i0:i1, j0:j1] = self.depth[i0:i1, j0:j1] > self.minDepth
+        for i in range(i0, i1):
+            trm.waterMap[i][j0:j1] = self.wet[i, j0:j1].tolist()
+        self.activeRect = self.__unionRect(self.activeRect, rect)
+        self.meshRect = self.__unionRect(self.meshRect, rect)
+
+    # Run the ticks due for the elapsed time, returns True if any ran
+    def advance(self, dt):
+        self.timeAccumulator += dt
+        numTicks = 0
+        while(self.timeAccumulator >= self.tickTime and numTicks < self.maxTicksPerAdvance):
+            self.step()
+            self.timeAccumulator -= self.tickTime
+            numTicks += 1
+        if(numTicks == self.maxTicksPerAdvance):
+            self.timeAccumulator = 0.0
+        if numTicks > 0:
+            self.__publish()
+        return numTicks > 0
+
+    def step(self):
+        i0, j0, i1, j1 = self.__getActiveWindow()
+        if(i0 < i1 and j0 < j1):
+            self.__flow(i0, j0, i1, j1)
+            self.publishRect = self.__unionRect(self.publishRect, (i0, j0, i1, j1))
+        else:
+            self.activeRect = None
+
+        for (i, j), rate in self.sources.items():
+            self.depth[i, j] += rate * self.tickTime
+
+        # Open sea on the border
+        self.depth[0, :] = self.seaDepth[0, :]
+        self.depth[-1, :] = self.seaDepth[-1, :]
+        self.depth[:, 0] = self.seaDepth[:, 0]
+        self.depth[:, -1] = self.seaDepth[:, -1]
+        self.numTicks += 1
+
+    # Cells that sent or received water last tick and the sources, grown by
+    # one cell so that water can spread into still neighbors
+    def __getActiveWindow(self):
+        if not self.windowed:
+            return 0, 0, self.heightMap.size, self.heightMap.size
+        rects = [] if self.activeRect is None else [self.activeRect]
+        for (i, j) in self.sources.keys():
+            rects.append((i, j, i+1, j+1))
+        if not rects:
+            return 0, 0, 0, 0
+        size = self.heightMap.size
+        return (max(min(r[0] for r in rects) - 1, 0), max(min(r[1] for r in rects) - 1, 0),
+                min(max(r[2] for r in rects) + 1, size), min(max(r[3] for r in rects) + 1, size))
+
+    def __unionRect(self, a, b):
+        if a is None:
+            return b
+        return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+    # One flow update inside the window [i0,i1[ x [j0,j1[, its edges act as walls
+    def __flow(self, i0, j0, i1, j1):
+        depth = self.depth[i0:i1, j0:j1]
+        surface = self.terrainZ[i0:i1, j0:j1] + depth
+
+        # Surface differences across every i and j cell border
+        di = surface[:-1, :] - surface[1:, :]
+        dj = surface[:, :-1] - surface[:, 1:]
+        flowIP = np.maximum(di, 0.0) * self.flowRate   # (i,j) -> (i+1,j)
+        flowIN = np.maximum(-di, 0.0) * self.flowRate  # (i+1,j) -> (i,j)
+        flowJP = np.maximum(dj, 0.0) * self.flowRate   # (i,j) -> (i,j+1)
+        flowJN = np.maximum(-dj, 0.0) * self.flowRate  # (i,j+1) -> (i,j)
+
+        # Scale the outflows down where they exceed the available depth
+        totalFlow = np.zeros_like(depth)
+        totalFlow[:-1, :] += flowIP
+        totalFlow[1:, :] += flowIN
+        totalFlow[:, :-1] += flowJP
+        totalFlow[:, 1:] += flowJN
+        scale = np.ones_like(depth)
+        np.divide(depth, totalFlow, out=scale, where=totalFlow > depth)
+        totalFlow *= scale
+        flowIP *= scale[:-1, :]
+        flowIN *= scale[1:, :]
+        flowJP *= scale[:, :-1]
+        flowJN *= scale[:, 1:]
+
+        depth -= totalFlow
+        depth[1:, :] += flowIP
+        depth[:-1, :] += flowIN
+        depth[:, 1:] += flowJP
+        depth[:, :-1] += flowJN
+        np.maximum(depth, 0.0, out=depth)
+
+        # Next active rectangle: cells that sent or received water this
+        # tick, a cell that just received water may send it on
+        inflow = np.zeros_like(depth)
+        inflow[1:, :] += flowIP
+        inflow[:-1, :] += flowIN
+        inflow[:, 1:] += flowJP
+        inflow[:, :-1] += flowJN
+        moving = (totalFlow > self.activityThreshold) | (inflow > self.activityThreshold)
+        rows = np.nonzero(moving.any(axis=1))[0]
+        cols = np.nonzero(moving.any(axis=0))[0]
+        if(len(rows) == 0):
+            self.activeRect = None
+        else:
+            self.activeRect = (i0 + int(rows[0]), j0 + int(cols[0]), i0 + int(rows[-1]) + 1, j0 + int(cols[-1]) + 1)
+
+    # Write levels and wet flags of the stepped cells back to the region map
+    def __publish(self):
+        if self.publishRect is None:
+            return
+        trm = self.heightMap
+        i0, j0, i1, j1 = self.publishRect
+        window = (slice(i0, i1), slice(j0, j1))
+        depth = self.depth[window]
+        terrainZ = self.terrainZ[window]
+        wet = depth > self.minDepth
+        level = trm.waterLevelMap[window]
+        np.copyto(level, terrainZ)
+        np.add(terrainZ, depth, out=level, where=wet)
+        changedI, changedJ = np.nonzero(wet != self.wet[window])
+        for i, j in zip(changedI.tolist(), changedJ.tolist()):
+            trm.waterMap[i0 + i][j0 + j] = bool(wet[i, j])
+        self.wet[window] = wet
+        self.meshRect = self.__unionRect(self.meshRect, self.publishRect)
+        self.publishRect = None
+
+    # Chunks whose water surface moved enough since they were last meshed.
+    # Their levels are marked as meshed.
+    def popChangedChunks(self, chunkGrid):
+        if self.meshRect is None:
+            return []
+        cs = chunkGrid.chunkSize
+        # Whole chunks around the changed cells
+        i0 = self.meshRect[0] // cs * cs
+        j0 = self.meshRect[1] // cs * cs
+        i1 = min((self.meshRect[2] + cs - 1) // cs * cs, self.heightMap.size)
+        j1 = min((self.meshRect[3] + cs - 1) // cs * cs, self.heightMap.size)
+        self.meshRect = None
+        window = (slice(i0, i1), slice(j0, j1))
+        level = self.heightMap.waterLevelMap[window]
+        changed = (np.abs(level - self.meshedLevel[window]) > self.remeshThreshold) | (self.wet[window] != self.meshedWet[window])
+        nci = (i1 - i0 + cs - 1) // cs
+        ncj = (j1 - j0 + cs - 1) // cs
+        padded = np.zeros((nci * cs, ncj * cs), dtype=bool)
+        padded[:changed.shape[0], :changed.shape[1]] = changed
+        changedChunks = padded.reshape(nci, cs, ncj, cs).any(axis=(1, 3))
+        chunkList = []
+        for ci, cj in zip(*np.nonzero(changedChunks)):
+            chunk = chunkGrid.getChunk(i0 // cs + int(ci), j0 // cs + int(cj))
+            cells = (slice(chunk.i0, chunk.i1), slice(chunk.j0, chunk.j1))
+            self.meshedLevel[cells] = self.heightMap.waterLevelMap[cells]
+            self.meshedWet[cells] = self.wet[cells]
+            chunkList.append(chunk)
+        return chunkList
+
+# Largest water depth difference between the windowed simulation and the
+# same ticks stepped over the whole map
+def compareWithFullWindow(terrainRegionMap, sources, numTicks):
+    simulations = []
+    for windowed in (True, False):
+        trm = terrainRegionMap
+        trm.resetWaterLevels()
+        simulation = WaterSimulation(trm)
+        simulation.windowed = windowed
+        for (i, j), rate in sources.items():
+            simulation.addSource(i, j, rate)
+        for _ in range(numTicks):
+            simulation.step()
+        simulations.append(simulation)
+    return float(np.abs(simulations[0].depth - simulations[1].depth).max())
+
+# A channel sloping down in +i fed by a source at its top: the front must
+# keep going when it crosses the border of the active window
+if __name__ == "__main__":
+    from terrainMap import TerrainRegionMap
+
+    parser = argparse.ArgumentParser(description="Lightworld: windowed water simulation check")
+    parser.add_argument("--size", type=int, default=32)
+    parser.add_argument("--ticks", type=int, default=3000)
+    options = parser.parse_args()
+
+    size = options.size
+    trm = TerrainRegionMap(size, size)
+    channel = size // 2
+    for i in range(size):
+        for j in range(size):
+            # One cell wide, walls 20 steps over the bed, the bed drops a
+            # step per row
+            trm.heightMap[i][j] = size - i + (0 if j == channel else 20)
+            trm.waterMap[i][j] = False
+    sources = {(2, channel): 2.0}
+    difference = compareWithFullWindow(trm, sources, options.ticks)
+    print("Largest depth difference with the full window after {0} ticks: {1:.6f}".format(options.ticks, difference))
@@ -0,0 +1,466 @@
+import argparse
+import asyncio
+import random
+import struct
+import zlib
+import numpy as np
+
+from panda3d.core import LVector2f
+
+from terrainMap import TerrainRegionMap
+from terrainGeneration import TerrainPipeline
+from navigation import Heading
+from avatar import LightworldAvatarControler
+from simulationClock import FixedTimestepClock
+
+###############################################################################
+# World server protocol
+#
+# Messages over a stream socket, little endian:
+#
+#   +-------------+------+---------+
+#   | length (u4) | type | payload |
+#   +-------------+------+---------+
+#
+# Client to server:
+#   HELO  protocol version
+#   CMND  one command byte (move, turn, terrain edit ahead of the avatar)
+#
+# Server to client:
+#   WLCM  agent id and region layout
+#   CHNK  ci, cj, zlib(heights int16, water flags uint8), chunk cells i-major
+#   CELL  i0, j0, i1, j1, zlib payload as CHNK: edited cells of a sent chunk
+#   UNLD  ci, cj: chunk left the interest area, client may drop it
+#   AGNT  id, x, y, z, heading per changed agent in the interest area
+#   GONE  id of an agent that left the interest area or disconnected
+#
+# Meshes never go over the wire, clients mesh the cells they receive.
+class WorldProtocol:
+    Version = 1
+    MessageStruct = struct.Struct('<IB')
+    HelloStruct = struct.Struct('<H')
+    WelcomeStruct = struct.Struct('<HIIIIffi')
+    ChunkStruct = struct.Struct('<ii')
+    CellsStruct = struct.Struct('<iiii')
+    AgentStruct = struct.Struct('<IfffB')
+    AgentIdStruct = struct.Struct('<I')
+    CommandStruct = struct.Struct('<B')
+
+    Hello = 1
+    Welcome = 2
+    Chunk = 3
+    Cells = 4
+    Unload = 5
+    Agents = 6
+    AgentGone = 7
+    Command = 8
+
+    MoveForward = 1
+    MoveBackward = 2
+    TurnLeft = 3
+    TurnRight = 4
+    RaiseTerrain = 5
+    LowerTerrain = 6
+    FlattenTerrain = 7
+
+    CompressionLevel = 6
+
+    def pack(messageType, payload=b''):
+        return WorldProtocol.MessageStruct.pack(len(payload), messageType) + payload
+
+    async def read(reader):
+        header = await reader.readexactly(WorldProtocol.MessageStruct.size)
+        length, messageType = WorldProtocol.MessageStruct.unpack(header)
+        payload = await reader.readexactly(length) if length > 0 else b''
+        return messageType, payload
+
+    def encodeCells(kHeights, water):
+        return zlib.compress(kHeights.astype('<i2').tobytes() + water.astype(np.uint8).tobytes(), WorldProtocol.CompressionLevel)
+
+    # Heights and water flags as [i,j] arrays of the given shape
+    def decodeCells(data, shape):
+        payload = zlib.decompress(data)
+        numCells = shape[0] * shape[1]
+        kHeights = np.frombuffer(payload, dtype='<i2', count=numCells).reshape(shape)
+        water = np.frombuffer(payload, dtype=np.uint8, offset=2 * numCells).reshape(shape)
+        return kHeights, water
+
+    def getChunkRange(size, chunkSize, ci, cj):
+        i0 = ci * chunkSize
+        j0 = cj * chunkSize
+        return i0, j0, min(i0 + chunkSize, size), min(j0 + chunkSize, size)
+
+###############################################################################
+# Server side state of a client: its agent and what it was sent
+class WorldClientSession:
+
+    def __init__(self, agentId, writer, avatarControler):
+        self.agentId = agentId
+        self.writer = writer
+        self.avatarControler = avatarControler
+        self.commands = []
+        # Chunks sent, and chunks in the interest area still to send
+        self.sentChunks = set()
+        self.pendingChunks = []
+        # Last agent states sent, by agent id
+        self.sentAgents = {}
+        self.bytesSent = 0
+
+    def send(self, messageType, payload=b''):
+        message = WorldProtocol.pack(messageType, payload)
+        self.writer.write(message)
+        self.bytesSent += len(message)
+
+###############################################################################
+# World server: owns the region map and the agents
+#
+# Runs a fixed timestep simulation of the agents from the client commands.
+# After each frame of steps every client gets, within interestRadius of its
+# agent: the chunks it does not have yet (nearest first, maxChunksPerFrame),
+# the edited cells of the chunks it has, and the agents that changed.
+class WorldServer:
+
+    def __init__(self, terrainRegionMap, chunkSize=16, interestRadius=48.0, stepRate=20.0, maxChunksPerFrame=8):
+        self.heightMap = terrainRegionMap
+        self.chunkSize = chunkSize
+        self.numChunks = (terrainRegionMap.size + chunkSize - 1) // chunkSize
+        self.interestRadius = interestRadius
+        self.maxChunksPerFrame = maxChunksPerFrame
+        self.simulationClock = FixedTimestepClock(stepRate)
+        # Avatar move and turn speed, in world units per second
+        self.avatarSpeed = 9.0
+        self.brushRadius = 1
+        self.sessions = {}
+        self.nextAgentId = 1
+        self.server = None
+        self.running = False
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self.__handleClient, host, port)
+        self.running = True
+        asyncio.get_running_loop().create_task(self.__runSimulation())
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.running = False
+        self.server.close()
+        await self.server.wait_closed()
+        for session in list(self.sessions.values()):
+            session.writer.close()
+
+    def getBytesSent(self):
+        return sum(session.bytesSent for session in self.sessions.values())
+
+    async def __handleClient(self, reader, writer):
+        session = None
+        try:
+            messageType, payload = await WorldProtocol.read(reader)
+            if(messageType != WorldProtocol.Hello or
+               WorldProtocol.HelloStruct.unpack(payload)[0] != WorldProtocol.Version):
+                writer.close()
+                return
+            session = self.__addSession(writer)
+            while True:
+                messageType, payload = await WorldProtocol.read(reader)
+                if messageType == WorldProtocol.Command:
+                    session.commands.append(WorldProtocol.CommandStruct.unpack(payload)[0])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if session is not None:
+                del self.sessions[session.agentId]
+                for other in self.sessions.values():
+                    if session.agentId in other.sentAgents:
+                        del other.sentAgents[session.agentId]
+                        other.send(WorldProtocol.AgentGone, WorldProtocol.AgentIdStruct.pack(session.agentId))
+            writer.close()
+
+    def __addSession(self, writer):
+        trm = self.heightMap
+        avatarControler = LightworldAvatarControler(1.0, 3.0)
+        avatarControler.setInitialPos(0, 0, trm.getZHeightFromXY(0.0, 0.0))
+        session = WorldClientSession(self.nextAgentId, writer, avatarControler)
+        self.nextAgentId += 1
+        self.sessions[session.agentId] = session
+        session.send(WorldProtocol.Welcome, WorldProtocol.WelcomeStruct.pack(
+            WorldProtocol.Version, session.agentId, trm.size, trm.height, self.chunkSize,
+            trm.cellDimension, trm.heightStep, int(trm.maxKHeight)))
+        return session
+
+    async def __runSimulation(self):
+        loop = asyncio.get_running_loop()
+        lastTime = loop.time()
+        while self.running:
+            await asyncio.sleep(self.simulationClock.stepTime)
+            now = loop.time()
+            self.simulationClock.advance(now - lastTime, self.step)
+            lastTime = now
+            self.publish()
+            await asyncio.gather(*(s.writer.drain() for s in self.sessions.values()), return_exceptions=True)
+
+    def step(self):
+        distance = self.avatarSpeed * self.simulationClock.stepTime
+        for session in self.sessions.values():
+            for command in session.commands:
+                self.__applyCommand(session.avatarControler, command)
+            session.commands = []
+            avatarControler = session.avatarControler
+            if avatarControler.moving:
+                avatarControler.moveByDistance(distance)
+            elif avatarControler.turning:
+                avatarControler.turnByDistance(distance)
+
+    def __applyCommand(self, avatarControler, command):
+        trm = self.heightMap
+        if command in (WorldProtocol.MoveForward, WorldProtocol.MoveBackward):
+            if command == WorldProtocol.MoveForward:
+                target = avatarControler.getTargetForwardCell()
+            else:
+                target = avatarControler.getTargetBackwardCell()
+            ij = trm.getIJLocationFromXY(target.getXy())
+            if trm.isValid(ij.getX(), ij.getY()):
+                target.setZ(trm.getZHeightFromIJ(ij.getX(), ij.getY()))
+                avatarControler.triggerMove(target)
+        elif command == WorldProtocol.TurnLeft:
+            avatarControler.triggerTurnLeft()
+        elif command == WorldProtocol.TurnRight:
+            avatarControler.triggerTurnRight()
+        elif command in (WorldProtocol.RaiseTerrain, WorldProtocol.LowerTerrain, WorldProtocol.FlattenTerrain):
+            ij = trm.getIJLocationFromXY(avatarControler.getTargetForwardCell().getXy())
+            if not trm.isValid(ij.getX(), ij.getY()):
+                return
+            if command == WorldProtocol.RaiseTerrain:
+                trm.raiseTerrain(ij.getX(), ij.getY(), self.brushRadius)
+            elif command == WorldProtocol.LowerTerrain:
+                trm.lowerTerrain(ij.getX(), ij.getY(), self.brushRadius)
+            else:
+                trm.flattenTerrain(ij.getX(), ij.getY(), self.brushRadius)
+
+    # Chunks within the interest radius of xy, nearest first
+    def getInterestChunks(self, x, y):
+        trm = self.heightMap
+        cs = self.chunkSize
+        center = trm.getIJLocationFromXY(LVector2f(x, y))
+        cellRadius = self.interestRadius / trm.cellDimension
+        chunks = []
+        for ci in range(max(int((center.getX() - cellRadius) // cs), 0), min(int((center.getX() + cellRadius) // cs), self.numChunks - 1) + 1):
+            for cj in range(max(int((center.getY() - cellRadius) // cs), 0), min(int((center.getY() + cellRadius) // cs), self.numChunks - 1) + 1):
+                # Distance from the avatar cell to the chunk rectangle
+                di = max(ci * cs - center.getX(), 0, center.getX() - (ci + 1) * cs + 1)
+                dj = max(cj * cs - center.getY(), 0, center.getY() - (cj + 1) * cs + 1)
+                distance2 = di * di + dj * dj
+                if distance2 <= cellRadius * cellRadius:
+                    chunks.append((distance2, ci, cj))
+        chunks.sort()
+        return [(ci, cj) for _, ci, cj in chunks]
+
+    # Send the changes of the frame to every client
+    def publish(self):
+        trm = self.heightMap
+        dirtyRects = trm.popDirtyRects()
+        if dirtyRects:
+            kHeights = trm.getKHeightArray()
+            water = np.array(trm.waterMap, dtype=np.uint8)
+        agentStates = {}
+        for agentId, session in self.sessions.items():
+            pos = session.avatarControler.curPos
+            agentStates[agentId] = (pos.getX(), pos.getY(), pos.getZ(), Heading.AllSides.index(session.avatarControler.curHeading))
+
+        for session in self.sessions.values():
+            pos = session.avatarControler.curPos
+            interest = self.getInterestChunks(pos.getX(), pos.getY())
+            interestSet = set(interest)
+
+            # Edits of chunks the client has, clipped per chunk
+            for rect in dirtyRects:
+                for ci in range(rect[0] // self.chunkSize, (rect[2] - 1) // self.chunkSize + 1):
+                    for cj in range(rect[1] // self.chunkSize, (rect[3] - 1) // self.chunkSize + 1):
+                        if (ci, cj) not in session.sentChunks:
+                            continue
+                        ci0, cj0, ci1, cj1 = WorldProtocol.getChunkRange(trm.size, self.chunkSize, ci, cj)
+                        i0, j0, i1, j1 = max(rect[0], ci0), max(rect[1], cj0), min(rect[2], ci1), min(rect[3], cj1)
+                        session.send(WorldProtocol.Cells, WorldProtocol.CellsStruct.pack(i0, j0, i1, j1) +
+                                     WorldProtocol.encodeCells(kHeights[i0:i1, j0:j1], water[i0:i1, j0:j1]))
+
+            for ci, cj in sorted(session.sentChunks - interestSet):
+                session.sentChunks.discard((ci, cj))
+                session.send(WorldProtocol.Unload, WorldProtocol.ChunkStruct.pack(ci, cj))
+            session.pendingChunks = [chunk for chunk in interest if chunk not in session.sentChunks]
+            if session.pendingChunks:
+                self.__sendChunks(session, session.pendingChunks[:self.maxChunksPerFrame])
+
+            self.__sendAgents(session, agentStates)
+
+    def __sendChunks(self, session, chunkList):
+        trm = self.heightMap
+        for ci, cj in chunkList:
+            i0, j0, i1, j1 = WorldProtocol.getChunkRange(trm.size, self.chunkSize, ci, cj)
+            kHeights = np.array([row[j0:j1] for row in trm.heightMap[i0:i1]], dtype=np.int32)
+            water = np.array([row[j0:j1] for row in trm.waterMap[i0:i1]], dtype=np.uint8)
+            session.send(WorldProtocol.Chunk, WorldProtocol.ChunkStruct.pack(ci, cj) + WorldProtocol.encodeCells(kHeights, water))
+            session.sentChunks.add((ci, cj))
+
+    def __sendAgents(self, session, agentStates):
+        own = agentStates[session.agentId]
+        radius2 = self.interestRadius * self.interestRadius
+        payload = b''
+        for agentId, state in agentStates.items():
+            dx = state[0] - own[0]
+            dy = state[1] - own[1]
+            if dx * dx + dy * dy > radius2:
+                if agentId in session.sentAgents:
+                    del session.sentAgents[agentId]
+                    session.send(WorldProtocol.AgentGone, WorldProtocol.AgentIdStruct.pack(agentId))
+            elif session.sentAgents.get(agentId) != state:
+                session.sentAgents[agentId] = state
+                payload += WorldProtocol.AgentStruct.pack(agentId, *state)
+        if payload:
+            session.send(WorldProtocol.Agents, payload)
+
+###############################################################################
+# Client keeping a local copy of the chunks around its agent
+#
+# Received cells are written to a TerrainRegionMap and their rects added to
+# its dirty rects, so the usual remeshing picks them up.
+class WorldClient:
+
+    def __init__(self):
+        self.heightMap = None
+        self.agentId = None
+        self.chunkSize = None
+        self.loadedChunks = set()
+        # Agent states (x, y, z, heading index) by id
+        self.agents = {}
+        self.bytesReceived = 0
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(WorldProtocol.pack(WorldProtocol.Hello, WorldProtocol.HelloStruct.pack(WorldProtocol.Version)))
+        await self.writer.drain()
+        self.handleMessage(*await WorldProtocol.read(self.reader))
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    def sendCommand(self, command):
+        self.writer.write(WorldProtocol.pack(WorldProtocol.Command, WorldProtocol.CommandStruct.pack(command)))
+
+    # Handle messages until the connection closes
+    async def receive(self):
+        try:
+            while True:
+                self.handleMessage(*await WorldProtocol.read(self.reader))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    def handleMessage(self, messageType, payload):
+        self.bytesReceived += WorldProtocol.MessageStruct.size + len(payload)
+        if messageType == WorldProtocol.Welcome:
+            version, self.agentId, size, height, self.chunkSize, cellDimension, heightStep, maxKHeight = \
+                WorldProtocol.WelcomeStruct.unpack(payload)
+            trm = TerrainRegionMap(size, height)
+            trm.cellDimension = cellDimension
+            trm.heightStep = heightStep
+            trm.waterOffset = trm.heightStep / 2.0
+            trm.resetWaterLevels()
+            trm.maxKHeight = maxKHeight
+            self.heightMap = trm
+        elif messageType == WorldProtocol.Chunk:
+            ci, cj = WorldProtocol.ChunkStruct.unpack_from(payload)
+            rect = WorldProtocol.getChunkRange(self.heightMap.size, self.chunkSize, ci, cj)
+            self.__setCells(rect, payload[WorldProtocol.ChunkStruct.size:])
+            self.loadedChunks.add((ci, cj))
+        elif messageType == WorldProtocol.Cells:
+            rect = WorldProtocol.CellsStruct.unpack_from(payload)
+            self.__setCells(rect, payload[WorldProtocol.CellsStruct.size:])
+        elif messageType == WorldProtocol.Unload:
+            self.loadedChunks.discard(WorldProtocol.ChunkStruct.unpack(payload))
+        elif messageType == WorldProtocol.Agents:
+            for agentId, x, y, z, heading in WorldProtocol.AgentStruct.iter_unpack(payload):
+                self.agents[agentId] = (x, y, z, heading)
+        elif messageType == WorldProtocol.AgentGone:
+            self.agents.pop(WorldProtocol.AgentIdStruct.unpack(payload)[0], None)
+
+    def __setCells(self, rect, data):
+        trm = self.heightMap
+        i0, j0, i1, j1 = rect
+        kHeights, water = WorldProtocol.decodeCells(data, (i1 - i0, j1 - j0))
+        for i in range(i0, i1):
+            trm.heightMap[i][j0:j1] = kHeights[i - i0].tolist()
+            trm.waterMap[i][j0:j1] = (water[i - i0] != 0).tolist()
+        trm.maxKHeight = max(trm.maxKHeight, int(kHeights.max()))
+        trm.dirtyRects.append((i0, j0, i1, j1))
+
+###############################################################################
+# Client sending random commands, for testing on localhost
+class SimulatedClient(WorldClient):
+
+    Commands = [WorldProtocol.MoveForward] * 6 + [WorldProtocol.MoveBackward, WorldProtocol.TurnLeft, WorldProtocol.TurnRight,
+                WorldProtocol.RaiseTerrain, WorldProtocol.LowerTerrain, WorldProtocol.FlattenTerrain]
+
+    def __init__(self, seed, commandPeriod=0.1):
+        WorldClient.__init__(self)
+        self.random = random.Random(seed)
+        self.commandPeriod = commandPeriod
+
+    async def run(self, host, port, duration):
+        await self.connect(host, port)
+        receiveTask = asyncio.get_running_loop().create_task(self.receive())
+        loop = asyncio.get_running_loop()
+        end = loop.time() + duration
+        while loop.time() < end:
+            self.sendCommand(self.random.choice(SimulatedClient.Commands))
+            await self.writer.drain()
+            await asyncio.sleep(self.commandPeriod)
+        return receiveTask
+
+    # Chunks of the client that differ from the server region map
+    def getMismatchedChunks(self, serverHeightMap):
+        serverHeights = serverHeightMap.getKHeightArray()
+        clientHeights = self.heightMap.getKHeightArray()
+        mismatched = []
+        for ci, cj in sorted(self.loadedChunks):
+            i0, j0, i1, j1 = WorldProtocol.getChunkRange(serverHeightMap.size, self.chunkSize, ci, cj)
+            if not np.array_equal(serverHeights[i0:i1, j0:j1], clientHeights[i0:i1, j0:j1]):
+                mismatched.append((ci, cj))
+        return mismatched
+
+# Server and simulated clients on localhost, returns a summary dict
+async def runLocalTest(size=128, height=18, numClients=4, duration=5.0, seed=1):
+    trm = TerrainRegionMap(size, height)
+    TerrainPipeline.makeBasic(seed).fill(trm)
+    server = WorldServer(trm)
+    port = await server.start()
+    clients = [SimulatedClient(seed + k) for k in range(numClients)]
+    receiveTasks = await asyncio.gather(*(client.run("127.0.0.1", port, duration) for client in clients))
+    # Let the last commands and updates go through
+    await asyncio.sleep(1.0)
+    summary = {
+        "clients": numClients,
+        "bytesSent": server.getBytesSent(),
+        "loadedChunks": [len(client.loadedChunks) for client in clients],
+        "visibleAgents": [len(client.agents) for client in clients],
+        "mismatchedChunks": sum(len(client.getMismatchedChunks(trm)) for client in clients),
+    }
+    for client in clients:
+        await client.close()
+    await asyncio.gather(*receiveTasks)
+    await server.stop()
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lightworld: world server with simulated clients on localhost")
+    parser.add_argument("--size", type=int, default=128)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--seed", type=int, default=1)
+    options = parser.parse_args()
+    summary = asyncio.run(runLocalTest(options.size, 18, options.clients, options.duration, options.seed))
+    for name, value in summary.items():
+        print("{0}: {1}".format(name, value))
@@ -0,0 +1,268 @@
+from panda3d.core import LVector3, LVector2f
+import struct
+import zlib
+import numpy as np
+
+from terrainMap import TerrainRegionMap
+from navigation import Heading
+
+###############################################################################
+# Binary world snapshot
+#
+#   +--------+--------+-----+-------+--------+--------+-------+--------+
+#   | header | record | ... | index | footer | record | index | footer |
+#   +--------+--------+-----+-------+--------+--------+-------+--------+
+#    \_____________ full save ______________/ \____ delta save ______/
+#
+# Records are appended and never rewritten. Each save ends with a full index
+# of the latest record of every key followed by a footer pointing to it, so
+# readers only parse the last footer, the last index and the chunks they need.
+#
+# Record: tag, ci, cj, compressed length, raw length, zlib payload
+#   b'CHNK': heights as int16 then water flags as uint8, chunk cells i-major
+#   b'WATR': record version as uint8 then water levels as float32, chunk
+#            cells i-major. Snapshots without it load with sea level water.
+#   b'META': max kHeight of the terrain
+#   b'AGNT': avatar position and heading
+
+class WorldSnapshotFormat:
+    Magic = b'LWSN'
+    Version = 1
+    HeaderStruct = struct.Struct('<4sHHIIIff')
+    RecordStruct = struct.Struct('<4siiII')
+    IndexEntryStruct = struct.Struct('<4siiQI')
+    FooterStruct = struct.Struct('<QI4s')
+    FooterMagic = b'LWIX'
+
+    ChunkTag = b'CHNK'
+    MetaTag = b'META'
+    AgentTag = b'AGNT'
+    WaterTag = b'WATR'
+
+    MetaStruct = struct.Struct('<i')
+    AgentStruct = struct.Struct('<fffB')
+    WaterStruct = struct.Struct('<B')
+    WaterVersion = 1
+
+    CompressionLevel = 6
+
+    def getChunkRange(size, chunkSize, ci, cj):
+        i0 = ci * chunkSize
+        j0 = cj * chunkSize
+        return i0, j0, min(i0 + chunkSize, size), min(j0 + chunkSize, size)
+
+###############################################################################
+# Writing full and delta snapshots
+class WorldSnapshotWriter:
+
+    def __init__(self, path, chunkSize=16):
+        self.path = path
+        self.chunkSize = chunkSize
+
+    # Write the whole world, replacing any existing file
+    def saveFull(self, terrainRegionMap, avatarControler=None):
+        trm = terrainRegionMap
+        numChunks = (trm.size + self.chunkSize - 1) // self.chunkSize
+        chunkList = [(ci, cj) for ci in range(numChunks) for cj in range(numChunks)]
+        with open(self.path, 'wb') as f:
+            f.write(WorldSnapshotFormat.HeaderStruct.pack(
+                WorldSnapshotFormat.Magic, WorldSnapshotFormat.Version, 0,
+                trm.size, trm.height, self.chunkSize, trm.cellDimension, trm.heightStep))
+            self.__writeRecords(f, {}, trm, chunkList, avatarControler)
+
+    # Append the given chunks (and avatar if any) to an existing snapshot
+    def saveDelta(self, terrainRegionMap, chunkList, avatarControler=None):
+        reader = WorldSnapshotReader(self.path)
+        if(reader.size != terrainRegionMap.size or reader.chunkSize != self.chunkSize):
+            raise ValueError("Snapshot layout does not match the terrain")
+        index = dict(reader.index)
+        reader.close()
+        with open(self.path, 'r+b') as f:
+            f.seek(0, 2)
+            self.__writeRecords(f, index, terrainRegionMap, chunkList, avatarControler)
+
+    def __writeRecords(self, f, index, trm, chunkList, avatarControler):
+        kHeights = trm.getKHeightArray()
+        water = np.array(trm.waterMap, dtype=np.uint8).reshape(trm.size, trm.size)
+        for ci, cj in chunkList:
+            i0, j0, i1, j1 = WorldSnapshotFormat.getChunkRange(trm.size, self.chunkSize, ci, cj)
+            payload = kHeights[i0:i1, j0:j1].astype('<i2').tobytes() + water[i0:i1, j0:j1].tobytes()
+            self.__writeRecord(f, index, WorldSnapshotFormat.ChunkTag, ci, cj, payload)
+            payload = WorldSnapshotFormat.WaterStruct.pack(WorldSnapshotFormat.WaterVersion) + \
+                trm.waterLevelMap[i0:i1, j0:j1].astype('<f4').tobytes()
+            self.__writeRecord(f, index, WorldSnapshotFormat.WaterTag, ci, cj, payload)
+
+        payload = WorldSnapshotFormat.MetaStruct.pack(int(trm.maxKHeight))
+        self.__writeRecord(f, index, WorldSnapshotFormat.MetaTag, 0, 0, payload)
+
+        if avatarControler is not None:
+            pos = avatarControler.curPos
+            payload = WorldSnapshotFormat.AgentStruct.pack(
+                pos.getX(), pos.getY(), pos.getZ(),
+                Heading.AllSides.index(avatarControler.curHeading))
+            self.__writeRecord(f, index, WorldSnapshotFormat.AgentTag, 0, 0, payload)
+
+        indexOffset = f.tell()
+        for (tag, ci, cj), (offset, length) in index.items():
+            f.write(WorldSnapshotFormat.IndexEntryStruct.pack(tag, ci, cj, offset, length))
+        f.write(WorldSnapshotFormat.FooterStruct.pack(indexOffset, len(index), WorldSnapshotFormat.FooterMagic))
+
+    def __writeRecord(self, f, index, tag, ci, cj, payload):
+        compressed = zlib.compress(payload, WorldSnapshotFormat.CompressionLevel)
+        offset = f.tell()
+        f.write(WorldSnapshotFormat.RecordStruct.pack(tag, ci, cj, len(compressed), len(payload)))
+        f.write(compressed)
+        index[(tag, ci, cj)] = (offset, f.tell() - offset)
+
+###############################################################################
+# Random access reading of a snapshot
+class WorldSnapshotReader:
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+
+        header = self.file.read(WorldSnapshotFormat.HeaderStruct.size)
+        magic, version, _, self.size, self.height, self.chunkSize, self.cellDimension, self.heightStep = \
+            WorldSnapshotFormat.HeaderStruct.unpack(header)
+        if(magic != WorldSnapshotFormat.Magic or version != WorldSnapshotFormat.Version):
+            raise ValueError("Not a world snapshot: {0}".format(path))
+        self.numChunks = (self.size + self.chunkSize - 1) // self.chunkSize
+
+        # Only the last index is live, older ones are left behind by delta saves
+        self.file.seek(-WorldSnapshotFormat.FooterStruct.size, 2)
+        indexOffset, numEntries, footerMagic = WorldSnapshotFormat.FooterStruct.unpack(
+            self.file.read(WorldSnapshotFormat.FooterStruct.size))
+        if(footerMagic != WorldSnapshotFormat.FooterMagic):
+            raise ValueError("Truncated world snapshot: {0}".format(path))
+        self.file.seek(indexOffset)
+        entrySize = WorldSnapshotFormat.IndexEntryStruct.size
+        data = self.file.read(entrySize * numEntries)
+        self.index = {}
+        for n in range(numEntries):
+            tag, ci, cj, offset, length = WorldSnapshotFormat.IndexEntryStruct.unpack_from(data, n * entrySize)
+            self.index[(tag, ci, cj)] = (offset, length)
+
+    def close(self):
+        self.file.close()
+
+    def hasChunk(self, ci, cj):
+        return (WorldSnapshotFormat.ChunkTag, ci, cj) in self.index
+
+    def __readRecord(self, tag, ci, cj):
+        offset, length = self.index[(tag, ci, cj)]
+        self.file.seek(offset)
+        data = self.file.read(length)
+        _, _, _, compressedLength, rawLength = WorldSnapshotFormat.RecordStruct.unpack_from(data)
+        payload = zlib.decompress(data[WorldSnapshotFormat.RecordStruct.size:])
+        if(len(payload) != rawLength):
+            raise ValueError("Corrupted record {0} {1},{2}".format(tag, ci, cj))
+        return payload
+
+    # Heights and water flags of one chunk as [i,j] arrays
+    def readChunk(self, ci, cj):
+        i0, j0, i1, j1 = WorldSnapshotFormat.getChunkRange(self.size, self.chunkSize, ci, cj)
+        shape = (i1 - i0, j1 - j0)
+        payload = self.__readRecord(WorldSnapshotFormat.ChunkTag, ci, cj)
+        numCells = shape[0] * shape[1]
+        kHeights = np.frombuffer(payload, dtype='<i2', count=numCells).reshape(shape)
+        water = np.frombuffer(payload, dtype=np.uint8, offset=2 * numCells).reshape(shape)
+        return kHeights, water
+
+    def hasWaterLevels(self, ci, cj):
+        return (WorldSnapshotFormat.WaterTag, ci, cj) in self.index
+
+    # Water levels of one chunk as an [i,j] array
+    def readWaterLevels(self, ci, cj):
+        i0, j0, i1, j1 = WorldSnapshotFormat.getChunkRange(self.size, self.chunkSize, ci, cj)
+        payload = self.__readRecord(WorldSnapshotFormat.WaterTag, ci, cj)
+        version = WorldSnapshotFormat.WaterStruct.unpack_from(payload)[0]
+        if(version != WorldSnapshotFormat.WaterVersion):
+            raise ValueError("Unsupported water record version {0} at {1},{2}".format(version, ci, cj))
+        return np.frombuffer(payload, dtype='<f4', offset=WorldSnapshotFormat.WaterStruct.size).reshape(i1 - i0, j1 - j0)
+
+    def readMaxKHeight(self):
+        payload = self.__readRecord(WorldSnapshotFormat.MetaTag, 0, 0)
+        return WorldSnapshotFormat.MetaStruct.unpack(payload)[0]
+
+    def hasAgent(self):
+        return (WorldSnapshotFormat.AgentTag, 0, 0) in self.index
+
+    # Avatar position and heading
+    def readAgent(self):
+        payload = self.__readRecord(WorldSnapshotFormat.AgentTag, 0, 0)
+        x, y, z, heading = WorldSnapshotFormat.AgentStruct.unpack(payload)
+        return LVector3(x, y, z), Heading.AllSides[heading]
+
+    # Empty region with the snapshot dimensions, chunks are filled by loadChunk
+    def createRegionMap(self):
+        trm = TerrainRegionMap(self.size, self.height)
+        trm.cellDimension = self.cellDimension
+        trm.heightStep = self.heightStep
+        trm.waterOffset = trm.heightStep / 2.0
+        trm.resetWaterLevels()
+        trm.maxKHeight = self.readMaxKHeight()
+        return trm
+
+    # Water flags follow the levels, the saved flags are only kept for older
+    # readers
+    def loadChunk(self, terrainRegionMap, ci, cj):
+        trm = terrainRegionMap
+        i0, j0, i1, j1 = WorldSnapshotFormat.getChunkRange(self.size, self.chunkSize, ci, cj)
+        kHeights, _ = self.readChunk(ci, cj)
+        if self.hasWaterLevels(ci, cj):
+            trm.waterLevelMap[i0:i1, j0:j1] = self.readWaterLevels(ci, cj)
+        wet = trm.waterLevelMap[i0:i1, j0:j1] > kHeights * trm.heightStep
+        for i in range(i0, i1):
+            trm.heightMap[i][j0:j1] = kHeights[i - i0].tolist()
+            trm.waterMap[i][j0:j1] = wet[i - i0].tolist()
+
+###############################################################################
+# Lazy streaming of snapshot chunks into a terrain region
+class WorldSnapshotStreamer:
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.heightMap = reader.createRegionMap()
+        self.loaded = set()
+
+    def isLoaded(self, ci, cj):
+        return (ci, cj) in self.loaded
+
+    # Load up to maxChunks missing chunks, closest to the xy location first.
+    # Returns the list of chunks loaded by this call.
+    def streamAround(self, x, y, radius, maxChunks=None):
+        trm = self.heightMap
+        center = trm.getIJLocationFromXY(LVector2f(x, y))
+        cellRadius = int(radius / trm.cellDimension) + 1
+        cs = self.reader.chunkSize
+        ciMin = max((center.getX() - cellRadius) // cs, 0)
+        ciMax = min((center.getX() + cellRadius) // cs, self.reader.numChunks - 1)
+        cjMin = max((center.getY() - cellRadius) // cs, 0)
+        cjMax = min((center.getY() + cellRadius) // cs, self.reader.numChunks - 1)
+        missing = []
+        for ci in range(ciMin, ciMax + 1):
+            for cj in range(cjMin, cjMax + 1):
+                if not self.isLoaded(ci, cj) and self.reader.hasChunk(ci, cj):
+                    dci = ci * cs + cs / 2 - center.getX()
+                    dcj = cj * cs + cs / 2 - center.getY()
+                    missing.append((dci * dci + dcj * dcj, ci, cj))
+        missing.sort()
+        if maxChunks is not None:
+            missing = missing[:maxChunks]
+        loadedNow = []
+        for _, ci, cj in missing:
+            self.reader.loadChunk(trm, ci, cj)
+            self.loaded.add((ci, cj))
+            loadedNow.append((ci, cj))
+        return loadedNow
+
+    def streamAll(self):
+        loadedNow = []
+        for ci in range(self.reader.numChunks):
+            for cj in range(self.reader.numChunks):
+                if not self.isLoaded(ci, cj) and self.reader.hasChunk(ci, cj):
+                    self.reader.loadChunk(self.heightMap, ci, cj)
+                    self.loaded.add((ci, cj))
+                    loadedNow.append((ci, cj))
+        return loadedNow